@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+"""
+Downloads the word similarity benchmarks used by SimilarityWordEmbeddingEval.
+
+Call as:
+python bin/cache_similarity_tasks.py [$FUEL_DATA_PATH/similarity]
+"""
+
+import argparse
+import logging
+
+from dictlearn.extensions import cache_similarity_tasks
+
+
+def main():
+    logging.basicConfig(
+        level='INFO',
+        format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
+
+    parser = argparse.ArgumentParser("Downloads the word similarity benchmarks")
+    parser.add_argument("cache_dir", nargs='?',
+                        help="Destination, similarity/ in the Fuel data path by default")
+    args = parser.parse_args()
+    cache_similarity_tasks(args.cache_dir)
+
+
+if __name__ == "__main__":
+    main()
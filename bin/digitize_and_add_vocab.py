@@ -4,7 +4,8 @@ import argparse
 import logging
 
 from dictlearn.vocab import Vocabulary
-from dictlearn.h5py_conversion import add_words_ids_to_squad, add_word_ids_to_snli
+from dictlearn.h5py_conversion import (
+    add_words_ids_to_squad, add_word_ids_to_snli, DIGITIZE_CHUNK_SIZE)
 
 def main():
     logging.basicConfig(
@@ -15,15 +16,19 @@ def main():
     parser.add_argument("vocab", help="Vocabulary")
     parser.add_argument("--type", choices=("squad", "snli"), default='squad',
         help="What kind of data should be converted")
+    parser.add_argument("--chunk-size", type=int, default=DIGITIZE_CHUNK_SIZE,
+        help="How many words (squad) or sentences (snli) to digitize at once")
+    parser.add_argument("--num-workers", type=int, default=1,
+        help="Number of processes doing the vocabulary lookups")
     parser.add_argument("h5", help="Destination")
     args = parser.parse_args()
 
     vocab = Vocabulary(args.vocab)
 
     if args.type == 'squad':
-        add_words_ids_to_squad(args.h5, vocab)
+        add_words_ids_to_squad(args.h5, vocab, args.chunk_size, args.num_workers)
     elif args.type == 'snli':
-        add_word_ids_to_snli(args.h5, vocab)
+        add_word_ids_to_snli(args.h5, vocab, args.chunk_size, args.num_workers)
     else:
         raise NotImplementedError()
 
@@ -3,6 +3,8 @@ import os
 from dictlearn.language_model_training import initialize_data_and_model
 from dictlearn.obw_configs import lm_config_registry
 from dictlearn.main import main_evaluate
+from dictlearn.function_cache import function
+from dictlearn.util import checkpoint_paths, write_results_table
 from dictlearn.retrieval import Dictionary
 from blocks.serialization import load_parameters
 from blocks.model import Model
@@ -10,7 +12,6 @@ from blocks.filter import VariableFilter
 from collections import Counter
 import numpy as np
 import json
-import theano
 import theano.tensor as T
 
 def evaluate_lm(config, tar_path, part, num_examples, dest_path, **kwargs):
@@ -18,22 +19,26 @@ def evaluate_lm(config, tar_path, part, num_examples, dest_path, **kwargs):
 
     if part not in ['valid', 'test_unseen', 'test']:
         raise ValueError()
+    if c['stateful'] and part == 'test_unseen':
+        raise ValueError("test_unseen predictions are not saved statefully")
 
     data, lm, _ = initialize_data_and_model(c)
     words = T.ltensor3('words')
     words_mask = T.matrix('words_mask')
 
-    costs = lm.apply(words, words_mask)
+    # only build the auxiliary variables that are computed below
+    auxiliary = set(lm.perplexity_names()) | {'unk_ratio'}
+    if part == 'test_unseen':
+        auxiliary.add('proba_out')
+    costs, updates = lm.apply(words, words_mask, auxiliary=auxiliary,
+                              stateful=c['stateful'])
     cg = Model(costs)
 
-    with open(tar_path) as src:
-        cg.set_parameter_values(load_parameters(src))
-
     perplexities = VariableFilter(name_regex='perplexity.*')(cg)
     mask_sums = [p.tag.aggregation_scheme.denominator for p in perplexities]
     CEs = [p.tag.aggregation_scheme.numerator for p in perplexities]
 
-    proba_out, = VariableFilter(name='proba_out')(cg)
+    proba_out = VariableFilter(name='proba_out')(cg)
     unk_ratios = VariableFilter(name_regex='unk_ratio.*')(cg)
     #num_definitions, = VariableFilter(name='num_definitions')(cg)
     print perplexities
@@ -46,70 +51,99 @@ def evaluate_lm(config, tar_path, part, num_examples, dest_path, **kwargs):
 
     compute_l = CEs + mask_sums + unk_ratios
     if part == 'test_unseen':
-        compute_l.append(proba_out)
+        compute_l.extend(proba_out)
 
     compute = dict({p.name: p for p in compute_l})
     print "to compute:", compute.keys()
-    predict_f = theano.function([words, words_mask], compute)
-
-    if part == 'test_unseen':
-        batch_size = 1
+    # in the stateful mode the updates carry the states between batches
+    predict_f = function([words, words_mask], compute,
+                         updates=updates if c['stateful'] else [], name='predict')
+
+    if c['stateful']:
+        # the part is read as one text by batch_size_valid contiguous
+        # streams, the states are carried over max_length tokens
+        stream = data.get_stateful_stream(
+            part, batch_size=c['batch_size_valid'], max_length=c['max_length'])
     else:
-        batch_size = 128 # size of test_unseen
-    stream = data.get_stream(part, batch_size=batch_size, max_length=100)
-    raw_data = [] # list of dicts containing the inputs and computed outputs
-    i=0
-    print "start computing"
-    for input_data in stream.get_epoch_iterator(as_dict=True):
-        if i and i%100==0:
-            print "iteration:", i
-        words = input_data['words']
-        words_mask = input_data['words_mask']
-        to_save = predict_f(words, words_mask)
-        to_save.update(input_data)
-        raw_data.append(to_save)
-        i+=1
-
-    # aggregate in the log space 
-    aggregated = Counter()
-    sum_mask_track = Counter()
-    for d in raw_data:
-        coef = d['words_mask'].sum() # over timesteps and batches
-        for name in name_to_aggregate:
-            aggregated[name] += d[name+"_num"]
-            sum_mask_track[name] += d[name+"_denom"]
-
-    for k,v in aggregated.iteritems():
-        print "k, v, m:", k, v, sum_mask_track[k]
-        aggregated[k] = np.exp(v/sum_mask_track[k])
-
-    n_params = sum([np.prod(p.shape.eval()) for p in cg.parameters])
-    aggregated['n_params'] = n_params
-    print "aggregated stats:", aggregated
-    print "# of parameters {}".format(n_params)
-
-
-    #TODO: check that different batch_size yields same validation error than 
-    # end of training validation error.
-    # TODO: I think blocks aggreg is simply mean which should break 
-    # when we use masks??? investigate
-
-    if not os.path.exists(dest_path):
-        os.makedirs(dest_path)
-
-    if part == 'test_unseen':
-        np.savez(os.path.join(dest_path, "predictions"),
-             words = input_data['words'], 
-             words_mask = input_data['words_mask'],
-             #unk_ratio = to_save['unk_ratio'],
-             #def_unk_ratio = to_save['def_unk_ratio'],
-             proba_out = to_save['languagemodel_apply_proba_out'],
-             vocab_in = lm._vocab.words[:c['num_input_words']],
-             vocab_out = lm._vocab.words[:c['num_output_words']])
-
-    json.dump(aggregated, 
-            open(os.path.join(dest_path, "aggregates.json"), "w"),
-            sort_keys=True, indent=2)
+        if part == 'test_unseen':
+            batch_size = 1
+        else:
+            batch_size = 128 # size of test_unseen
+        stream = data.get_stream(part, batch_size=batch_size, max_length=100)
+
+    def evaluate_checkpoint(tar_path, dest_path):
+        with open(tar_path) as src:
+            cg.set_parameter_values(load_parameters(src))
+        lm.reset_states()
+
+        raw_data = [] # list of dicts containing the inputs and computed outputs
+        i=0
+        print "start computing"
+        for input_data in stream.get_epoch_iterator(as_dict=True):
+            if i and i%100==0:
+                print "iteration:", i
+            words = input_data['words']
+            words_mask = input_data['words_mask']
+            to_save = predict_f(words, words_mask)
+            to_save.update(input_data)
+            raw_data.append(to_save)
+            i+=1
+
+        # aggregate in the log space 
+        aggregated = Counter()
+        sum_mask_track = Counter()
+        for d in raw_data:
+            coef = d['words_mask'].sum() # over timesteps and batches
+            for name in name_to_aggregate:
+                aggregated[name] += d[name+"_num"]
+                sum_mask_track[name] += d[name+"_denom"]
+
+        for k,v in aggregated.iteritems():
+            print "k, v, m:", k, v, sum_mask_track[k]
+            aggregated[k] = np.exp(v/sum_mask_track[k])
+
+        n_params = sum([np.prod(p.shape.eval()) for p in cg.parameters])
+        aggregated['n_params'] = n_params
+        print "aggregated stats:", aggregated
+        print "# of parameters {}".format(n_params)
+
+
+        #TODO: check that different batch_size yields same validation error than 
+        # end of training validation error.
+        # TODO: I think blocks aggreg is simply mean which should break 
+        # when we use masks??? investigate
+
+        if not os.path.exists(dest_path):
+            os.makedirs(dest_path)
+
+        if part == 'test_unseen':
+            np.savez(os.path.join(dest_path, "predictions"),
+                 words = input_data['words'], 
+                 words_mask = input_data['words_mask'],
+                 #unk_ratio = to_save['unk_ratio'],
+                 #def_unk_ratio = to_save['def_unk_ratio'],
+                 proba_out = to_save['languagemodel_apply_proba_out'],
+                 vocab_in = lm._vocab.words[:c['num_input_words']],
+                 vocab_out = lm._vocab.words[:c['num_output_words']])
+
+        json.dump(aggregated, 
+                open(os.path.join(dest_path, "aggregates.json"), "w"),
+                sort_keys=True, indent=2)
+        return aggregated
+
+    # A glob of checkpoints is evaluated with the same function and
+    # stream, only the parameters are changed
+    tar_paths = checkpoint_paths(tar_path)
+    if len(tar_paths) == 1:
+        evaluate_checkpoint(tar_paths[0], dest_path)
+    else:
+        rows = []
+        for path in tar_paths:
+            print "evaluating", path
+            name = os.path.splitext(os.path.basename(path))[0]
+            aggregated = evaluate_checkpoint(path, os.path.join(dest_path, name))
+            rows.append(dict(aggregated, checkpoint=path))
+        write_results_table(rows, os.path.join(dest_path, 'results.csv'))
 
 if __name__ == "__main__":
     main_evaluate(lm_config_registry, evaluate_lm)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Exports the word and definition embeddings of a trained model.
+
+The matrices are written as float32 .npy files together with words.txt,
+they can be loaded with numpy.load(path, mmap_mode='r'). See
+dictlearn/embedding_export.py.
+
+Call as:
+python bin/export_embeddings.py nli_simple $CONFIG $RUN/main.tar $DEST \
+    --vocab $DATA_DIR/snli/vocab_all.txt --workers 4
+"""
+import logging
+import argparse
+
+from dictlearn.vocab import Vocabulary
+from dictlearn.embedding_export import initialize_model, export_embeddings
+from dictlearn.theano_util import load_brick_parameters
+
+logger = logging.getLogger()
+
+
+def main():
+    logging.basicConfig(
+        level='INFO',
+        format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
+
+    parser = argparse.ArgumentParser(
+        "Exports the embeddings of a trained model")
+    parser.add_argument("model", choices=['lm', 'qa', 'nli_simple', 'nli_esim'])
+    parser.add_argument("config", help="The configuration, a name or a json file")
+    parser.add_argument("tar_path", help="The tar file with parameters")
+    parser.add_argument("dest", help="Destination directory")
+    parser.add_argument("--vocab",
+                        help="The words to export, the vocabulary of the model by default")
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="The number of processes retrieving the definitions")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted export")
+    args = parser.parse_args()
+
+    model, retrieval, vocab = initialize_model(args.model, args.config)
+    missing = load_brick_parameters(model, args.tar_path)
+    if missing:
+        logger.info("Parameters not in the checkpoint: {}".format(missing))
+
+    words = Vocabulary(args.vocab).words if args.vocab else vocab.words
+    export_embeddings(model, retrieval, vocab, words, args.dest,
+                      batch_size=args.batch_size, num_workers=args.workers,
+                      resume=args.resume)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Exports a trained NLISimple model for the NumPy inference.
+
+The resulting .npz file is loaded by dictlearn.nli_numpy.NumpyNLISimple,
+which needs neither Theano nor Blocks. The models that use definitions
+need a table of precomputed definition embeddings, see
+bin/precompute_def_embeddings.py.
+
+Call as:
+python bin/export_nli_numpy.py $CONFIG $RUN/best_main.tar model.npz \
+    --def-table def_embeddings.npy
+"""
+import logging
+import argparse
+
+import numpy
+
+from dictlearn.embedding_export import initialize_model
+from dictlearn.theano_util import (
+    load_brick_parameters, load_population_statistics)
+
+logger = logging.getLogger()
+
+
+def main():
+    logging.basicConfig(
+        level='INFO',
+        format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
+
+    parser = argparse.ArgumentParser(
+        "Exports a trained NLISimple model for the NumPy inference")
+    parser.add_argument("config", help="The configuration, a name or a json file")
+    parser.add_argument("tar_path", help="The tar file with parameters")
+    parser.add_argument("dest", help="Destination .npz file")
+    parser.add_argument("--def-table",
+                        help="Precomputed definition embeddings, see bin/precompute_def_embeddings.py")
+    args = parser.parse_args()
+
+    model, _, _ = initialize_model('nli_simple', args.config)
+    missing = load_brick_parameters(model, args.tar_path)
+    missing += load_population_statistics(model, args.tar_path)
+    if missing:
+        logger.info("Parameters not in the checkpoint: {}".format(missing))
+
+    def_table = numpy.load(args.def_table) if args.def_table else None
+    model.export_numpy(args.dest, def_table=def_table)
+    logger.info("Saved to " + args.dest)
+
+
+if __name__ == "__main__":
+    main()
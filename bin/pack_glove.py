@@ -1,13 +1,142 @@
 #!/usr/bin/env python
+"""Converts GloVe embeddings to a float32 numpy array.
 
+The GloVe text file is streamed and only the lines of the words that
+are actually needed are parsed. The vectors are written directly into
+a memory-mapped .npy file, so that even the largest GloVe files can be
+packed with little memory.
+
+"""
 import argparse
 import logging
+from collections import defaultdict
+
 import numpy
 
-from os import path
 from dictlearn.vocab import Vocabulary
 from dictlearn.retrieval import Dictionary
 
+logger = logging.getLogger()
+
+# Priorities of the ways to find a vector for a vocabulary word,
+# the lower the better
+EXACT, LOWERCASE, LEMMA = range(3)
+NOT_FOUND = len([EXACT, LOWERCASE, LEMMA])
+
+
+def read_dim(path):
+    with open(path) as src:
+        return len(src.readline().rstrip().split(' ')) - 1
+
+
+def parse_vector(line, dim):
+    # Some of the GloVe words contain spaces, that's why the vector
+    # is always taken from the end of the line.
+    return numpy.array(line.rstrip().rsplit(' ', dim)[1:], dtype='float32')
+
+
+def build_candidates(vocab, dict_, try_lowercase, try_lemma):
+    """Maps GloVe words to the vocabulary words that can use them.
+
+    Returns a dictionary from utf-8 encoded GloVe words to lists of
+    `(word_id, priority)` pairs.
+
+    """
+    if try_lemma:
+        import nltk
+        lemmatizer = nltk.WordNetLemmatizer()
+
+    candidates = defaultdict(list)
+    for word_id, word in enumerate(vocab.words):
+        if dict_ and not dict_.get_definitions(word):
+            continue
+        keys = [(word, EXACT)]
+        if try_lowercase:
+            keys.append((word.lower(), LOWERCASE))
+        if try_lemma:
+            for part_of_speech in ['a', 's', 'r', 'n', 'v']:
+                try:
+                    keys.append((lemmatizer.lemmatize(word, part_of_speech), LEMMA))
+                except Exception:
+                    logger.error(u"lemmatizer crashed on {}".format(word))
+        seen = set()
+        for key, priority in keys:
+            if key in seen:
+                continue
+            seen.add(key)
+            candidates[key.encode('utf-8')].append((word_id, priority))
+    return candidates
+
+
+def report_coverage(vocab, found, lines_read):
+    freqs = numpy.array(vocab.frequencies, dtype='float64')
+    covered = found < NOT_FOUND
+    logger.info("{} lines read, {} of {} words covered ({:.2f}% of occurences)".format(
+        lines_read, covered.sum(), vocab.size(),
+        100 * freqs[covered].sum() / max(freqs.sum(), 1.)))
+    for priority, name in [(LOWERCASE, 'lowercase'), (LEMMA, 'lemma')]:
+        if (found == priority).any():
+            logger.info("{} words covered through {}".format(
+                (found == priority).sum(), name))
+
+
+def pack_with_vocab(args):
+    vocab = Vocabulary(args.vocab)
+    dict_ = Dictionary(args.dict) if args.dict else None
+    candidates = build_candidates(vocab, dict_, args.try_lowercase, args.try_lemma)
+    dim = read_dim(args.txt)
+
+    # words not found in GloVe will be all-zeros
+    embeddings = numpy.lib.format.open_memmap(
+        args.npy, mode='w+', dtype='float32', shape=(vocab.size(), dim))
+    found = numpy.full((vocab.size(),), NOT_FOUND, dtype='int64')
+
+    logger.info("Reading GloVe file")
+    lines_read = 0
+    with open(args.txt) as src:
+        for line in src:
+            lines_read += 1
+            if lines_read % args.report_every == 0:
+                report_coverage(vocab, found, lines_read)
+            wanted = candidates.get(line[:line.find(' ')])
+            if not wanted:
+                continue
+            wanted = [(word_id, priority) for word_id, priority in wanted
+                      if priority < found[word_id]]
+            if not wanted:
+                continue
+            vector = parse_vector(line, dim)
+            for word_id, priority in wanted:
+                embeddings[word_id] = vector
+                found[word_id] = priority
+    embeddings.flush()
+    report_coverage(vocab, found, lines_read)
+
+    for word_id in numpy.where(found == NOT_FOUND)[0]:
+        word = vocab.id_to_word(word_id)
+        if dict_ and not dict_.get_definitions(word):
+            logger.debug(u'Missing from dict: {}'.format(word))
+        else:
+            logger.debug(u'Missing from GloVe: {}'.format(word))
+
+
+def pack_all(args):
+    dim = read_dim(args.txt)
+    with open(args.txt) as src:
+        num_lines = sum(1 for _ in src)
+    num_special = len(Vocabulary.SPECIAL_TOKEN_MAP)
+
+    embeddings = numpy.lib.format.open_memmap(
+        args.npy, mode='w+', dtype='float32', shape=(num_special + num_lines, dim))
+    embeddings[:num_special] = 0.
+    with open(args.txt) as src:
+        for i, line in enumerate(src):
+            embeddings[num_special + i] = parse_vector(line, dim)
+            if i and i % args.report_every == 0:
+                logger.info("{} of {} lines packed".format(i, num_lines))
+    embeddings.flush()
+
+
 def main():
     logging.basicConfig(
         level='INFO',
@@ -18,72 +147,28 @@ def main():
     parser.add_argument("npy", help="Destination for npy format")
     parser.add_argument("--vocab", default="", help="Performs subsetting based on passed vocab")
     parser.add_argument("--dict", default="", help="Performs subsetting based on passed dict")
+    parser.add_argument("--report-every", type=int, default=100000,
+                        help="Report coverage every that many lines")
 
     # OOV handling
     parser.add_argument("--try-lemma", action="store_true", help="Try lemma")
-    parser.add_argument("--try-lowercase", default="", help="Try lowercase")
+    parser.add_argument("--try-lowercase", action="store_true", help="Try lowercase")
 
     args = parser.parse_args()
 
-    if args.dict and not args.vocab: 
+    if not args.npy.endswith('.npy'):
+        # that's what numpy.save would do
+        args.npy += '.npy'
+    if args.dict and not args.vocab:
         # usually you'd want to use both, I suppose
         raise NotImplementedError("Not implemented")
-    if args.try_lemma or args.try_lowercase:
-        # TODO(kudkudak): Implement
-        raise NotImplementedError("Not implemented yet")
+    if (args.try_lemma or args.try_lowercase) and not args.vocab:
+        raise ValueError("OOV handling only makes sense with --vocab")
 
     if args.vocab == "":
-        embeddings = []
-        dim = None
-        with open(args.txt) as src:
-            for i, line in enumerate(src):
-                tokens = line.strip().split()
-                features = map(float, tokens[1:])
-                dim = len(features)
-                embeddings.append(features)
-                if i and i % 100000 == 0:
-                    print i
-        embeddings = [[0.] * dim] * len(Vocabulary.SPECIAL_TOKEN_MAP) + embeddings
-        numpy.save(args.npy, embeddings)
+        pack_all(args)
     else:
-        vocab = Vocabulary(args.vocab)
-        if args.dict:
-            dict_ = Dictionary(args.dict)
-            
-        print('Computing GloVe')
-
-        # Loading
-        embeddings_index = {}
-        f = open(args.txt)
-        print('Reading GloVe file')
-        for line in f:
-            values = line.split(' ')
-            word = values[0]
-            dim = len(values[1:])
-            coefs = numpy.asarray(values[1:], dtype='float32')
-            embeddings_index[word] = coefs
-        f.close()
-
-        # Embedding matrix
-        print('Reading GloVe file')
-        embedding_matrix = numpy.zeros((vocab.size(), dim))
-        for word in vocab._word_to_id:
-            embedding_vector = embeddings_index.get(word)
-            in_glove = embedding_vector is not None
-            if args.dict:
-                in_dict = len(dict_.get_definitions(word)) > 0
-
-            if in_glove and (not args.dict or in_dict):
-                # words not found in embedding index will be all-zeros.
-                embedding_matrix[vocab.word_to_id(word)] = embedding_vector
-            else:
-                if not in_glove:
-                    print(u'Missing from GloVe: {}'.format(word))
-                else:
-                    print(u'Missing from dict: {}'.format(word))
-
-
-        numpy.save(args.npy, embedding_matrix)
+        pack_with_vocab(args)
 
 if __name__ == "__main__":
     main()
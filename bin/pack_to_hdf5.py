@@ -20,6 +20,8 @@ def main():
                         help="What kind of data should be converted")
     parser.add_argument("--lowercase", action="store_true")
     parser.add_argument("--relaxed-span", action="store_true", default=False)
+    parser.add_argument("--num-corenlp", type=int, default=1,
+                        help="Number of CoreNLP servers to tokenize SQuAD with in parallel")
     parser.add_argument("data", help="The data to convert")
     parser.add_argument("h5", help="Destination")
     args = parser.parse_args()
@@ -31,14 +33,19 @@ def main():
     elif args.type == 'squad':
         if args.lowercase:
             raise NotImplementedError() # Just to be safe
-        port = get_free_port()
+        servers = []
         try:
-            corenlp = start_corenlp(port)
-            squad_to_h5py_dataset(args.data, args.h5, "http://localhost:{}".format(port),
+            urls = []
+            for _ in range(args.num_corenlp):
+                port = get_free_port()
+                servers.append(start_corenlp(port))
+                urls.append("http://localhost:{}".format(port))
+            squad_to_h5py_dataset(args.data, args.h5, urls,
                                   not args.relaxed_span)
         finally:
-            if corenlp and corenlp.returncode is None:
-                corenlp.kill()
+            for corenlp in servers:
+                if corenlp.returncode is None:
+                    corenlp.kill()
     elif args.type == 'snli':
         snli_to_h5py_dataset(args.data, args.h5, lowercase=args.lowercase)
     else:
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Precomputes the definition embeddings of a trained model.
+
+The resulting table can be passed to the NLI evaluation with --def-table,
+in which case the definitions are not retrieved and read any more.
+
+"""
+import logging
+import argparse
+
+import numpy
+
+from dictlearn.def_embeddings import (
+    precompute_def_embeddings, check_def_embeddings)
+from dictlearn.embedding_export import initialize_model
+from dictlearn.theano_util import load_brick_parameters
+
+logger = logging.getLogger()
+
+
+def initialize(model_type, config):
+    """Returns the model, the retrieval and the vocabulary."""
+    model, retrieval, vocab = initialize_model(model_type, config)
+    if retrieval is None:
+        raise ValueError("the model does not use definitions")
+    return model, retrieval, vocab
+
+
+def main():
+    logging.basicConfig(
+        level='INFO',
+        format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
+
+    parser = argparse.ArgumentParser(
+        "Precomputes the definition embeddings of a trained model")
+    parser.add_argument("model", choices=['lm', 'qa', 'nli_simple', 'nli_esim'])
+    parser.add_argument("config", help="The configuration, a name or a json file")
+    parser.add_argument("tar_path", help="The tar file with parameters")
+    parser.add_argument("dest", help="Destination .npy file")
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--check-sentences", type=int, default=32,
+                        help="Compare with the full definition path"
+                             " on that many random sentences")
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    model, retrieval, vocab = initialize(args.model, args.config)
+    missing = load_brick_parameters(model, args.tar_path)
+    if missing:
+        logger.info("Parameters not in the checkpoint: {}".format(missing))
+
+    table = precompute_def_embeddings(
+        model, retrieval, vocab, args.dest, batch_size=args.batch_size)
+
+    if args.check_sentences:
+        rng = numpy.random.RandomState(1)
+        sentences = [[vocab.id_to_word(id_) for id_ in rng.randint(vocab.size(), size=10)]
+                     for _ in range(args.check_sentences)]
+        error = check_def_embeddings(model, retrieval, vocab, table, sentences)
+        logger.info("Largest difference from the full path: {}".format(error))
+        if error > args.tolerance:
+            raise ValueError("the precomputed embeddings do not match the model")
+
+
+if __name__ == "__main__":
+    main()
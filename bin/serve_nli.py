@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Serves the predictions of a trained NLI model over HTTP.
+
+The concurrent requests are scored in micro-batches, see
+dictlearn/nli_server.py for the protocol.
+
+Call as:
+python bin/serve_nli.py simple $RUN/config.json $RUN/best_main.tar \
+    --port 8000 --max-batch-size 64 --max-wait-ms 10
+
+curl -d '{"pairs": [["A man is sleeping.", "A person rests."]]}' \
+    localhost:8000/predict
+curl localhost:8000/metrics
+"""
+import logging
+import argparse
+
+from dictlearn.nli_server import load_predictor, MicroBatcher, make_server
+
+logger = logging.getLogger()
+
+
+def main():
+    logging.basicConfig(
+        level='INFO',
+        format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
+
+    parser = argparse.ArgumentParser(
+        "Serves the predictions of a trained NLI model over HTTP")
+    parser.add_argument("model", choices=["simple", "esim"])
+    parser.add_argument("config", help="The json configuration of the run")
+    parser.add_argument("tar_path", help="The tar file with parameters")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--socket",
+                        help="Listen on this Unix socket instead of a port")
+    parser.add_argument("--max-batch-size", type=int, default=32,
+                        help="The maximum number of pairs scored at once")
+    parser.add_argument("--max-wait-ms", type=float, default=10.,
+                        help="The maximum time a pair waits for a batch to fill")
+    parser.add_argument("--timeout", type=float, default=30.,
+                        help="The time in seconds after which a request fails")
+    parser.add_argument("--def-table",
+                        help="Precomputed definition embeddings, see bin/precompute_def_embeddings.py")
+    parser.add_argument("--lowercase", action="store_true",
+                        help="Lowercase the sentences")
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.def_table:
+        kwargs['def_table_path'] = args.def_table
+    predictor = load_predictor(args.model, args.config, args.tar_path,
+                               lowercase=args.lowercase, **kwargs)
+    batcher = MicroBatcher(predictor, max_batch_size=args.max_batch_size,
+                           max_wait=args.max_wait_ms / 1000.).start()
+    server = make_server(batcher, args.socket or (args.host, args.port),
+                         timeout=args.timeout)
+    logger.info("Serving on {}".format(args.socket or "{}:{}".format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+
+
+if __name__ == "__main__":
+    main()
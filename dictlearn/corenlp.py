@@ -7,6 +7,7 @@ at the time.
 """
 import time
 import json
+import bisect
 import requests
 import subprocess
 
@@ -20,10 +21,20 @@ def start_corenlp(port):
     return popen
 
 
+def _java_length(str_):
+    """The length of a string in UTF-16 code units.
+
+    CoreNLP reports character offsets in these units.
+
+    """
+    return len(str_.encode('utf-16-le')) // 2
+
+
 class StanfordCoreNLP(object):
 
     def __init__(self, server_url):
         self.server_url = server_url
+        self._server_checked = False
 
     def annotate(self, text, properties=None):
         assert isinstance(text, unicode)
@@ -33,12 +44,14 @@ class StanfordCoreNLP(object):
             assert isinstance(properties, dict)
 
         # Checks that the Stanford CoreNLP server is started.
-        try:
-            requests.get(self.server_url)
-        except requests.exceptions.ConnectionError:
-            raise Exception('Check whether you have started the CoreNLP server e.g.\n'
-            '$ cd stanford-corenlp-full-2015-12-09/ \n'
-            '$ java -mx4g -cp "*" edu.stanford.nlp.pipeline.StanfordCoreNLPServer')
+        if not self._server_checked:
+            try:
+                requests.get(self.server_url)
+            except requests.exceptions.ConnectionError:
+                raise Exception('Check whether you have started the CoreNLP server e.g.\n'
+                '$ cd stanford-corenlp-full-2015-12-09/ \n'
+                '$ java -mx4g -cp "*" edu.stanford.nlp.pipeline.StanfordCoreNLPServer')
+            self._server_checked = True
 
         r = requests.post(
             self.server_url, params={
@@ -53,15 +66,47 @@ class StanfordCoreNLP(object):
                 pass
         return output
 
-
-    def tokenize(self, str_):
+    def _tokenize(self, str_):
         annotations = json.loads(
             self.annotate(str_,
                                 properties={'annotators': 'tokenize,ssplit'}))
         tokens = []
         positions = []
+        ends = []
         for sentence in annotations['sentences']:
             for token in sentence['tokens']:
                 tokens.append(token['originalText'])
                 positions.append(token['characterOffsetBegin'])
+                ends.append(token['characterOffsetEnd'])
+        return tokens, positions, ends
+
+    def tokenize(self, str_):
+        tokens, positions, _ = self._tokenize(str_)
         return tokens, positions
+
+    def tokenize_many(self, strs, separator=u"\n\n"):
+        """Tokenizes several strings with a single request.
+
+        Returns a list of `(tokens, positions)` pairs, the same that
+        `tokenize` would return for each of the strings. If a token
+        happens to cross the boundary between two strings, falls back
+        to tokenizing them one by one.
+
+        """
+        begins = []
+        total = 0
+        for str_ in strs:
+            begins.append(total)
+            total += _java_length(str_) + _java_length(separator)
+        tokens, positions, ends = self._tokenize(separator.join(strs))
+
+        results = []
+        for str_, begin in zip(strs, begins):
+            end = begin + _java_length(str_)
+            first = bisect.bisect_left(positions, begin)
+            last = bisect.bisect_left(positions, end)
+            if last > first and ends[last - 1] > end:
+                return [self.tokenize(str_) for str_ in strs]
+            results.append((tokens[first:last],
+                            [position - begin for position in positions[first:last]]))
+        return results
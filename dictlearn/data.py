@@ -11,6 +11,9 @@ Currently the following layouts are supported:
     HDF5 file "train.h5". The training data is read randomly
     by taking random spans.
 
+For both layouts the language modelling data can also be read
+statefully, see `StatefulSpanScheme`.
+
 TODO: Unit test SNLI data
 """
 
@@ -31,7 +34,8 @@ from fuel.streams import DataStream
 from fuel.datasets import H5PYDataset
 
 from dictlearn.vocab import Vocabulary
-from dictlearn.datasets import TextDataset, SQuADDataset, PutTextTransfomer
+from dictlearn.datasets import (
+    TextDataset, TokenDataset, SQuADDataset, PutTextTransfomer)
 from dictlearn.util import str2vec
 
 # We have to pad all the words to contain the same
@@ -95,6 +99,56 @@ class RandomSpanScheme(IterationScheme):
         return slice(start, start + self._span_size)
 
 
+class StatefulSpanScheme(IterationScheme):
+    """Contiguous spans for truncated backpropagation through time.
+
+    The data is split into `num_streams` contiguous segments, each of
+    them is read by its own cursor. The requests of the different
+    segments are interleaved, so that when they are batched by
+    `num_streams` the i-th sequence of a batch always continues the i-th
+    sequence of the previous batch. An epoch ends when the segments are
+    exhausted, the remainders of the segments are dropped.
+
+    Consecutive spans of a segment share one token: the first token of
+    a sequence is not predicted, hence the last token of a span is also
+    the first one of the next span.
+
+    """
+    requests_examples = True
+
+    def __init__(self, dataset_size, num_streams, span_size):
+        self._num_streams = num_streams
+        self._span_size = span_size
+        self._segment_size = dataset_size // num_streams
+        if self._segment_size <= span_size:
+            raise ValueError("not enough data for {} streams".format(num_streams))
+
+    def get_request_iterator(self):
+        return _StatefulSpanIterator(
+            self._num_streams, self._span_size, self._segment_size)
+
+
+class _StatefulSpanIterator(object):
+    """A picklable iterator over the requests of `StatefulSpanScheme`."""
+    def __init__(self, num_streams, span_size, segment_size):
+        self._num_streams = num_streams
+        self._span_size = span_size
+        self._segment_size = segment_size
+        self._num_spans = (segment_size - 1) // span_size
+        self._position = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        span, stream = divmod(self._position, self._num_streams)
+        if span >= self._num_spans:
+            raise StopIteration
+        self._position += 1
+        start = stream * self._segment_size + span * self._span_size
+        return slice(start, start + self._span_size + 1)
+
+
 class Data(object):
     """Builds the data stream for different parts of the data.
 
@@ -163,6 +217,42 @@ class Data(object):
 
 class LanguageModellingData(Data):
 
+    def get_token_dataset(self, part):
+        """The data of a part as a single sequence of tokens.
+
+        The text files are digitized once and memory-mapped, see
+        `TokenDataset`.
+
+        """
+        key = (part, 'tokens')
+        if not key in self._dataset_cache:
+            if self._layout == 'lambada' and part == 'train':
+                self._dataset_cache[key] = self.get_dataset(part)
+            else:
+                self._dataset_cache[key] = TokenDataset(
+                    self.get_dataset_path(part))
+        return self._dataset_cache[key]
+
+    def get_stateful_stream(self, part, batch_size, max_length):
+        """Contiguous batches for truncated backpropagation through time.
+
+        See `StatefulSpanScheme`. The sequences have `max_length + 1`
+        tokens and no BOS token is added.
+
+        """
+        dataset = self.get_token_dataset(part)
+        stream = DataStream(
+            dataset,
+            iteration_scheme=StatefulSpanScheme(
+                dataset.num_examples, batch_size, max_length))
+        stream = Mapping(stream, listify)
+        stream = SourcewiseMapping(stream, vectorize)
+        stream = Batch(
+            stream,
+            iteration_scheme=ConstantScheme(batch_size))
+        stream = Padding(stream)
+        return stream
+
     def get_stream(self, part, batch_size=None, max_length=None, seed=None):
         dataset = self.get_dataset(part, max_length)
         if self._layout == 'lambada' and part == 'train':
@@ -10,12 +10,17 @@ suitable:
 That said, we need a different basic solution.
 
 """
+import os
+import logging
 
+import numpy
 from fuel.datasets import Dataset
 from fuel.datasets.hdf5 import H5PYDataset
 from fuel.utils import do_not_pickle_attributes
 from fuel.transformers import Transformer
 
+logger = logging.getLogger(__name__)
+
 
 class PicklableFile(object):
     """
@@ -83,6 +88,83 @@ class TextDataset(Dataset):
         return (next(state).strip().split()[:self._max_length],)
 
 
+def digitize_tokens(path):
+    """Digitizes the tokens of a text file once.
+
+    The ids of the tokens are saved as an int32 array in
+    `<path>.tokens.npy`, and the distinct tokens, in the order of their
+    ids, one per line in `<path>.types.txt`. The files are built again
+    if the text file is newer.
+
+    Returns
+    -------
+    The paths of the two files.
+
+    """
+    tokens_path = path + '.tokens.npy'
+    types_path = path + '.types.txt'
+    if (os.path.exists(tokens_path) and os.path.exists(types_path)
+            and os.path.getmtime(tokens_path) >= os.path.getmtime(path)):
+        return tokens_path, types_path
+
+    logger.info("Digitizing the tokens of " + path)
+    type_ids = {}
+    num_tokens = 0
+    with open(path) as src:
+        for line in src:
+            for token in line.split():
+                type_ids.setdefault(token, len(type_ids))
+                num_tokens += 1
+    # written under temporary names, several jobs can share the data
+    temp_suffix = '.{}.tmp'.format(os.getpid())
+    tokens = numpy.lib.format.open_memmap(
+        tokens_path + temp_suffix, mode='w+', dtype='int32', shape=(num_tokens,))
+    position = 0
+    with open(path) as src:
+        for line in src:
+            ids = [type_ids[token] for token in line.split()]
+            tokens[position:position + len(ids)] = ids
+            position += len(ids)
+    tokens.flush()
+    del tokens
+    types = sorted(type_ids, key=type_ids.get)
+    with open(types_path + temp_suffix, 'w') as dst:
+        for type_ in types:
+            dst.write(type_ + '\n')
+    os.rename(types_path + temp_suffix, types_path)
+    os.rename(tokens_path + temp_suffix, tokens_path)
+    logger.info("{} tokens of {} types".format(num_tokens, len(types)))
+    return tokens_path, types_path
+
+
+@do_not_pickle_attributes('tokens', 'types')
+class TokenDataset(Dataset):
+    """The tokens of a text file as a single sequence.
+
+    Only the ids of the tokens are kept, memory-mapped, see
+    `digitize_tokens`. A request is a slice or a list of positions, the
+    tokens are looked up for the requested positions only.
+
+    """
+    provides_sources = ('words',)
+    example_iteration_scheme = None
+
+    def __init__(self, path, **kwargs):
+        self._tokens_path, self._types_path = digitize_tokens(path)
+        super(TokenDataset, self).__init__(**kwargs)
+        self.load()
+        self.num_examples = len(self.tokens)
+
+    def load(self):
+        self.tokens = numpy.load(self._tokens_path, mmap_mode='r')
+        with open(self._types_path) as src:
+            self.types = numpy.array([line.rstrip('\n') for line in src],
+                                     dtype=object)
+
+    def get_data(self, state=None, request=None):
+        return (self.types[self.tokens[request]],)
+
+
 class PutTextTransfomer(Transformer):
 
     def __init__(self, data_stream, dataset, raw_text=False, **kwargs):
@@ -0,0 +1,149 @@
+"""Precomputed definition embeddings.
+
+Once a model is trained, the definition embedding of a word, i.e. the
+output of the definition reader aggregated by the combiner, only depends
+on the word itself, provided the retrieval is deterministic. It can then
+be computed once for the whole vocabulary and looked up at evaluation
+time instead of retrieving and reading the definitions in every batch.
+
+The table is indexed by word ids, so it is exact for the models that
+retrieve definitions by word id (NLI). When the definitions are retrieved
+from raw text, out-of-vocabulary words get the definitions of the UNK
+token instead of their own.
+
+"""
+import logging
+
+import numpy
+import theano
+from theano import tensor
+
+logger = logging.getLogger(__name__)
+
+
+def _reader_and_combiner(model):
+    combiner = getattr(model, '_combiner', None)
+    if combiner is None:
+        # ESIM
+        combiner = model._def_combiner
+    return model._def_reader, combiner
+
+
+def definitions_are_deterministic(retrieval, words):
+    """Checks that `retrieval` never samples definitions for `words`."""
+    if retrieval._with_too_many_defs != 'random':
+        return True
+    return all(len(retrieval._dictionary.get_definitions(word))
+               <= retrieval._max_def_per_word
+               for word in words)
+
+
+def build_def_embedder(model):
+    """Compiles the definition path of a model.
+
+    Returns a function of `(defs, def_mask, def_map, seq_len)` that
+    returns the flat positions of the words that have definitions
+    and their definition embeddings.
+
+    Parameters
+    ----------
+    model : Brick
+        A `LanguageModel`, `NLISimple`, `ESIM` or `ExtractiveQAModel`
+        that uses definitions.
+
+    """
+    def_reader, combiner = _reader_and_combiner(model)
+    defs = tensor.lmatrix('defs')
+    def_mask = tensor.matrix('def_mask')
+    def_map = tensor.lmatrix('def_map')
+    seq_len = tensor.lscalar('seq_len')
+    def_embs = def_reader.apply(defs, def_mask, auxiliary=set())
+    positions, def_means = combiner.aggregate(
+        def_embs, def_map[:, 0] * seq_len + def_map[:, 1], def_map[:, 2])
+    return theano.function([defs, def_mask, def_map, seq_len],
+                           [positions, def_means], on_unused_input='ignore')
+
+
+def precompute_def_embeddings(model, retrieval, vocab, dest, batch_size=1024):
+    """Computes the definition embeddings of all the words of a vocabulary.
+
+    The embeddings are written into a float32 `.npy` file at `dest`, one
+    row per vocabulary entry. The words without definitions get all-zero
+    rows, which is exactly what the combiner uses for them.
+
+    Parameters
+    ----------
+    model : Brick
+        The trained model, see `build_def_embedder`.
+    retrieval : Retrieval
+        The retrieval the model was trained with.
+    vocab : Vocabulary
+        The vocabulary that is used to index the table, typically the
+        text vocabulary of the retrieval.
+
+    """
+    if not definitions_are_deterministic(retrieval, vocab.words):
+        raise ValueError("the retrieval samples definitions at random,"
+                         " they can not be precomputed")
+    embedder = build_def_embedder(model)
+
+    table = None
+    num_words_with_defs = 0
+    for start in range(0, vocab.size(), batch_size):
+        words = vocab.words[start:start + batch_size]
+        defs, def_mask, def_map = retrieval.retrieve_and_pad(
+            [[word] for word in words])
+        if not len(def_map):
+            continue
+        positions, def_means = embedder(defs, def_mask, def_map, 1)
+        if table is None:
+            table = numpy.lib.format.open_memmap(
+                dest, mode='w+', dtype='float32',
+                shape=(vocab.size(), def_means.shape[1]))
+        table[start + positions] = def_means
+        num_words_with_defs += len(positions)
+        logger.debug("{} of {} words done".format(start + len(words), vocab.size()))
+    if table is None:
+        raise ValueError("no word of the vocabulary has definitions")
+    table.flush()
+    logger.info("Definition embeddings of {} of {} words saved to {}".format(
+        num_words_with_defs, vocab.size(), dest))
+    return table
+
+
+def check_def_embeddings(model, retrieval, vocab, table, sentences):
+    """Compares a precomputed table with the full definition path.
+
+    The definition embeddings of `sentences` are computed by retrieving
+    and reading the definitions of all their words in one batch, just
+    like during training.
+
+    Parameters
+    ----------
+    sentences : list of lists of str
+        A batch of tokenized sentences.
+
+    Returns
+    -------
+    The largest absolute difference between the two.
+
+    """
+    seq_len = max(map(len, sentences))
+    padded = [sentence + [''] * (seq_len - len(sentence)) for sentence in sentences]
+    word_ids = numpy.array([[vocab.word_to_id(word) for word in sentence]
+                            for sentence in padded])
+    is_word = numpy.array([[bool(word) for word in sentence] for sentence in padded])
+    # The table is indexed by word ids, so out-of-vocabulary words
+    # are looked up as the UNK token
+    padded = [[vocab.id_to_word(id_) if word else ''
+               for id_, word in zip(ids, sentence)]
+              for ids, sentence in zip(word_ids, padded)]
+
+    defs, def_mask, def_map = retrieval.retrieve_and_pad(padded)
+    full = numpy.zeros((word_ids.size, table.shape[1]), dtype='float32')
+    if len(def_map):
+        positions, def_means = build_def_embedder(model)(
+            defs, def_mask, def_map, seq_len)
+        full[positions] = def_means
+    precomputed = numpy.asarray(table)[word_ids.flatten()]
+    return numpy.abs(full - precomputed)[is_word.flatten()].max()
@@ -0,0 +1,215 @@
+"""Export of the word and definition embeddings of a trained model.
+
+The embeddings of a whole vocabulary are written as float32 `.npy`
+matrices, which can be memory-mapped with `numpy.load(path, mmap_mode='r')`
+without Theano, together with `words.txt`, the word of every row.
+
+- `word_embeddings.npy` are the rows of the input lookup table, the
+  words beyond `num_input_words` get the embedding of UNK, like in the
+  models.
+- `def_embeddings.npy` are the definition embeddings, see
+  `dictlearn.def_embeddings`. The words without definitions get
+  all-zero rows.
+
+The progress is saved after every batch, so that an interrupted export
+can be resumed.
+
+"""
+import os
+import json
+import logging
+import multiprocessing
+
+import numpy
+import fuel
+from six import text_type
+
+from dictlearn.def_embeddings import (
+    build_def_embedder, definitions_are_deterministic)
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_FILE = 'progress.json'
+
+# The retrieval used by the worker processes, they get it when they are
+# forked so that the dictionary is not pickled
+_retrieval = None
+
+
+def _load_config(registry, config):
+    if config.endswith('json'):
+        with open(config) as src:
+            c = json.load(src)
+    else:
+        c = registry[config]
+    return c
+
+
+def initialize_model(model_type, config):
+    """Returns the model, the retrieval and the vocabulary.
+
+    The retrieval is `None` if the model does not use definitions.
+
+    """
+    if model_type == 'lm':
+        from dictlearn.obw_configs import lm_config_registry
+        from dictlearn.language_model_training import initialize_data_and_model
+        data, model, retrieval = initialize_data_and_model(
+            _load_config(lm_config_registry, config))
+    elif model_type == 'qa':
+        from dictlearn.extractive_qa_configs import qa_config_registry
+        from dictlearn.extractive_qa_training import initialize_data_and_model
+        data, model = initialize_data_and_model(
+            _load_config(qa_config_registry, config))
+        retrieval = data._retrieval
+    elif model_type in ['nli_simple', 'nli_esim']:
+        from dictlearn.nli_simple_config_registry import snli_config_registry
+        from dictlearn.nli_esim_config_registry import nli_esim_config_registry
+        from dictlearn import nli_training
+        if model_type == 'nli_simple':
+            registry = snli_config_registry
+            init = nli_training._initialize_simple_model_and_data
+        else:
+            registry = nli_esim_config_registry
+            init = nli_training._initialize_esim_model_and_data
+        c = _load_config(registry, config)
+        for path in ['dict_path', 'embedding_def_path', 'embedding_path', 'vocab', 'vocab_def', 'vocab_text']:
+            if c.get(path, '') and not os.path.isabs(c[path]):
+                c[path] = os.path.join(fuel.config.data_path[0], c[path])
+        model, data, _, retrieval, _ = init(c)
+    else:
+        raise ValueError("unknown model type: " + model_type)
+    return model, retrieval, data.vocab
+
+
+def _word_lookup(model):
+    # the language model has several lookups
+    lookup = getattr(model, '_main_lookup', None)
+    if lookup is None:
+        lookup = getattr(model, '_lookup', None)
+    return lookup
+
+
+def _retrieve(batch):
+    start, words = batch
+    return start, _retrieval.retrieve_and_pad([[word] for word in words])
+
+
+def _open_matrix(path, shape, resume):
+    if resume and os.path.exists(path):
+        matrix = numpy.load(path, mmap_mode='r+')
+        if matrix.shape != shape:
+            raise ValueError("{} has shape {} instead of {}".format(
+                path, matrix.shape, shape))
+        return matrix
+    return numpy.lib.format.open_memmap(
+        path, mode='w+', dtype='float32', shape=shape)
+
+
+def _save_progress(dest, progress):
+    path = os.path.join(dest, PROGRESS_FILE)
+    with open(path + '.tmp', 'w') as dst:
+        json.dump(progress, dst)
+    os.rename(path + '.tmp', path)
+
+
+def export_embeddings(model, retrieval, model_vocab, words, dest,
+                      batch_size=4096, num_workers=1, resume=False):
+    """Writes the embeddings of `words` to the directory `dest`.
+
+    Parameters
+    ----------
+    model : Brick
+        The trained model.
+    retrieval : Retrieval
+        The retrieval the model was trained with, `None` to export only
+        the word embeddings.
+    model_vocab : Vocabulary
+        The vocabulary of the model, which gives the ids of the words.
+    words : list of str
+        The words to export, e.g. all the words of another vocabulary.
+    batch_size : int
+        The number of words whose definitions are read at once.
+    num_workers : int
+        The number of processes that retrieve the definitions.
+    resume : bool
+        Continue an interrupted export into `dest`.
+
+    """
+    if not os.path.exists(dest):
+        os.makedirs(dest)
+    progress_path = os.path.join(dest, PROGRESS_FILE)
+    progress = {'num_words': len(words), 'done': 0}
+    if resume and os.path.exists(progress_path):
+        with open(progress_path) as src:
+            progress = json.load(src)
+        if progress['num_words'] != len(words):
+            raise ValueError("{} is an export of a different vocabulary".format(dest))
+        logger.info("Resuming after {} words".format(progress['done']))
+    else:
+        resume = False
+        with open(os.path.join(dest, 'words.txt'), 'w') as dst:
+            for word in words:
+                if isinstance(word, text_type):
+                    word = word.encode('utf-8')
+                dst.write(word + '\n')
+
+    lookup = _word_lookup(model)
+    if lookup is not None:
+        table = lookup.parameters[0].get_value()
+        ids = model_vocab.words_to_ids(words)
+        ids[ids >= model._num_input_words] = model_vocab.unk
+        word_embeddings = _open_matrix(
+            os.path.join(dest, 'word_embeddings.npy'),
+            (len(words), table.shape[1]), resume)
+        for start in range(0, len(words), batch_size):
+            word_embeddings[start:start + batch_size] = table[ids[start:start + batch_size]]
+        word_embeddings.flush()
+        logger.info("Word embeddings saved")
+    else:
+        logger.info("The model has no word embeddings")
+
+    if retrieval is None:
+        _save_progress(dest, dict(progress, done=len(words)))
+        return
+    if not definitions_are_deterministic(retrieval, words):
+        logger.warning("The retrieval samples definitions at random for some words")
+
+    embedder = build_def_embedder(model)
+    def_embeddings = None
+    if progress.get('def_dim'):
+        def_embeddings = _open_matrix(
+            os.path.join(dest, 'def_embeddings.npy'),
+            (len(words), progress['def_dim']), resume)
+    batches = [(start, words[start:start + batch_size])
+               for start in range(progress['done'], len(words), batch_size)]
+
+    global _retrieval
+    _retrieval = retrieval
+    pool = None
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        retrieved = pool.imap(_retrieve, batches)
+    else:
+        retrieved = (_retrieve(batch) for batch in batches)
+    try:
+        for start, (defs, def_mask, def_map) in retrieved:
+            if len(def_map):
+                positions, def_means = embedder(defs, def_mask, def_map, 1)
+                if def_embeddings is None:
+                    progress['def_dim'] = def_means.shape[1]
+                    def_embeddings = _open_matrix(
+                        os.path.join(dest, 'def_embeddings.npy'),
+                        (len(words), progress['def_dim']), False)
+                def_embeddings[start + positions] = def_means
+                def_embeddings.flush()
+            progress['done'] = min(start + batch_size, len(words))
+            _save_progress(dest, progress)
+            logger.debug("{} of {} words done".format(progress['done'], len(words)))
+    finally:
+        if pool:
+            pool.terminate()
+        _retrieval = None
+    if def_embeddings is None:
+        logger.warning("No word has definitions")
+    logger.info("Embeddings of {} words saved to {}".format(len(words), dest))
@@ -0,0 +1,136 @@
+"""Read-only storage for pretrained embeddings.
+
+The embeddings are memory-mapped instead of being read into memory,
+so that all the jobs running on the same machine share the same pages
+of the OS file cache. Frozen embeddings can be passed to Theano without
+making a private copy.
+
+"""
+import hashlib
+import json
+import logging
+import os
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 2 ** 24
+REFERENCES_FILE = 'embeddings.json'
+
+
+class EmbeddingStore(object):
+    """A memory-mapped `.npy` embedding matrix.
+
+    Use `EmbeddingStore.get` rather than the constructor, so that
+    a process opens every file only once.
+
+    Parameters
+    ----------
+    path : str
+        The path to the `.npy` file.
+
+    """
+    _stores = {}
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._matrix = None
+        self._hash = None
+
+    @classmethod
+    def get(cls, path):
+        path = os.path.abspath(path)
+        if path not in cls._stores:
+            cls._stores[path] = cls(path)
+        return cls._stores[path]
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = numpy.load(self.path, mmap_mode='r')
+            logger.debug("Memory-mapped {} embeddings from {}".format(
+                self._matrix.shape, self.path))
+        return self._matrix
+
+    def as_dtype(self, dtype, frozen):
+        """Returns the matrix in a form suitable for a shared variable.
+
+        Parameters
+        ----------
+        dtype : str
+            The dtype of the shared variable.
+        frozen : bool
+            If ``True``, the matrix will never be modified, so the
+            memory map itself is returned when the dtype matches.
+            Otherwise a private writable copy is made.
+
+        """
+        if frozen and self.matrix.dtype == numpy.dtype(dtype):
+            return self.matrix
+        return numpy.array(self.matrix, dtype=dtype)
+
+    def hash(self):
+        if self._hash is None:
+            sha1 = hashlib.sha1()
+            with open(self.path, 'rb') as src:
+                for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b''):
+                    sha1.update(chunk)
+            self._hash = sha1.hexdigest()
+        return self._hash
+
+    def reference(self):
+        return {'path': self.path, 'hash': self.hash()}
+
+
+def save_references(save_path, paths):
+    """Saves references to the embedding stores used by a job.
+
+    Frozen embeddings are not stored in the checkpoints, so that the
+    checkpoints only have to remember where they came from.
+
+    Parameters
+    ----------
+    save_path : str
+        The directory of the job.
+    paths : dict
+        Maps config keys to embedding paths. Empty paths are skipped.
+
+    """
+    references = {key: EmbeddingStore.get(path).reference()
+                  for key, path in paths.items() if path}
+    with open(os.path.join(save_path, REFERENCES_FILE), 'w') as dst:
+        json.dump(references, dst, indent=2)
+
+
+def check_references(save_path, paths):
+    """Checks that a job is resumed with the same embeddings.
+
+    Raises
+    ------
+    ValueError
+        If a store was changed since the job was started.
+
+    """
+    references_path = os.path.join(save_path, REFERENCES_FILE)
+    if not os.path.exists(references_path):
+        logger.warning("No embedding references in {}".format(save_path))
+        return
+    with open(references_path) as src:
+        references = json.load(src)
+    for key, path in paths.items():
+        if not path or key not in references:
+            continue
+        store = EmbeddingStore.get(path)
+        if store.hash() != references[key]['hash']:
+            raise ValueError(
+                "{} was changed since the job was started: was {} ({}), now {} ({})"
+                .format(key, references[key]['path'], references[key]['hash'],
+                        store.path, store.hash()))
+
+
+def sync_references(save_path, paths, new_training_job):
+    if new_training_job:
+        save_references(save_path, paths)
+    else:
+        check_references(save_path, paths)
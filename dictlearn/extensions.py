@@ -13,9 +13,11 @@ try:
     import pandas as pd
 except ImportError:
     pass
-import scipy
+import scipy.stats
 import numpy
 import numpy as np
+import theano
+import fuel
 
 import ssl
 if hasattr(ssl, '_create_unverified_context'):
@@ -26,6 +28,7 @@ from collections import defaultdict
 from six import iteritems
 
 from blocks.extensions import SimpleExtension
+from blocks.graph import ComputationGraph
 from blocks.extensions.monitoring import MonitoringExtension
 from blocks.serialization import load, load_parameters
 from blocks.extensions.saveload import Load, Checkpoint
@@ -86,40 +89,6 @@ def construct_embedder(theano_fnc, vocab):
     return _embedder
 
 
-def evaluate_similarity(w, X, y, restrict_to_words=None):
-    """
-    Calculate Spearman correlation between cosine similarity of the model
-    and human rated similarity of word pairs
-
-    Parameters
-    ----------
-    w : Embedding or dict
-      Embedding or dict instance.
-
-    X: array, shape: (n_samples, 2)
-      Word pairs
-
-    y: vector, shape: (n_samples,)
-      Human ratings
-
-    Returns
-    -------
-    cor: float
-      Spearman correlation
-    """
-
-    from web.embedding import Embedding
-
-    if isinstance(w, dict):
-        w = Embedding.from_dict(w)
-
-    mean_vector = np.mean(w.vectors, axis=0, keepdims=True)
-    A = np.vstack(w.get(word, mean_vector) for word in X[:, 0])
-    B = np.vstack(w.get(word, mean_vector) for word in X[:, 1])
-    scores = np.array([v1.dot(v2.T) for v1, v2 in zip(A, B)])
-    return scipy.stats.spearmanr(scores, y).correlation
-
-
 class RetrievalPrintStats(SimpleExtension):
     """
     Prints statistics about Retrieval object
@@ -163,42 +132,89 @@ class RetrievalPrintStats(SimpleExtension):
                     numpy.random.choice(d['missed_word_sample'], 20, replace=False)))
             self.add_records(self.main_loop.log, record_tuples)
 
+# The word similarity benchmarks and the functions of
+# https://github.com/kudkudak/word-embeddings-benchmarks that fetch them
+SIMILARITY_TASKS = {
+    "MEN": "fetch_MEN",
+    "WS353": "fetch_WS353",
+    "SIMLEX999": "fetch_SimLex999",
+    "RW": "fetch_RW"
+}
+
+
+def default_similarity_cache_dir():
+    return os.path.join(fuel.config.data_path[0], 'similarity')
+
+
+def cache_similarity_tasks(cache_dir=None):
+    """Downloads the word similarity benchmarks to `cache_dir`.
+
+    Every task is saved as `<name>.npz` with the word pairs `X` and the
+    human ratings `y`.
+
+    """
+    try:
+        import web.datasets.similarity
+    except ImportError:
+        raise RuntimeError("Please install web (https://github.com/kudkudak/word-embeddings-benchmarks)")
+    cache_dir = cache_dir or default_similarity_cache_dir()
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    for name, fetch in iteritems(SIMILARITY_TASKS):
+        logger.info("Downloading " + name)
+        data = getattr(web.datasets.similarity, fetch)()
+        np.savez(os.path.join(cache_dir, name + '.npz'),
+                 X=np.array(data.X, dtype=np.unicode_),
+                 y=np.array(data.y, dtype='float64').reshape((-1,)))
+
+
+def load_similarity_tasks(cache_dir=None):
+    """Loads the word similarity benchmarks saved by `cache_similarity_tasks`."""
+    cache_dir = cache_dir or default_similarity_cache_dir()
+    tasks = {}
+    for name in SIMILARITY_TASKS:
+        path = os.path.join(cache_dir, name + '.npz')
+        if not os.path.exists(path):
+            raise IOError("{} not found, run bin/cache_similarity_tasks.py first".format(path))
+        with np.load(path) as data:
+            tasks[name] = (data['X'], data['y'])
+    return tasks
+
+
 class SimilarityWordEmbeddingEval(SimpleExtension):
     """
     Parameters
     ----------
 
-    embedder: function: word -> vector
+    embedder: function: words -> matrix of vectors
+    cache_dir: str
+        The directory with the benchmarks, see `cache_similarity_tasks`.
+    batch_size: int
+        The number of words embedded at once.
     """
 
-    def __init__(self, embedder, prefix="", **kwargs):
-        try:
-            from web.datasets.similarity import fetch_MEN, fetch_WS353, fetch_SimLex999, fetch_RW
-        except ImportError:
-            raise RuntimeError("Please install web (https://github.com/kudkudak/word-embeddings-benchmarks)")
-
+    def __init__(self, embedder, prefix="", cache_dir=None, batch_size=1000, **kwargs):
         self._embedder = embedder
         self._prefix = prefix
+        self._batch_size = batch_size
 
-        # Define tasks
-        logger.info("Downloading benchmark data")
-        tasks = { # TODO: Pick a bit better tasks
-            "MEN": fetch_MEN(),
-            "WS353": fetch_WS353(),
-            "SIMLEX999": fetch_SimLex999(),
-            "RW": fetch_RW()
-        }
+        tasks = load_similarity_tasks(cache_dir)
 
         # Print sample data
-        for name, data in iteritems(tasks):
+        for name, (X, y) in iteritems(tasks):
             logger.info(
-            "Sample data from {}: pair \"{}\" and \"{}\" is assigned score {}".format(name, data.X[0][0], data.X[0][1],
-                data.y[0]))
+            "Sample data from {}: pair \"{}\" and \"{}\" is assigned score {}".format(name, X[0][0], X[0][1],
+                y[0]))
 
         logger.info("Checking embedder for " + prefix)
         logger.info(embedder(["love"])[0, 0:5]) # Test embedder
 
-        self._tasks = tasks
+        # Every word is embedded once, the pairs are kept as indices
+        self._words = sorted(set(word for X, _ in tasks.values() for word in X.flatten()))
+        word_to_index = {word: index for index, word in enumerate(self._words)}
+        self._tasks = {
+            name: (np.vectorize(word_to_index.get, otypes=['int64'])(X), y)
+            for name, (X, y) in iteritems(tasks)}
 
         super(SimilarityWordEmbeddingEval, self).__init__(**kwargs)
 
@@ -208,6 +224,8 @@ class SimilarityWordEmbeddingEval(SimpleExtension):
             del dict_['_embedder']
         if '_tasks' in dict_:
             del dict_['_tasks']
+        if '_words' in dict_:
+            del dict_['_words']
         return dict_
 
     def add_records(self, log, record_tuples):
@@ -218,23 +236,18 @@ class SimilarityWordEmbeddingEval(SimpleExtension):
             log.current_row[name] = value
 
     def do(self, *args, **kwargs):
-        # Embedd
-        all_words = []
-        all_words_vectors = []
-
-        # TODO: Do it at once?
-        for task in self._tasks:
-            for row in self._tasks[task].X:
-                for w in row:
-                    all_words.append(w)
-                    all_words_vectors.append(self._embedder([w]))
-        W = dict(zip(np.array(all_words).reshape((-1,)), all_words_vectors))
-
-        # Calculate results using helper function
+        vectors = np.vstack([
+            self._embedder(self._words[i:i + self._batch_size])
+            for i in range(0, len(self._words), self._batch_size)])
+        vectors = vectors / np.maximum(
+            np.linalg.norm(vectors, axis=1, keepdims=True), 1e-8)
+
+        # Spearman correlation of the cosine similarities with the ratings
         record_items = []
-        for name, data in iteritems(self._tasks):
-            eval = evaluate_similarity(W, data.X, data.y)
-            record_items.append((self._prefix + "_" + name, eval))
+        for name, (pairs, y) in iteritems(self._tasks):
+            scores = (vectors[pairs[:, 0]] * vectors[pairs[:, 1]]).sum(axis=1)
+            record_items.append((self._prefix + "_" + name,
+                                 scipy.stats.spearmanr(scores, y).correlation))
 
         self.add_records(self.main_loop.log, record_items)
 
@@ -386,3 +399,64 @@ class IntermediateCheckpoint(Checkpoint):
         self.path = "{}.after_batch_{}.tar".format(self.base_path, iterations_done)
         super(IntermediateCheckpoint, self).do(*args, **kwargs)
 
+
+
+class LastBatchMonitoring(SimpleExtension, MonitoringExtension):
+    """Monitors variables on the last training batch.
+
+    Unlike `TrainingDataMonitoring`, the variables are not added to the
+    training function: a separate function is compiled and called only
+    when the extension is triggered, typically every `mon_freq` batches.
+    The values are hence computed after the parameter update.
+
+    Parameters
+    ----------
+    variables : list of TensorVariable
+        The variables to monitor, the inputs of their graph must be
+        named after the sources of the batches.
+
+    """
+    def __init__(self, variables, **kwargs):
+        kwargs.setdefault("after_batch", True)
+        super(LastBatchMonitoring, self).__init__(**kwargs)
+        self._variables = variables
+        self._function = None
+
+    def __getstate__(self):
+        dict_ = dict(self.__dict__)
+        dict_['_function'] = None
+        return dict_
+
+    def _compile(self):
+        self._inputs = ComputationGraph(self._variables).inputs
+        self._function = theano.function(
+            self._inputs, self._variables, on_unused_input='ignore')
+
+    def do(self, which_callback, *args):
+        if which_callback != 'after_batch':
+            return
+        batch, = args
+        if self._function is None:
+            self._compile()
+        values = self._function(*[batch[input_.name] for input_ in self._inputs])
+        self.add_records(
+            self.main_loop.log,
+            [(variable.name, value)
+             for variable, value in zip(self._variables, values)])
+
+
+class ResetStates(SimpleExtension):
+    """Resets the states carried between batches by a stateful model.
+
+    Parameters
+    ----------
+    model : Brick
+        A brick with a `reset_states` method, e.g. `LanguageModel`.
+
+    """
+    def __init__(self, model, **kwargs):
+        self._model = model
+        super(ResetStates, self).__init__(**kwargs)
+
+    def do(self, *args, **kwargs):
+        self._model.reset_states()
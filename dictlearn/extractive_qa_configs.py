@@ -35,6 +35,9 @@ qa_config_registry.set_root_config({
     'annealing_learning_rate' : 0.0001,
     'annealing_start_epoch' : 10,
     'grad_clip_threshold' : 5.0,
+    # parameter name regexp -> 'adam' or 'sgd', for row-wise updates
+    # of lookup tables
+    'sparse_updates' : {},
     'emb_dropout' : 0.0,
     'emb_dropout_type' : 'regular',
     'dropout' : 0.,
@@ -45,6 +48,9 @@ qa_config_registry.set_root_config({
     'reuse_word_embeddings' : False,
     'bidir_encoder' : False,
     'train_only_def_part' : False,
+    'def_cache_max_age' : 0,
+    # if positive, the predicted spans are at most this long
+    'max_answer_len' : 0,
 
     # monitoring and checkpointing
     'mon_freq_train' : 10,
@@ -53,7 +59,10 @@ qa_config_registry.set_root_config({
     # that corresponds to about 12 epochs
     'n_batches' : 0,
     'n_epochs' : 12,
-    'monitor_parameters' : False
+    'monitor_parameters' : False,
+    # when False: the diagnostics are computed on the last batch every
+    # mon_freq_train batches instead of by the training function
+    'monitor_every_batch' : False
 })
 qar = qa_config_registry
 
@@ -22,8 +22,9 @@ from blocks.select import Selector
 from dictlearn.ops import WordToIdOp, RetrievalOp
 from dictlearn.lookup import (
     LSTMReadDefinitions, MeanPoolReadDefinitions,
-    MeanPoolCombiner)
-from dictlearn.theano_util import unk_ratio
+    MeanPoolCombiner, DefinitionCache)
+from dictlearn.theano_util import unk_ratio, is_required
+from dictlearn.span_decoding import best_span
 
 
 class EmbeddingRole(VariableRole):
@@ -59,6 +60,13 @@ class ExtractiveQAModel(Initializable):
         Triggers the use of definitions.
     reuse_word_embeddings : bool
     compose_type : str
+    def_cache_max_age : int
+        If positive, the definition embeddings are cached for this
+        number of updates, see `DefinitionCache`.
+    max_answer_len : int
+        If positive, the predicted spans are decoded jointly and have
+        at most this number of words, see `best_span`. Otherwise the
+        beginning and the end are predicted independently.
 
     """
     def __init__(self, dim, emb_dim, readout_dims,
@@ -66,6 +74,7 @@ class ExtractiveQAModel(Initializable):
                  use_definitions, def_word_gating, compose_type, coattention,
                  def_reader, reuse_word_embeddings, bidir_encoder,
                  random_unk, recurrent_weights_init,
+                 def_cache_max_age=0, max_answer_len=0,
                  **kwargs):
         self._vocab = vocab
         if emb_dim == 0:
@@ -76,6 +85,7 @@ class ExtractiveQAModel(Initializable):
             def_num_input_words = num_input_words
 
         self._coattention = coattention
+        self._max_answer_len = max_answer_len
         self._num_input_words = num_input_words
         self._use_definitions = use_definitions
         self._random_unk = random_unk
@@ -133,6 +143,13 @@ class ExtractiveQAModel(Initializable):
                 def_word_gating=def_word_gating, compose_type=compose_type)
             children.extend([self._def_reader, self._combiner])
 
+        self._def_cache = None
+        if self._use_definitions and def_cache_max_age > 0:
+            self._def_cache = DefinitionCache(
+                self._def_reader, self._combiner, vocab.size(),
+                def_cache_max_age, vocab.unk, name='def_cache')
+            children.append(self._def_cache)
+
         super(ExtractiveQAModel, self).__init__(children=children, **kwargs)
 
         # create default input variables
@@ -160,8 +177,9 @@ class ExtractiveQAModel(Initializable):
         self._encoder_rnn.weights_init = self.recurrent_weights_init
         self._bidir.weights_init = self.recurrent_weights_init
 
-    def set_embeddings(self, embeddings):
-        self._lookup.parameters[0].set_value(embeddings.astype(theano.config.floatX))
+    def set_embeddings(self, embeddings, borrow=False):
+        self._lookup.parameters[0].set_value(
+            embeddings.astype(theano.config.floatX, copy=False), borrow=borrow)
 
     def embeddings_var(self):
         return self._lookup.parameters[0]
@@ -176,12 +194,13 @@ class ExtractiveQAModel(Initializable):
 
 
     @application
-    def _encode(self, application_call, text, mask, def_embs=None, def_map=None, text_name=None):
+    def _encode(self, application_call, text, mask, def_embs=None, def_map=None,
+                text_name=None, def_mean=None, auxiliary=None):
         if not self._random_unk:
             text = (
                 tensor.lt(text, self._num_input_words) * text
                 + tensor.ge(text, self._num_input_words) * self._vocab.unk)
-        if text_name:
+        if text_name and is_required(auxiliary, '{}_unk_ratio'.format(text_name)):
             application_call.add_auxiliary_variable(
                 unk_ratio(text, mask, self._vocab.unk),
                 name='{}_unk_ratio'.format(text_name))
@@ -190,8 +209,12 @@ class ExtractiveQAModel(Initializable):
             embs = (
                 tensor.lt(text, self._num_input_words)[:, :, None] * embs
                 + tensor.ge(text, self._num_input_words)[:, :, None] * disconnected_grad(embs))
-        if def_embs:
-            embs, _, _ = self._combiner.apply(embs, mask, def_embs, def_map)
+        if def_mean is not None:
+            embs = self._combiner.apply_precomputed(
+                embs, mask, def_mean, auxiliary=auxiliary)
+        elif def_embs is not None:
+            embs, _, _ = self._combiner.apply(
+                embs, mask, def_embs, def_map, auxiliary=auxiliary)
         add_role(embs, EMBEDDINGS)
         encoded = flip01(
             self._encoder_rnn.apply(
@@ -205,15 +228,30 @@ class ExtractiveQAModel(Initializable):
     def apply(self, application_call,
               contexts, contexts_mask, questions, questions_mask,
               answer_begins, answer_ends,
-              defs=None, def_mask=None, contexts_def_map=None, questions_def_map=None):
+              defs=None, def_mask=None, contexts_def_map=None, questions_def_map=None,
+              auxiliary=None):
+        """Computes the costs of the answer spans.
+
+        `auxiliary` is the set of the names of the auxiliary variables to
+        build, by default all of them are. Evaluation only needs
+        `predicted_begins` and `predicted_ends`.
+
+        """
         def_embs = None
-        if self._use_definitions:
-            def_embs = self._def_reader.apply(defs, def_mask)
+        contexts_def_mean = questions_def_mean = None
+        if self._def_cache:
+            contexts_def_mean, questions_def_mean = self._def_cache.apply(
+                defs, def_mask, [contexts, questions],
+                [contexts_def_map, questions_def_map], auxiliary=auxiliary)
+        elif self._use_definitions:
+            def_embs = self._def_reader.apply(defs, def_mask, auxiliary=auxiliary)
 
         context_enc = self._encode(contexts, contexts_mask,
-                                   def_embs, contexts_def_map, 'context')
+                                   def_embs, contexts_def_map, 'context',
+                                   contexts_def_mean, auxiliary)
         question_enc_pre = self._encode(questions, questions_mask,
-                                         def_embs, questions_def_map, 'question')
+                                         def_embs, questions_def_map, 'question',
+                                         questions_def_mean, auxiliary)
         question_enc = tensor.tanh(self._question_transform.apply(question_enc_pre))
 
         # should be (batch size, context length, question_length)
@@ -222,12 +260,14 @@ class ExtractiveQAModel(Initializable):
         affinity = affinity * affinity_mask - 1000.0 * (1 - affinity_mask)
         # soft-aligns every position in the context to positions in the question
         d2q_att_weights = self._softmax.apply(affinity, extra_ndim=1)
-        application_call.add_auxiliary_variable(
-            d2q_att_weights.copy(), name='d2q_att_weights')
+        if is_required(auxiliary, 'd2q_att_weights'):
+            application_call.add_auxiliary_variable(
+                d2q_att_weights.copy(), name='d2q_att_weights')
         # soft-aligns every position in the question to positions in the document
         q2d_att_weights = self._softmax.apply(flip12(affinity), extra_ndim=1)
-        application_call.add_auxiliary_variable(
-            q2d_att_weights.copy(), name='q2d_att_weights')
+        if is_required(auxiliary, 'q2d_att_weights'):
+            application_call.add_auxiliary_variable(
+                q2d_att_weights.copy(), name='q2d_att_weights')
 
         # question encoding "in the view of the document"
         question_enc_informed = tensor.batched_dot(
@@ -265,18 +305,25 @@ class ExtractiveQAModel(Initializable):
         end_costs = self._softmax.categorical_cross_entropy(
             answer_ends, end_readouts)
 
-        predicted_begins = begin_readouts.argmax(axis=-1)
-        predicted_ends = end_readouts.argmax(axis=-1)
-        exact_match = (tensor.eq(predicted_begins, answer_begins) *
-                       tensor.eq(predicted_ends, answer_ends))
-        application_call.add_auxiliary_variable(
-            predicted_begins, name='predicted_begins')
-        application_call.add_auxiliary_variable(
-            predicted_ends, name='predicted_ends')
-        application_call.add_auxiliary_variable(
-            exact_match, name='exact_match')
+        if self._max_answer_len:
+            predicted_begins, predicted_ends = best_span(
+                begin_readouts, end_readouts, self._max_answer_len)
+        else:
+            predicted_begins = begin_readouts.argmax(axis=-1)
+            predicted_ends = end_readouts.argmax(axis=-1)
+        if is_required(auxiliary, 'predicted_begins'):
+            application_call.add_auxiliary_variable(
+                predicted_begins, name='predicted_begins')
+        if is_required(auxiliary, 'predicted_ends'):
+            application_call.add_auxiliary_variable(
+                predicted_ends, name='predicted_ends')
+        if is_required(auxiliary, 'exact_match'):
+            exact_match = (tensor.eq(predicted_begins, answer_begins) *
+                           tensor.eq(predicted_ends, answer_ends))
+            application_call.add_auxiliary_variable(
+                exact_match, name='exact_match')
 
         return begin_costs + end_costs
 
-    def apply_with_default_vars(self):
-        return self.apply(*self.input_vars.values())
+    def apply_with_default_vars(self, auxiliary=None):
+        return self.apply(*self.input_vars.values(), auxiliary=auxiliary)
@@ -14,7 +14,6 @@ import subprocess
 import json
 import StringIO
 
-import numpy
 import theano
 from theano import tensor
 from nltk.tokenize.moses import MosesDetokenizer
@@ -25,7 +24,7 @@ from blocks.bricks.recurrent import Bidirectional
 from blocks.bricks.simple import Rectifier
 from blocks.bricks import Initializable
 from blocks.algorithms import (
-    Adam, GradientDescent, Adam, StepClipping, CompositeRule)
+    Adam, Adam, StepClipping, CompositeRule)
 from blocks.graph import ComputationGraph, apply_dropout
 from blocks.model import Model
 from blocks.filter import VariableFilter
@@ -49,15 +48,19 @@ from fuel.streams import ServerDataStream
 import dictlearn.squad_evaluate
 from dictlearn.util import (
     rename, masked_root_mean_square, get_free_port,
-    copy_streams_to_file, run_with_redirection)
+    copy_streams_to_file, run_with_redirection,
+    checkpoint_paths, write_results_table)
 from dictlearn.theano_util import parameter_stats, unk_ratio
 from dictlearn.data import ExtractiveQAData
 from dictlearn.datasets import SQuADDataset
 from dictlearn.extensions import (
     DumpTensorflowSummaries, LoadNoUnpickling, StartFuelServer,
-    RetrievalPrintStats)
+    RetrievalPrintStats, LastBatchMonitoring)
 from dictlearn.extractive_qa_model import ExtractiveQAModel, EMBEDDINGS
 from dictlearn.vocab import Vocabulary
+from dictlearn.embedding_store import EmbeddingStore, sync_references
+from dictlearn.sparse_updates import rules_from_config, sparse_updates
+from dictlearn.function_cache import CachedGradientDescent, function
 from dictlearn.retrieval import Retrieval, Dictionary
 from dictlearn.squad_evaluate import normalize_answer
 from dictlearn.util import vec2str
@@ -67,6 +70,10 @@ from dictlearn.theano_util import get_dropout_mask, apply_dropout2
 
 logger = logging.getLogger()
 
+# The original SQuAD files, which the official evaluation needs
+SQUAD_JSON = {'train': 'squad/train-v1.1.json',
+              'dev': 'squad/dev-v1.1.json'}
+
 detok = MosesDetokenizer()
 def detokenize(str_):
     return u" ".join(detok.detokenize(str_))
@@ -164,6 +171,8 @@ def initialize_data_and_model(config):
         bidir_encoder=c['bidir_encoder'],
         random_unk=c['random_unk'],
         def_reader=c['def_reader'],
+        def_cache_max_age=c['def_cache_max_age'],
+        max_answer_len=c['max_answer_len'],
         weights_init=(GlorotUniform()
                       if not c['init_width']
                       else Uniform(width=c['init_width'])),
@@ -174,8 +183,11 @@ def initialize_data_and_model(config):
     qam.initialize()
     logger.debug("Model created")
     if c['embedding_path']:
-        qam.set_embeddings(numpy.load(
-            os.path.join(fuel.config.data_path[0], c['embedding_path'])))
+        # the embeddings are frozen, no need for a private copy
+        store = EmbeddingStore.get(
+            os.path.join(fuel.config.data_path[0], c['embedding_path']))
+        qam.set_embeddings(
+            store.as_dtype(theano.config.floatX, frozen=True), borrow=True)
         logger.debug("Embeddings loaded")
     return data, qam
 
@@ -195,6 +207,11 @@ def train_extractive_qa(new_training_job, config, save_path,
 
     c = config
     data, qam = initialize_data_and_model(c)
+    if c['embedding_path']:
+        sync_references(
+            save_path,
+            {'embedding_path': os.path.join(fuel.config.data_path[0], c['embedding_path'])},
+            new_training_job)
 
     if theano.config.compute_test_value != 'off':
         test_value_data = next(
@@ -234,6 +251,10 @@ def train_extractive_qa(new_training_job, config, save_path,
             def_gates_max = tensor.maximum(*[x.max() for x in def_gates])
             monitored_vars.extend([rename(def_gates_min, 'def_gates_min'),
                                    rename(def_gates_max, 'def_gates_max')])
+        if c['def_cache_max_age']:
+            def_cache_hit_rate, = VariableFilter(name='def_cache_hit_rate')(cg)
+            def_cache_staleness, = VariableFilter(name='def_cache_staleness')(cg)
+            monitored_vars.extend([def_cache_hit_rate, def_cache_staleness])
     text_match_ratio = TextMatchRatio(
         data_path=os.path.join(fuel.config.data_path[0], 'squad/dev-v1.1.json'),
         requires=[predicted_begins, predicted_ends,
@@ -305,20 +326,43 @@ def train_extractive_qa(new_training_job, config, save_path,
         train_cost = regularized_cg.outputs[0]
         train_monitored_vars = regularized_cg.outputs[1:]
 
+    # Unless asked otherwise, the diagnostics are computed on the last
+    # batch every `mon_freq_train` batches by a separate function
+    batch_monitored_vars = []
+    if not c['monitor_every_batch']:
+        every_batch = ['mean_cost', 'def_cache_hit_rate', 'def_cache_staleness']
+        batch_monitored_vars = [var for var in train_monitored_vars
+                                if var.name not in every_batch]
+        train_monitored_vars = [var for var in train_monitored_vars
+                                if var.name in every_batch]
+
     rules = []
     if c['grad_clip_threshold']:
         rules.append(StepClipping(c['grad_clip_threshold']))
-    rules.append(Adam(learning_rate=c['learning_rate'],
-                      beta1=c['momentum']))
-    algorithm = GradientDescent(
+    adam = Adam(learning_rate=c['learning_rate'], beta1=c['momentum'])
+    rules.append(adam)
+    # the sparse rules share the learning rate to be annealed with Adam
+    sparse_rules = rules_from_config(
+        parameters, c['sparse_updates'], adam.learning_rate, beta1=c['momentum'])
+    sparse_parameters, lookup_updates = sparse_updates(
+        train_cost, {p: rule for p, rule in sparse_rules.items() if p in trained_parameters},
+        clip_threshold=c['grad_clip_threshold'])
+    dense_parameters = [p for p in trained_parameters
+                        if p not in sparse_parameters]
+    algorithm = CachedGradientDescent(
         cost=train_cost,
-        parameters=trained_parameters,
+        parameters=dense_parameters,
         step_rule=CompositeRule(rules))
+    algorithm.add_updates(lookup_updates)
+    if c['def_cache_max_age']:
+        algorithm.add_updates(cg.updates)
 
     if c['grad_clip_threshold']:
         train_monitored_vars.append(algorithm.total_gradient_norm)
     if c['monitor_parameters']:
-        train_monitored_vars.extend(parameter_stats(parameters, algorithm))
+        train_monitored_vars.extend(parameter_stats(
+            {key: p for key, p in parameters.items() if p in dense_parameters},
+            algorithm))
 
     training_stream = data.get_stream(
         'train', batch_size=c['batch_size'],
@@ -341,6 +385,11 @@ def train_extractive_qa(new_training_job, config, save_path,
             train_monitored_vars, prefix="train",
             every_n_batches=c['mon_freq_train']),
     ]
+    if batch_monitored_vars:
+        extensions.append(
+            LastBatchMonitoring(
+                batch_monitored_vars, prefix="train",
+                every_n_batches=c['mon_freq_train']))
     validation = DataStreamMonitoring(
         [text_match_ratio] + monitored_vars,
         data.get_stream('dev', batch_size=c['batch_size_valid'],
@@ -409,112 +458,209 @@ def train_extractive_qa(new_training_job, config, save_path,
     main_loop.run()
 
 
+def _squad_subset(articles, q_ids):
+    """Keeps only the questions from `q_ids` in a SQuAD dataset."""
+    subset = []
+    for article in articles:
+        paragraphs = []
+        for paragraph in article['paragraphs']:
+            qas = [qa for qa in paragraph['qas'] if qa['id'] in q_ids]
+            if qas:
+                paragraphs.append(dict(paragraph, qas=qas))
+        if paragraphs:
+            subset.append(dict(article, paragraphs=paragraphs))
+    return subset
+
+
+# The arguments of the evaluation script that only `evaluate_extractive_qa`
+# understands, see `dictlearn.main.main_evaluate`
+EVALUATE_ARGUMENTS = [
+    (["--dump-attention"], dict(action="store_true", help="Save the attention weights")),
+    (["--verbose"], dict(action="store_true", help="Print every example"))]
+
+
 def evaluate_extractive_qa(config, tar_path, part, num_examples, dest_path,
-                           qids=None, dataset=None):
+                           qids=None, dataset=None, dump_attention=False,
+                           verbose=False):
+    """Predicts the answers and computes EM and F1.
+
+    The predictions are written to `dest_path` and a log with one JSON
+    line per question to `<dest_path>_log.jsonl`, both as the batches
+    are processed. With `dump_attention` the attention weights of the
+    coattention models are pickled one question after another into
+    `<dest_path>_attention.pkl`. With `verbose` every example is
+    printed. The batches are of size `batch_size_valid`.
+
+    """
     if not dest_path:
         dest_path = os.path.join(os.path.dirname(tar_path), 'predictions.json')
-    log_path = os.path.splitext(dest_path)[0] + '_log.json'
 
     if qids:
-        qids = qids.split(',')
+        qids = set(qids.split(','))
 
+    squad_articles = None
     if dataset:
         dataset = SQuADDataset(dataset, ('all',))
+    elif part in SQUAD_JSON:
+        with open(os.path.join(fuel.config.data_path[0], SQUAD_JSON[part])) as src:
+            squad_articles = json.load(src)['data']
+    else:
+        logger.warning("No SQuAD file for {}, EM and F1 are not computed".format(part))
 
     c = config
+    dump_attention = dump_attention and c['coattention']
     data, qam = initialize_data_and_model(c)
-    costs = qam.apply_with_default_vars()
+    auxiliary = {'predicted_begins', 'predicted_ends'}
+    if dump_attention:
+        auxiliary |= {'d2q_att_weights', 'q2d_att_weights'}
+    costs = qam.apply_with_default_vars(auxiliary=auxiliary)
     cg = Model(costs)
 
-    with open(tar_path) as src:
-        cg.set_parameter_values(load_parameters(src))
-
     predicted_begins, = VariableFilter(name='predicted_begins')(cg)
     predicted_ends, = VariableFilter(name='predicted_ends')(cg)
     compute = {'begins': predicted_begins, 'ends': predicted_ends}
-    if c['coattention']:
+    if dump_attention:
         d2q_att_weights, = VariableFilter(name='d2q_att_weights')(cg)
         q2d_att_weights, = VariableFilter(name='q2d_att_weights')(cg)
         compute.update({'d2q': d2q_att_weights,
                         'q2d': q2d_att_weights})
     compute['costs'] = costs
-    predict_func = theano.function(qam.input_vars.values(), compute)
+    predict_func = function(qam.input_vars.values(), compute, name='predict')
     logger.debug("Ready to evaluate")
 
-    done_examples = 0
-    num_correct = 0
-    def print_stats():
-        print('EXACT MATCH RATIO: {}'.format(num_correct / float(done_examples)))
-
-    predictions = {}
-    log = {}
-
-    stream = data.get_stream(part, batch_size=1, shuffle=part == 'train',
+    stream = data.get_stream(part, batch_size=c['batch_size_valid'],
+                             shuffle=part == 'train',
                              raw_text=True, q_ids=True, dataset=dataset)
-    for example in stream.get_epoch_iterator(as_dict=True):
-        if done_examples == num_examples:
-            break
-        q_id = vec2str(example['q_ids'][0])
-        if qids and not q_id in qids:
-            continue
-
-        example['contexts_text'] = [
-            map(vec2str, example['contexts_text'][0])]
-        example['questions_text'] = [
-            map(vec2str, example['questions_text'][0])]
-        feed = dict(example)
-        del feed['q_ids']
-        del feed['contexts_text']
-        del feed['questions_text']
-        del feed['contexts_text_mask']
-        result = predict_func(**feed)
-        correct_answer_span = slice(example['answer_begins'][0], example['answer_ends'][0])
-        predicted_answer_span = slice(result['begins'][0], result['ends'][0])
-        correct_answer = example['contexts_text'][0][correct_answer_span]
-        answer = example['contexts_text'][0][predicted_answer_span]
-        is_correct = correct_answer_span == predicted_answer_span
-        context = example['contexts_text'][0]
-        question = example['questions_text'][0]
-        context_def_map = example['contexts_def_map']
-
-        # pretty print
-        outcome = 'correct' if is_correct else 'wrong'
-        print('#{}'.format(done_examples))
-        print(u"CONTEXT:", detokenize(context))
-        print(u"QUESTION:", detokenize(question))
-        print(u"RIGHT ANSWER: {}".format(detokenize(correct_answer)))
-        print(u"ANSWER (span=[{}, {}], {}):".format(predicted_answer_span.start,
-                                                    predicted_answer_span.stop,
-                                                    outcome),
-              detokenize(answer))
-        print(u"COST: {}".format(float(result['costs'][0])))
-        print(u"DEFINITIONS AVAILABLE FOR:")
-        for pos in set(context_def_map[:, 1]):
-            print(context[pos])
-        print()
-
-        # update statistics
-        done_examples += 1
-        num_correct += is_correct
-
-
-        # save the results
-        predictions[q_id] = detokenize(answer)
-        log_entry = {'context': context,
-                     'question': question,
-                     'answer': answer,
-                     'correct_answer': correct_answer,
-                     'cost' : float(result['costs'][0])}
-        if c['coattention']:
-            log_entry['d2q'] = cPickle.dumps(result['d2q'][0])
-            log_entry['q2d'] = cPickle.dumps(result['q2d'][0])
-        log[q_id] = log_entry
-
-        if done_examples % 100 == 0:
-            print_stats()
-    print_stats()
 
-    with open(log_path, 'w') as dst:
-        json.dump(log, dst, indent=2, sort_keys=True)
-    with open(dest_path, 'w') as dst:
-        json.dump(predictions, dst, indent=2, sort_keys=True)
+    def evaluate_checkpoint(tar_path, dest_path):
+        with open(tar_path) as src:
+            cg.set_parameter_values(load_parameters(src))
+        log_path = os.path.splitext(dest_path)[0] + '_log.jsonl'
+        attention_path = os.path.splitext(dest_path)[0] + '_attention.pkl'
+
+        done_examples = 0
+        num_correct = 0
+        def print_stats():
+            print('EXACT MATCH RATIO: {}'.format(
+                num_correct / float(max(done_examples, 1))))
+
+        predictions = {}
+        # The predictions are written as a JSON dictionary one entry
+        # at a time, so that they are not lost if the evaluation is stopped
+        predictions_dst = open(dest_path, 'w')
+        predictions_dst.write('{')
+        log_dst = open(log_path, 'w')
+        attention_dst = open(attention_path, 'wb') if dump_attention else None
+        try:
+            for batch in stream.get_epoch_iterator(as_dict=True):
+                if done_examples == num_examples:
+                    break
+                feed = dict(batch)
+                del feed['q_ids']
+                del feed['contexts_text']
+                del feed['questions_text']
+                del feed['contexts_text_mask']
+                result = predict_func(**feed)
+
+                context_lengths = batch['contexts_text_mask'].sum(axis=1).astype('int64')
+                for i in range(len(batch['q_ids'])):
+                    if done_examples == num_examples:
+                        break
+                    q_id = vec2str(batch['q_ids'][i])
+                    if qids and not q_id in qids:
+                        continue
+                    context_text = batch['contexts_text'][i]
+                    correct_answer_span = slice(batch['answer_begins'][i],
+                                                batch['answer_ends'][i])
+                    predicted_answer_span = slice(result['begins'][i],
+                                                  result['ends'][i])
+                    # only the words that are reported are decoded
+                    answer = map(vec2str, context_text[predicted_answer_span])
+                    correct_answer = map(vec2str, context_text[correct_answer_span])
+                    is_correct = correct_answer_span == predicted_answer_span
+                    cost = float(result['costs'][i])
+
+                    if verbose:
+                        context = map(vec2str, context_text[:context_lengths[i]])
+                        question = map(vec2str, batch['questions_text'][i])
+                        outcome = 'correct' if is_correct else 'wrong'
+                        print('#{}'.format(done_examples))
+                        print(u"CONTEXT:", detokenize(context))
+                        print(u"QUESTION:", detokenize(question))
+                        print(u"RIGHT ANSWER: {}".format(detokenize(correct_answer)))
+                        print(u"ANSWER (span=[{}, {}], {}):".format(
+                                  predicted_answer_span.start,
+                                  predicted_answer_span.stop, outcome),
+                              detokenize(answer))
+                        print(u"COST: {}".format(cost))
+                        if 'contexts_def_map' in batch:
+                            def_map = batch['contexts_def_map']
+                            print(u"DEFINITIONS AVAILABLE FOR:")
+                            for pos in set(def_map[def_map[:, 0] == i, 1]):
+                                print(context[pos])
+                        print()
+
+                    # update statistics
+                    done_examples += 1
+                    num_correct += is_correct
+
+                    # save the results
+                    predictions[q_id] = detokenize(answer)
+                    predictions_dst.write('{}\n{}: {}'.format(
+                        ',' if done_examples > 1 else '',
+                        json.dumps(q_id), json.dumps(predictions[q_id])))
+                    log_dst.write(json.dumps(
+                        {'q_id': q_id,
+                         'answer': answer,
+                         'correct_answer': correct_answer,
+                         'span': [predicted_answer_span.start,
+                                  predicted_answer_span.stop],
+                         'correct_span': [correct_answer_span.start,
+                                          correct_answer_span.stop],
+                         'cost': cost}) + '\n')
+                    if dump_attention:
+                        context_length = int(batch['contexts_mask'][i].sum())
+                        question_length = int(batch['questions_mask'][i].sum())
+                        cPickle.dump(
+                            (q_id,
+                             result['d2q'][i, :context_length, :question_length],
+                             result['q2d'][i, :question_length, :context_length]),
+                            attention_dst, cPickle.HIGHEST_PROTOCOL)
+
+                    if done_examples % 1000 == 0:
+                        print_stats()
+                predictions_dst.flush()
+                log_dst.flush()
+            print_stats()
+        finally:
+            predictions_dst.write('\n}\n')
+            predictions_dst.close()
+            log_dst.close()
+            if attention_dst:
+                attention_dst.close()
+
+        results = {'exact_match_ratio': num_correct / float(max(done_examples, 1)),
+                   'num_examples': done_examples}
+        if squad_articles is not None and predictions:
+            # only the questions that were answered are scored
+            results.update(dictlearn.squad_evaluate.evaluate(
+                _squad_subset(squad_articles, predictions), predictions))
+            logger.info("EM: {exact_match}, F1: {f1}".format(**results))
+        return results
+
+    # A glob of checkpoints is evaluated with the same function and
+    # stream, only the parameters are changed
+    tar_paths = checkpoint_paths(tar_path)
+    if len(tar_paths) == 1:
+        evaluate_checkpoint(tar_paths[0], dest_path)
+    else:
+        rows = []
+        for path in tar_paths:
+            logger.info("Evaluating " + path)
+            name = os.path.splitext(os.path.basename(path))[0]
+            checkpoint_dest_path = '{}_{}.json'.format(
+                os.path.splitext(dest_path)[0], name)
+            rows.append(dict(evaluate_checkpoint(path, checkpoint_dest_path),
+                             checkpoint=path))
+        write_results_table(
+            rows, os.path.splitext(dest_path)[0] + '_results.csv')
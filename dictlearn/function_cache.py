@@ -0,0 +1,199 @@
+"""A disk cache of compiled Theano functions.
+
+Compiling the training and evaluation functions of the larger models
+takes minutes, and it is repeated by every job of a sweep and every
+evaluation of a checkpoint. `function` is a drop-in replacement of
+`theano.function` that pickles the compiled functions into a directory
+shared by the jobs and loads them back on the next start.
+
+The functions are keyed by a hash of the configuration of the run, of
+the structure of the graph and of the Theano flags. A function that
+can not be loaded is compiled again.
+
+The shared variables, i.e. the parameters, are not saved with the
+functions: the loaded functions are rebound to the shared variables
+of the current graph.
+
+"""
+import os
+import json
+import time
+import cPickle
+import hashlib
+import logging
+import tempfile
+
+import numpy
+import theano
+from theano.compile import SharedVariable
+from theano.tensor import TensorType
+
+from blocks.algorithms import GradientDescent
+from blocks.graph import ComputationGraph
+
+from dictlearn.ops import WordToIdOp, WordToCountOp, RetrievalOp
+
+logger = logging.getLogger(__name__)
+
+# These ops hold the vocabulary and the dictionary
+_UNPICKLABLE_OPS = (WordToIdOp, WordToCountOp, RetrievalOp)
+_FLAGS = ['floatX', 'device', 'mode', 'optimizer', 'linker',
+          'optimizer_including', 'optimizer_excluding', 'cast_policy']
+
+_cache_dir = None
+_config = None
+
+
+def set_function_cache(cache_dir, config=None):
+    """Enables the cache.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory of the cache, `None` disables it.
+    config : dict
+        The configuration of the run, which is part of the key.
+
+    """
+    global _cache_dir, _config
+    _cache_dir = cache_dir
+    _config = config
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+
+def _as_list(variables):
+    if variables is None:
+        return []
+    if isinstance(variables, dict):
+        return [variables[key] for key in sorted(variables)]
+    if isinstance(variables, (list, tuple)):
+        return list(variables)
+    return [variables]
+
+
+def _shared_variables(variables):
+    """The shared variables of a graph in a deterministic order."""
+    shared = []
+    for variable in theano.gof.graph.inputs(variables):
+        if isinstance(variable, SharedVariable) and variable not in shared:
+            shared.append(variable)
+    return shared
+
+
+def _key(inputs, outputs, updates, kwargs):
+    graph = theano.printing.debugprint(
+        outputs + [value for _, value in updates], file='str', print_type=True)
+    key = hashlib.sha1()
+    key.update(json.dumps(_config, sort_keys=True, default=repr))
+    key.update(repr([(input_.name, str(input_.type)) for input_ in inputs]))
+    key.update(repr([(variable.name, str(variable.type)) for variable, _ in updates]))
+    key.update(graph)
+    key.update(repr([(flag, str(getattr(theano.config, flag, None)))
+                     for flag in _FLAGS]))
+    key.update(repr(sorted(kwargs.items())))
+    return key.hexdigest()
+
+
+def _placeholder(variable):
+    shape = [1 if broadcastable else 0
+             for broadcastable in variable.broadcastable]
+    return theano.shared(numpy.zeros(shape, dtype=variable.dtype),
+                         name=variable.name,
+                         broadcastable=variable.broadcastable)
+
+
+def _load(path, shared):
+    with open(path, 'rb') as src:
+        placeholder_function, positions, compilation_time = cPickle.load(src)
+    swap = {placeholder: shared[position] for placeholder, position
+            in zip(placeholder_function.get_shared(), positions)}
+    return placeholder_function.copy(swap=swap), compilation_time
+
+
+def _save(path, compiled, shared):
+    positions = [shared.index(variable) for variable in compiled.get_shared()]
+    # the values of the shared variables are not saved
+    placeholder_function = compiled.copy(
+        swap={variable: _placeholder(variable)
+              for variable in compiled.get_shared()})
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as dst:
+        cPickle.dump((placeholder_function, positions, compiled.compilation_time),
+                     dst, cPickle.HIGHEST_PROTOCOL)
+    # the cache can be shared by concurrent jobs
+    os.rename(temp_path, path)
+
+
+def _is_cacheable(variables, kwargs):
+    if 'givens' in kwargs:
+        return False
+    for node in theano.gof.graph.io_toposort(
+            theano.gof.graph.inputs(variables), variables):
+        if isinstance(node.op, _UNPICKLABLE_OPS):
+            return False
+    return all(isinstance(variable.type, TensorType)
+               for variable in _shared_variables(variables))
+
+
+def function(inputs, outputs=None, updates=None, name=None, **kwargs):
+    """Compiles a Theano function or loads it from the cache.
+
+    The arguments are the ones of `theano.function`, `givens` is not
+    supported by the cache.
+
+    """
+    if updates is None:
+        updates = []
+    updates = list(updates.items()) if hasattr(updates, 'items') else list(updates)
+    variables = (_as_list(outputs) + [value for _, value in updates]
+                 + [variable for variable, _ in updates])
+    name = name or 'function'
+
+    def compile_():
+        start = time.time()
+        compiled = theano.function(inputs, outputs, updates=updates,
+                                   name=name, **kwargs)
+        compiled.compilation_time = time.time() - start
+        logger.info("Compiled {} in {:.1f}s".format(name, compiled.compilation_time))
+        return compiled
+
+    if not _cache_dir:
+        return compile_()
+    if not _is_cacheable(variables, kwargs):
+        logger.info("{} can not be cached".format(name))
+        return compile_()
+
+    start = time.time()
+    shared = _shared_variables(variables)
+    path = os.path.join(
+        _cache_dir, _key(inputs, _as_list(outputs), updates, kwargs) + '.pkl')
+    if os.path.exists(path):
+        try:
+            loaded, compilation_time = _load(path, shared)
+            logger.info(
+                "Loaded {} from the cache in {:.1f}s, compiling it took {:.1f}s"
+                .format(name, time.time() - start, compilation_time))
+            return loaded
+        except Exception:
+            logger.warning("Could not load {} from {}, compiling it".format(
+                name, path), exc_info=True)
+    compiled = compile_()
+    try:
+        _save(path, compiled, shared)
+    except Exception:
+        logger.warning("Could not save {} to the cache".format(name),
+                       exc_info=True)
+    return compiled
+
+
+class CachedGradientDescent(GradientDescent):
+    """A `GradientDescent` that compiles its function with `function`."""
+    def initialize(self):
+        logger.info("Initializing the training algorithm")
+        update_values = [new_value for _, new_value in self.updates]
+        self.inputs = ComputationGraph(update_values).inputs
+        self._function = function(
+            self.inputs, [], updates=self.updates, name='training_function',
+            **self.theano_func_kwargs)
+        logger.info("The training algorithm is initialized")
@@ -1,8 +1,9 @@
 import json
 import logging
+import itertools
+import multiprocessing
 import traceback
 import h5py
-import json
 try:
     import pandas as pd
 except ImportError:
@@ -12,26 +13,102 @@ import h5py
 import numpy as np
 
 from os import path
+from collections import defaultdict
 from fuel.datasets.hdf5 import H5PYDataset
 
 from dictlearn.corenlp import StanfordCoreNLP
 
 logger = logging.getLogger()
 
+# The number of words (SQuAD) or sentences (SNLI) digitized at once
+DIGITIZE_CHUNK_SIZE = 100000
+
+
+_HASH_BASE = 1000003
+_HASH_MOD = (1 << 61) - 1
+
 
 def _find_sublist(list_, sublist):
+    """Finds all occurrences of `sublist` in `list_`.
+
+    Uses the Knuth-Morris-Pratt algorithm, hence the running time is
+    linear in `len(list_) + len(sublist)`.
+
+    """
+    if not sublist:
+        return list(range(len(list_) + 1))
+    # failure[i] is the length of the longest proper prefix of
+    # sublist[:i + 1] which is also its suffix
+    failure = [0] * len(sublist)
+    matched = 0
+    for i in range(1, len(sublist)):
+        while matched and sublist[i] != sublist[matched]:
+            matched = failure[matched - 1]
+        if sublist[i] == sublist[matched]:
+            matched += 1
+        failure[i] = matched
+
     indices = []
-    for i in range(len(list_) - len(sublist) + 1):
-        found = True
-        for j in range(len(sublist)):
-            if list_[i + j] != sublist[j]:
-                found = False
-                break
-        if found:
-            indices.append(i)
+    matched = 0
+    for i, item in enumerate(list_):
+        while matched and item != sublist[matched]:
+            matched = failure[matched - 1]
+        if item == sublist[matched]:
+            matched += 1
+        if matched == len(sublist):
+            indices.append(i - matched + 1)
+            matched = failure[matched - 1]
     return indices
 
 
+def _find_sublists(list_, sublists):
+    """Finds all occurrences of each of `sublists` in `list_`.
+
+    The sublists are grouped by length, and for each length all the
+    windows of `list_` are hashed with a rolling hash in one pass, so
+    that many patterns cost about as much as one. Hash matches are
+    verified, the result is exact.
+
+    Returns a list with the indices of occurrences for each sublist.
+
+    """
+    list_ = list(list_)
+    sublists = [list(sublist) for sublist in sublists]
+    results = [[] for _ in sublists]
+    by_length = defaultdict(list)
+    for i, sublist in enumerate(sublists):
+        by_length[len(sublist)].append(i)
+
+    item_hashes = [hash(item) % _HASH_MOD for item in list_]
+    def window_hash(hashes):
+        value = 0
+        for item_hash in hashes:
+            value = (value * _HASH_BASE + item_hash) % _HASH_MOD
+        return value
+
+    for length, sublist_ids in by_length.items():
+        if not length:
+            for i in sublist_ids:
+                results[i] = list(range(len(list_) + 1))
+            continue
+        if length > len(list_):
+            continue
+        by_hash = defaultdict(list)
+        for i in sublist_ids:
+            by_hash[window_hash([hash(item) % _HASH_MOD
+                                 for item in sublists[i]])].append(i)
+        highest_power = pow(_HASH_BASE, length - 1, _HASH_MOD)
+        value = window_hash(item_hashes[:length])
+        for start in range(len(list_) - length + 1):
+            if start:
+                value = ((value - item_hashes[start - 1] * highest_power) * _HASH_BASE
+                         + item_hashes[start + length - 1]) % _HASH_MOD
+            for i in by_hash.get(value, ()):
+                if list_[start:start + length] == sublists[i]:
+                    results[i].append(start)
+    return results
+
+
 def text_to_h5py_dataset(text_path, dst_path):
     # The simplest is to load everything to memory first.
     # If memory becomes an issue, this code can be optimized.
@@ -52,8 +129,115 @@ def text_to_h5py_dataset(text_path, dst_path):
             })
 
 
+def _squad_paragraph_to_examples(corenlp, paragraph, exact_span):
+    """Tokenizes a SQuAD paragraph and locates the answers.
+
+    The context, the questions and the answers are tokenized with
+    a single CoreNLP request.
+
+    Returns
+    -------
+    context
+        The list of context tokens.
+    qas
+        A list of `(question, q_id, answer_begins, answer_ends)` tuples,
+        one for each question. If the answers could not be located,
+        `answer_begins` and `answer_ends` are `None`.
+    num_issues
+        The number of questions for which the answers could not be located.
+
+    """
+    texts = [paragraph['context']]
+    for qa in paragraph['qas']:
+        texts.append(qa['question'])
+        texts.extend(answer['text'] for answer in qa['answers'])
+    tokenized = corenlp.tokenize_many(texts)
+    context, context_positions = tokenized[0]
+    # maps character offsets to token positions
+    token_index = {position: i for i, position in enumerate(context_positions)}
+
+    relaxed_begins = {}
+    if not exact_span:
+        # For the answers that do not start at a token boundary,
+        # look for the tokenized answer in the context and take
+        # the occurrence closest to the answer start.
+        unaligned = []
+        next_text = 1
+        for qa in paragraph['qas']:
+            for answer in qa['answers']:
+                next_text += 1
+                if answer['answer_start'] not in token_index:
+                    unaligned.append((next_text, answer['answer_start']))
+            next_text += 1
+        occurrences = _find_sublists(
+            context, [tokenized[text_index][0] for text_index, _ in unaligned])
+        for (text_index, start), indices in zip(unaligned, occurrences):
+            if indices:
+                relaxed_begins[text_index] = min(
+                    indices, key=lambda i: abs(context_positions[i] - start))
+
+    qas = []
+    num_issues = 0
+    next_text = 1
+    for qa in paragraph['qas']:
+        question, _ = tokenized[next_text]
+        answers_tokenized = tokenized[next_text + 1:next_text + 1 + len(qa['answers'])]
+        answer_text_indices = range(next_text + 1, next_text + 1 + len(qa['answers']))
+        next_text += 1 + len(qa['answers'])
+        try:
+            answer_begins = []
+            answer_ends = []
+
+            for answer, (answer_text, _), text_index in zip(
+                    qa['answers'], answers_tokenized, answer_text_indices):
+                start = answer['answer_start']
+                assert (paragraph['context'][start:start + len(answer['text'])]
+                        == answer['text'])
+                begin = token_index.get(start)
+                if begin is None:
+                    if exact_span:
+                        raise ValueError("{} is not a starting position of a token".format(start))
+                    begin = relaxed_begins.get(text_index)
+                if begin is None:
+                    logger.error("{} is not a starting position of a token".format(start))
+                    # just don't add this rubbish to the training set
+                    # and everything will be ok
+                    begin = 0
+
+                end = begin + len(answer_text)
+                answer_begins.append(begin)
+                answer_ends.append(end)
+            qas.append((question, qa['id'], answer_begins, answer_ends))
+        except ValueError:
+            logger.error("tokenized context: {}".format(zip(context, context_positions)))
+            logger.error("qa: {}".format(qa))
+            traceback.print_exc()
+            qas.append((question, qa['id'], None, None))
+            num_issues += 1
+    return context, qas, num_issues
+
+
+_worker_corenlp = None
+
+def _init_squad_worker(urls):
+    global _worker_corenlp
+    _worker_corenlp = StanfordCoreNLP(urls.get())
+
+
+def _process_squad_paragraph(args):
+    return _squad_paragraph_to_examples(_worker_corenlp, *args)
+
+
 def squad_to_h5py_dataset(squad_path, dst_path, corenlp_url,
                           exact_span=True):
+    """Converts a SQuAD-formatted JSON file into HDF5.
+
+    corenlp_url
+        Either a URL of a CoreNLP server or a list of them. For a list
+        the paragraphs are tokenized in parallel by one worker process per
+        URL. The same URL can be used several times.
+
+    """
     data = json.load(open(squad_path))
     data = data['data']
 
@@ -62,8 +246,21 @@ def squad_to_h5py_dataset(squad_path, dst_path, corenlp_url,
         text.extend(list_)
         return len(text) - len(list_), len(text)
 
-    corenlp = StanfordCoreNLP(corenlp_url)
-
+    paragraphs = ((paragraph, exact_span)
+                  for article in data for paragraph in article['paragraphs'])
+    urls = [corenlp_url] if isinstance(corenlp_url, basestring) else corenlp_url
+    pool = None
+    if len(urls) > 1:
+        url_queue = multiprocessing.Queue()
+        for url in urls:
+            url_queue.put(url)
+        pool = multiprocessing.Pool(len(urls), _init_squad_worker, (url_queue,))
+        # imap returns the results in the order of the paragraphs
+        results = pool.imap(_process_squad_paragraph, paragraphs)
+    else:
+        corenlp = StanfordCoreNLP(urls[0])
+        results = (_squad_paragraph_to_examples(corenlp, *args)
+                   for args in paragraphs)
 
     all_contexts = []
     all_questions = []
@@ -72,47 +269,25 @@ def squad_to_h5py_dataset(squad_path, dst_path, corenlp_url,
     all_answer_ends = []
 
     num_issues = 0
-    for article in data:
-        for paragraph in article['paragraphs']:
-            context, context_positions = corenlp.tokenize(paragraph['context'])
+    try:
+        for context, qas, paragraph_issues in results:
             context_begin, context_end = add_text(context)
-
-            for qa in paragraph['qas']:
-                try:
-                    question, _ = corenlp.tokenize(qa['question'])
-                    question_begin, question_end = add_text(question)
-                    answer_begins = []
-                    answer_ends = []
-
-                    for answer in qa['answers']:
-                        start = answer['answer_start']
-                        assert (paragraph['context'][start:start + len(answer['text'])]
-                                == answer['text'])
-                        answer_text, _ = corenlp.tokenize(answer['text'])
-                        try:
-                            begin = context_positions.index(answer['answer_start'])
-                        except ValueError:
-                            if exact_span:
-                                raise
-                            logger.error("{} is not a starting position of a token".format(begin))
-                            # just don't add this rubbish to the training set
-                            # and everything will be ok
-                            begin = 0
-
-                        end = begin + len(answer_text)
-                        answer_begins.append(begin)
-                        answer_ends.append(end)
-
-                    all_contexts.append((context_begin, context_end))
-                    all_questions.append((question_begin, question_end))
-                    all_q_ids.append(qa['id'])
-                    all_answer_begins.append(answer_begins)
-                    all_answer_ends.append(answer_ends)
-                except ValueError:
-                    logger.error("tokenized context: {}".format(zip(context, context_positions)))
-                    logger.error("qa: {}".format(qa))
-                    traceback.print_exc()
-                    num_issues += 1
+            for question, q_id, answer_begins, answer_ends in qas:
+                question_begin, question_end = add_text(question)
+                if answer_begins is None:
+                    continue
+                all_contexts.append((context_begin, context_end))
+                all_questions.append((question_begin, question_end))
+                all_q_ids.append(q_id)
+                all_answer_begins.append(answer_begins)
+                all_answer_ends.append(answer_ends)
+            num_issues += paragraph_issues
+        if pool:
+            pool.close()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
     if num_issues:
         logger.error("there were {} issues".format(num_issues))
 
@@ -145,65 +320,146 @@ def squad_to_h5py_dataset(squad_path, dst_path, corenlp_url,
     dst.close()
 
 
-def add_words_ids_to_squad(h5_file, vocab):
+def _recreate_dataset(dst, name, *args, **kwargs):
+    """Creates a dataset, replacing the old one if it exists.
+
+    Allows to digitize the same file again after a vocabulary change.
+
+    """
+    if name in dst:
+        del dst[name]
+    return dst.create_dataset(name, *args, **kwargs)
+
+
+def _add_vocab(dst, vocab):
+    unicode_dtype = h5py.special_dtype(vlen=unicode)
+    _recreate_dataset(dst, 'vocab_words', (vocab.size(),), unicode_dtype)
+    _recreate_dataset(dst, 'vocab_freqs', (vocab.size(),), 'int64')
+    dst['vocab_words'][:] = vocab.words
+    dst['vocab_freqs'][:] = vocab.frequencies
+
+
+_worker_vocab = None
+
+def _init_digitize_worker(vocab):
+    global _worker_vocab
+    _worker_vocab = vocab
+
+
+def _digitize_chunk(chunk):
+    key, words = chunk
+    return key, _worker_vocab.words_to_ids(words)
+
+
+def _digitize_chunks(vocab, chunks, num_workers=1):
+    """Digitizes an iterable of `(key, words)` chunks.
+
+    Yields `(key, word_ids)` pairs in the original order. With
+    `num_workers` > 1 the lookups are done by a pool of processes,
+    but still at most `num_workers` chunks are kept in memory.
+
+    """
+    if num_workers <= 1:
+        _init_digitize_worker(vocab)
+        for chunk in chunks:
+            yield _digitize_chunk(chunk)
+        return
+    pool = multiprocessing.Pool(num_workers, _init_digitize_worker, (vocab,))
+    try:
+        chunks = iter(chunks)
+        while True:
+            group = list(itertools.islice(chunks, num_workers))
+            if not group:
+                break
+            for result in pool.map(_digitize_chunk, group):
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def add_words_ids_to_squad(h5_file, vocab, chunk_size=DIGITIZE_CHUNK_SIZE,
+                           num_workers=1):
     """Digitizes test with a vocabulary.
 
-    Also saves the vocabulary into the hdf5 file.
+    Also saves the vocabulary into the hdf5 file. The text is
+    processed in chunks of `chunk_size` words.
 
     """
     with h5py.File(h5_file, 'a') as dst:
-        unicode_dtype = h5py.special_dtype(vlen=unicode)
-        dst.create_dataset('text_ids', (dst['text'].shape[0],), 'int64')
-        dst.create_dataset('vocab_words', (vocab.size(),), unicode_dtype)
-        dst.create_dataset('vocab_freqs', (vocab.size(),), 'int64')
-        dst['text_ids'][:] = map(vocab.word_to_id, dst['text'][:])
-        dst['vocab_words'][:] = vocab.words
-        dst['vocab_freqs'][:] = vocab.frequencies
+        text = dst['text']
+        num_words = text.shape[0]
+        text_ids = _recreate_dataset(dst, 'text_ids', (num_words,), 'int64')
+        _add_vocab(dst, vocab)
+
+        def read_chunks():
+            for begin in range(0, num_words, chunk_size):
+                yield begin, text[begin:begin + chunk_size]
+        for begin, ids in _digitize_chunks(vocab, read_chunks(), num_workers):
+            text_ids[begin:begin + len(ids)] = ids
 
 
 ### SNLI ###
 
 SNLI_LABEL2INT = {"neutral": 1, "entailment": 2, "contradiction": 0}
 
-def add_word_ids_to_snli(h5_file, vocab):
+def add_word_ids_to_snli(h5_file, vocab, chunk_size=DIGITIZE_CHUNK_SIZE,
+                         num_workers=1):
+    """Digitizes SNLI sentences with a vocabulary.
+
+    The sentences are read `chunk_size` at a time, the words of a
+    chunk are digitized at once and written into preallocated datasets.
+
+    """
     with h5py.File(h5_file, 'a') as dst:
         N = len(dst['sentence1'])
         assert len(dst['sentence2']) == N
 
-        dst.create_dataset('vocab_words', (vocab.size(),),  h5py.special_dtype(vlen=unicode))
-        dst.create_dataset('vocab_freqs', (vocab.size(),), 'int64')
-        dst['vocab_words'][:] = vocab.words
-        dst['vocab_freqs'][:] = vocab.frequencies
-
-        dtype = h5py.special_dtype(vlen=np.dtype('int32'))
-        sentence1_ds = dst.create_dataset('sentence1_ids', (N, ), dtype=dtype)
-        sentence2_ds = dst.create_dataset('sentence2_ids', (N, ), dtype=dtype)
+        _add_vocab(dst, vocab)
+        # the old ids have to go before the scales attached to them
+        for name in ['sentence1_ids', 'sentence2_ids']:
+            if name in dst:
+                del dst[name]
 
         ### h5py nonsense ###
-        sentence1_ds_shapes = dst.create_dataset('sentence1_ids_shapes', (N, 1), dtype=("int"))
-        sentence2_ds_shapes = dst.create_dataset('sentence2_ids_shapes', (N, 1), dtype=("int"))
-        ds_shape_labels = dst.create_dataset('ds_ids_shape_labels', (1, ), dtype=("S20"))
-        ### h5py nonsense ###
-
-        sentence1_ds[:] = np.array([[vocab.word_to_id(w) for w in s] for s in dst['sentence1'][:]])
-        sentence2_ds[:] = np.array([[vocab.word_to_id(w) for w in s] for s in dst['sentence2'][:]])
-
-        ### h5py nonsense ###
-        sentence1_ds_shapes[:] = np.array([np.array(x).shape for x in dst['sentence1'][:]])
-        sentence2_ds_shapes[:] = np.array([np.array(x).shape for x in dst['sentence2'][:]])
+        ds_shape_labels = _recreate_dataset(dst, 'ds_ids_shape_labels', (1, ), dtype=("S20"))
         ds_shape_labels[:] = np.array(['sentence_len'])
-
-        sentence1_ds.dims.create_scale(sentence1_ds_shapes, 'shapes')
-        sentence1_ds.dims[0].attach_scale(sentence1_ds_shapes)
-        sentence1_ds.dims.create_scale(ds_shape_labels, 'shape_labels')
-        sentence1_ds.dims[0].attach_scale(ds_shape_labels)
-
-        sentence2_ds.dims.create_scale(sentence2_ds_shapes, 'shapes')
-        sentence2_ds.dims[0].attach_scale(sentence2_ds_shapes)
-        sentence2_ds.dims.create_scale(ds_shape_labels, 'shape_labels')
-        sentence2_ds.dims[0].attach_scale(ds_shape_labels)
         ### h5py nonsense ###
 
+        dtype = h5py.special_dtype(vlen=np.dtype('int32'))
+        for name in ['sentence1', 'sentence2']:
+            sentences = dst[name]
+            ids_ds = _recreate_dataset(dst, name + '_ids', (N, ), dtype=dtype)
+            ### h5py nonsense ###
+            ids_ds_shapes = _recreate_dataset(dst, name + '_ids_shapes', (N, 1), dtype=("int"))
+            ### h5py nonsense ###
+
+            def read_chunks():
+                for begin in range(0, N, chunk_size):
+                    chunk = sentences[begin:begin + chunk_size]
+                    lengths = np.array([len(s) for s in chunk], dtype='int64')
+                    words = (np.concatenate(list(chunk)) if lengths.sum()
+                             else np.zeros((0,), dtype='S20'))
+                    yield (begin, lengths), words
+
+            for (begin, lengths), ids in _digitize_chunks(
+                    vocab, read_chunks(), num_workers):
+                ids = ids.astype('int32')
+                sentence_ids = np.empty((len(lengths),), dtype=object)
+                for i, sentence in enumerate(np.split(ids, np.cumsum(lengths)[:-1])):
+                    sentence_ids[i] = sentence
+                end = begin + len(lengths)
+                ids_ds[begin:end] = sentence_ids
+                ids_ds_shapes[begin:end] = lengths[:, None]
+
+            ### h5py nonsense ###
+            ids_ds.dims.create_scale(ids_ds_shapes, 'shapes')
+            ids_ds.dims[0].attach_scale(ids_ds_shapes)
+            ids_ds.dims.create_scale(ds_shape_labels, 'shape_labels')
+            ids_ds.dims[0].attach_scale(ds_shape_labels)
+            ### h5py nonsense ###
+
         dst.attrs['split'] = H5PYDataset.create_split_array({
             'all': {
                 'sentence1': (0, N),
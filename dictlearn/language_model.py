@@ -1,6 +1,12 @@
 """A dictionary-equipped language model."""
+import numpy
 import theano
 from theano import tensor
+from theano.ifelse import ifelse
+from theano.sandbox.rng_mrg import MRG_RandomStreams
+
+from blocks.config import config
+from blocks.utils import shared_floatx_zeros
 
 from blocks.bricks import (Initializable, Linear, NDimensionalSoftmax, MLP,
                            Tanh, Rectifier)
@@ -9,13 +15,13 @@ from blocks.bricks.recurrent import LSTM
 from blocks.bricks.lookup import LookupTable
 from blocks.initialization import Constant
 
-from dictlearn.theano_util import unk_ratio
+from dictlearn.theano_util import unk_ratio, is_required
 from dictlearn.ops import WordToIdOp, RetrievalOp, WordToCountOp
 from dictlearn.aggregation_schemes import Perplexity
-from dictlearn.stuff import DebugLSTM
+from dictlearn.stuff import PeepholeLSTM, DebugLSTM
 from dictlearn.util import masked_root_mean_square
 from dictlearn.lookup import (LSTMReadDefinitions, MeanPoolReadDefinitions,
-                              MeanPoolCombiner)
+                              MeanPoolCombiner, DefinitionCache)
 
 
 
@@ -37,7 +43,20 @@ class LanguageModel(Initializable):
     retrieval
         The dictionary retrieval algorithm. If `None`, the language model
         does not use any dictionary.
-    def_reader: either 'LSTM' or 'mean'
+    def_reader: either 'LSTM', 'mean' or 'sparse_mean'
+    def_reader_buckets : int
+        The number of length buckets for the 'LSTM' definition reader.
+    def_cache_max_age : int
+        If positive, the definition embeddings are cached for this
+        number of updates, see `DefinitionCache`.
+    num_sampled : int
+        The number of negative samples of the sampled softmax that
+        `apply` uses when called with `sampled=True`. The output
+        vocabulary has to be sorted by decreasing frequency.
+    debug_rnn : bool
+        If `True`, the main RNN is a `DebugLSTM`, which outputs its
+        gates as auxiliary variables at the cost of extra memory.
+        It has the same parameters as the default `PeepholeLSTM`.
     standalone_def_rnn : bool
         If `True`, a standalone RNN with separate word embeddings is used
         to embed definition. If `False` the language model is reused.
@@ -62,6 +81,10 @@ class LanguageModel(Initializable):
                  compose_type='sum',
                  very_rare_threshold=[10],
                  cache_size=0,
+                 def_reader_buckets=1,
+                 def_cache_max_age=0,
+                 num_sampled=0,
+                 debug_rnn=False,
                  **kwargs):
         # TODO(tombosc): document
         if emb_dim == 0:
@@ -75,6 +98,8 @@ class LanguageModel(Initializable):
 
         if (num_input_words != def_num_input_words) and (not standalone_def_lookup):
             raise NotImplementedError()
+        if cache_size > 0 and def_cache_max_age > 0:
+            raise ValueError("cache_size and def_cache_max_age can not be used together")
 
         self._very_rare_threshold = very_rare_threshold
         self._num_input_words = num_input_words
@@ -83,6 +108,9 @@ class LanguageModel(Initializable):
         self._retrieval = retrieval
         self._disregard_word_embeddings = disregard_word_embeddings
         self._compose_type = compose_type
+        self._num_sampled = num_sampled
+        if num_sampled:
+            self._rng = MRG_RandomStreams(config.default_seed)
 
         self._word_to_id = WordToIdOp(self._vocab)
         self._word_to_count = WordToCountOp(self._vocab)
@@ -96,13 +124,20 @@ class LanguageModel(Initializable):
                                       name='cache_def_embeddings')
             children.append(self._cache)
 
+        self._def_cache = None
         if self._retrieval:
             self._retrieve = RetrievalOp(retrieval)
 
         self._main_lookup = LookupTable(self._num_input_words, emb_dim, name='main_lookup')
         self._main_fork = Linear(emb_dim, 4 * dim, name='main_fork')
-        self._main_rnn = DebugLSTM(dim, name='main_rnn') # TODO(tombosc): use regular LSTM?
+        main_rnn_class = DebugLSTM if debug_rnn else PeepholeLSTM
+        self._main_rnn = main_rnn_class(dim, name='main_rnn')
         children.extend([self._main_lookup, self._main_fork, self._main_rnn])
+        # The states carried between the batches of stateful training,
+        # empty when there is nothing to carry
+        self._dim = dim
+        self._carried_states = shared_floatx_zeros((0, dim), name='carried_states')
+        self._carried_cells = shared_floatx_zeros((0, dim), name='carried_cells')
         if self._retrieval:
             if standalone_def_lookup:
                 lookup = None
@@ -118,13 +153,15 @@ class LanguageModel(Initializable):
                     fork_and_rnn = (self._main_fork, self._main_rnn)
                 self._def_reader = LSTMReadDefinitions(def_num_input_words, emb_def_dim,
                                                        dim, vocab, lookup,
-                                                       fork_and_rnn, cache=self._cache)
+                                                       fork_and_rnn, cache=self._cache,
+                                                       num_buckets=def_reader_buckets)
             
-            elif def_reader == 'mean':
+            elif def_reader in ['mean', 'sparse_mean']:
                 self._def_reader = MeanPoolReadDefinitions(def_num_input_words, emb_def_dim,
                                                            dim, vocab, lookup, 
                                                            translate=(emb_def_dim!=dim), 
-                                                           normalize=False)
+                                                           normalize=False,
+                                                           sparse=(def_reader == 'sparse_mean'))
             else:
                 raise Exception("def reader not understood")
 
@@ -133,6 +170,12 @@ class LanguageModel(Initializable):
 
             children.extend([self._def_reader, self._combiner])
 
+            if def_cache_max_age > 0:
+                self._def_cache = DefinitionCache(
+                    self._def_reader, self._combiner, vocab.size(),
+                    def_cache_max_age, vocab.unk, name='def_cache')
+                children.append(self._def_cache)
+
         self._pre_softmax = Linear(dim, self._num_output_words)
         self._softmax = NDimensionalSoftmax()
         children.extend([self._pre_softmax, self._softmax])
@@ -144,8 +187,9 @@ class LanguageModel(Initializable):
         if self._cache:
             self._cache.weights_init = Constant(0.)
 
-    def set_def_embeddings(self, embeddings):
-        self._def_reader._def_lookup.parameters[0].set_value(embeddings.astype(theano.config.floatX))
+    def set_def_embeddings(self, embeddings, borrow=False):
+        self._def_reader._def_lookup.parameters[0].set_value(
+            embeddings.astype(theano.config.floatX, copy=False), borrow=borrow)
 
     def get_def_embeddings_params(self):
         return self._def_reader._def_lookup.parameters[0]
@@ -153,17 +197,87 @@ class LanguageModel(Initializable):
     def get_cache_params(self):
         return self._cache.W
 
-    def add_perplexity_measure(self, application_call, minus_logs, mask, name):
+    def reset_states(self):
+        """Forgets the states carried by stateful training."""
+        for carried in [self._carried_states, self._carried_cells]:
+            carried.set_value(
+                numpy.zeros((0, self._dim), dtype=theano.config.floatX))
+
+    def _initial_states(self, batch_size):
+        # The shared variables are not parameters, so the gradient is
+        # truncated at the batch boundary
+        initial = []
+        for carried in [self._carried_states, self._carried_cells]:
+            initial.append(ifelse(
+                tensor.eq(carried.shape[0], batch_size),
+                carried,
+                tensor.zeros((batch_size, self._dim), dtype=carried.dtype)))
+        return initial
+
+    def perplexity_names(self):
+        """The names of the perplexity measures of the full softmax."""
+        names = ["", "after_mis_word_embs", "after_word_embs"]
+        names.extend("after_very_rare_" + str(threshold)
+                     for threshold in self._very_rare_threshold)
+        if self._retrieval:
+            names.append("after_def_embs")
+            names.extend("after_def_very_rare_" + str(threshold)
+                         for threshold in self._very_rare_threshold)
+        return ["perplexity_" + name for name in names]
+
+    def add_perplexity_measure(self, application_call, minus_logs, mask, name,
+                               auxiliary=None):
         costs = (minus_logs * mask).sum(axis=0)
-        perplexity = tensor.exp(costs.sum() / mask.sum())
-        perplexity.tag.aggregation_scheme = Perplexity(
-            costs.sum(), mask.sum())
         full_name = "perplexity_" + name
-        application_call.add_auxiliary_variable(perplexity, name=full_name)
+        if is_required(auxiliary, full_name):
+            perplexity = tensor.exp(costs.sum() / mask.sum())
+            perplexity.tag.aggregation_scheme = Perplexity(
+                costs.sum(), mask.sum())
+            application_call.add_auxiliary_variable(perplexity, name=full_name)
         return costs
 
+    def sampled_minus_logs(self, states, targets):
+        """The sampled softmax loss.
+
+        The negative words are shared by the whole batch and drawn with
+        replacement from a log-uniform (Zipfian) distribution over the
+        output vocabulary. The logits are corrected by the log expected
+        counts of the words, and the samples that happen to be the
+        target are ignored.
+
+        states
+            The RNN states of shape (T, B, dim).
+        targets
+            The target words of shape (T, B).
+
+        """
+        floatX = theano.config.floatX
+        W, b = self._pre_softmax.W, self._pre_softmax.b
+        log_range = numpy.log(self._num_output_words + 1)
+        samples = tensor.floor(tensor.exp(
+            self._rng.uniform((self._num_sampled,)) * log_range)).astype('int64') - 1
+        samples = tensor.clip(samples, 0, self._num_output_words - 1)
+
+        def log_expected_count(ids):
+            ids = ids.astype(floatX)
+            return tensor.log(
+                self._num_sampled * tensor.log((ids + 2) / (ids + 1)) / log_range)
+
+        true_logits = ((states * W.T[targets]).sum(axis=2) + b[targets]
+                       - log_expected_count(targets))
+        sampled_logits = (tensor.dot(states, W[:, samples]) + b[samples]
+                          - log_expected_count(samples))
+        hits = tensor.eq(targets[:, :, None], samples[None, None, :])
+        sampled_logits = sampled_logits - 1e6 * hits
+        logits = tensor.concatenate([true_logits[:, :, None], sampled_logits], axis=2)
+        max_logits = logits.max(axis=2)
+        log_normalizer = tensor.log(
+            tensor.exp(logits - max_logits[:, :, None]).sum(axis=2)) + max_logits
+        return log_normalizer - true_logits
+
     @application
-    def apply(self, application_call, words, mask):
+    def apply(self, application_call, words, mask, sampled=False, auxiliary=None,
+              stateful=False):
         """Compute the log-likelihood for a batch of sequences.
 
         words
@@ -173,15 +287,34 @@ class LanguageModel(Initializable):
             should be transposed at some point.
         mask
             A float32 matrix of shape (B, T). Zeros indicate the padding.
+        sampled
+            If `True`, the cost is the sampled softmax loss and the only
+            perplexity measure is `perplexity_sampled`, which is not the
+            real perplexity.
+        auxiliary
+            The names of the auxiliary variables to build, e.g.
+            `perplexity_names()`. By default all of them are built.
+        stateful
+            If `True`, the main RNN starts from the states carried from
+            the previous batch and the returned updates carry the states
+            to the next one. The i-th sequence of a batch must continue
+            the i-th sequence of the previous batch, sharing one token
+            with it, see `StatefulSpanScheme`. Call `reset_states` to
+            start from zero states again.
 
         """
+        def required(name):
+            return is_required(auxiliary, name)
+
         if self._retrieval:
             defs, def_mask, def_map = self._retrieve(words)
-            def_embeddings = self._def_reader.apply(defs, def_mask)
+            if not self._def_cache:
+                def_embeddings = self._def_reader.apply(defs, def_mask, auxiliary=auxiliary)
 
             # Auxililary variable for debugging
-            application_call.add_auxiliary_variable(
-                def_embeddings.shape[0], name="num_definitions")
+            if required("num_definitions"):
+                application_call.add_auxiliary_variable(
+                    defs.shape[0], name="num_definitions")
 
 
         word_ids = self._word_to_id(words)
@@ -192,17 +325,25 @@ class LanguageModel(Initializable):
         output_word_ids = (tensor.lt(word_ids, self._num_output_words) * word_ids
                           + tensor.ge(word_ids, self._num_output_words) * self._vocab.unk)
 
-        application_call.add_auxiliary_variable(
-            unk_ratio(input_word_ids, mask, self._vocab.unk),
-            name='unk_ratio')
+        if required('unk_ratio'):
+            application_call.add_auxiliary_variable(
+                unk_ratio(input_word_ids, mask, self._vocab.unk),
+                name='unk_ratio')
 
         # Run the main rnn with combined inputs
         word_embs = self._main_lookup.apply(input_word_ids)
-        application_call.add_auxiliary_variable(
-            masked_root_mean_square(word_embs, mask), name='word_emb_RMS')
-
-        if self._retrieval:
-            rnn_inputs, updated, positions = self._combiner.apply(word_embs, mask, def_embeddings, def_map)
+        if required('word_emb_RMS'):
+            application_call.add_auxiliary_variable(
+                masked_root_mean_square(word_embs, mask), name='word_emb_RMS')
+
+        if self._def_cache:
+            def_mean = self._def_cache.apply(defs, def_mask, [word_ids], [def_map],
+                                             auxiliary=auxiliary)
+            rnn_inputs = self._combiner.apply_precomputed(
+                word_embs, mask, def_mean, auxiliary=auxiliary)
+        elif self._retrieval:
+            rnn_inputs, updated, positions = self._combiner.apply(
+                word_embs, mask, def_embeddings, def_map, auxiliary=auxiliary)
         else:
             rnn_inputs = word_embs
 
@@ -213,44 +354,68 @@ class LanguageModel(Initializable):
             # computing updates for cache
             updates = [(self._cache.W, tensor.set_subtensor(self._cache.W[flat_word_ids_to_update], updated))]
 
-        application_call.add_auxiliary_variable(
-            masked_root_mean_square(word_embs, mask), name='main_rnn_in_RMS')
+        if required('main_rnn_in_RMS'):
+            application_call.add_auxiliary_variable(
+                masked_root_mean_square(word_embs, mask), name='main_rnn_in_RMS')
 
-        main_rnn_states = self._main_rnn.apply(
+        rnn_kwargs = {}
+        if stateful:
+            rnn_kwargs['states'], rnn_kwargs['cells'] = self._initial_states(
+                words.shape[0])
+        main_rnn_states, main_rnn_cells = self._main_rnn.apply(
             tensor.transpose(self._main_fork.apply(rnn_inputs), (1, 0, 2)),
-            mask=mask.T)[0]
+            mask=mask.T, **rnn_kwargs)[:2]
+        if stateful:
+            # The last token is read again as the first one of the
+            # next batch
+            updates.extend([(self._carried_states, main_rnn_states[-2]),
+                            (self._carried_cells, main_rnn_cells[-2])])
 
         # The first token is not predicted
-        logits = self._pre_softmax.apply(main_rnn_states[:-1])
         targets = output_word_ids.T[1:]
-        out_softmax = self._softmax.apply(logits, extra_ndim=1)
-        application_call.add_auxiliary_variable(
-                out_softmax.copy(), name="proba_out")
+        targets_mask = mask.T[1:]
+        if sampled:
+            if not self._num_sampled:
+                raise ValueError("num_sampled is required for the sampled softmax")
+            minus_logs = self.sampled_minus_logs(main_rnn_states[:-1], targets)
+            costs = self.add_perplexity_measure(
+                application_call, minus_logs, targets_mask, "sampled", auxiliary)
+            return costs, updates
+
+        logits = self._pre_softmax.apply(main_rnn_states[:-1])
+        if required("proba_out"):
+            out_softmax = self._softmax.apply(logits, extra_ndim=1)
+            application_call.add_auxiliary_variable(
+                    out_softmax.copy(), name="proba_out")
         minus_logs = self._softmax.categorical_cross_entropy(
             targets, logits, extra_ndim=1)
 
-        targets_mask = mask.T[1:]
         costs = self.add_perplexity_measure(application_call, minus_logs,
                                targets_mask,
-                               "")
+                               "", auxiliary)
 
         missing_embs = tensor.eq(input_word_ids, self._vocab.unk).astype('int32') # (bs, L)
         self.add_perplexity_measure(application_call, minus_logs,
                                targets_mask * missing_embs.T[:-1],
-                               "after_mis_word_embs")
+                               "after_mis_word_embs", auxiliary)
         self.add_perplexity_measure(application_call, minus_logs,
                                targets_mask * (1-missing_embs.T[:-1]),
-                               "after_word_embs")
+                               "after_word_embs", auxiliary)
 
-        word_counts = self._word_to_count(words)
+        rare_names = ["perplexity_after_very_rare_" + str(threshold)
+                      for threshold in self._very_rare_threshold]
+        rare_names += ["perplexity_after_def_very_rare_" + str(threshold)
+                       for threshold in self._very_rare_threshold]
         very_rare_masks = []
-        for threshold in self._very_rare_threshold:
-            very_rare_mask = tensor.lt(word_counts, threshold).astype('int32')
-            very_rare_mask = targets_mask * (very_rare_mask.T[:-1])
-            very_rare_masks.append(very_rare_mask)
-            self.add_perplexity_measure(application_call, minus_logs,
-                                   very_rare_mask,
-                                   "after_very_rare_" + str(threshold))
+        if any(required(name) for name in rare_names):
+            word_counts = self._word_to_count(words)
+            for threshold in self._very_rare_threshold:
+                very_rare_mask = tensor.lt(word_counts, threshold).astype('int32')
+                very_rare_mask = targets_mask * (very_rare_mask.T[:-1])
+                very_rare_masks.append(very_rare_mask)
+                self.add_perplexity_measure(application_call, minus_logs,
+                                       very_rare_mask,
+                                       "after_very_rare_" + str(threshold), auxiliary)
 
         if self._retrieval:
             has_def = tensor.zeros_like(output_word_ids)
@@ -258,14 +423,15 @@ class LanguageModel(Initializable):
             mask_targets_has_def = has_def.T[:-1] * targets_mask # (L-1, bs)
             self.add_perplexity_measure(application_call, minus_logs,
                                    mask_targets_has_def,
-                                   "after_def_embs")
+                                   "after_def_embs", auxiliary)
 
             for thresh, very_rare_mask in zip(self._very_rare_threshold, very_rare_masks):
                 self.add_perplexity_measure(application_call, minus_logs,
                                    very_rare_mask * mask_targets_has_def,
-                                   "after_def_very_rare_" + str(thresh))
+                                   "after_def_very_rare_" + str(thresh), auxiliary)
 
-            application_call.add_auxiliary_variable(
-                    mask_targets_has_def.T, name='mask_def_emb')
+            if required('mask_def_emb'):
+                application_call.add_auxiliary_variable(
+                        mask_targets_has_def.T, name='mask_def_emb')
 
         return costs, updates
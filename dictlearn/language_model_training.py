@@ -16,7 +16,7 @@ from theano import tensor
 import blocks
 from blocks.initialization import Uniform, Constant
 from blocks.algorithms import (
-    Adam, GradientDescent, Adam, StepClipping, CompositeRule)
+    Adam, Adam, StepClipping, CompositeRule)
 from blocks.graph import ComputationGraph
 from blocks.model import Model
 from blocks.filter import VariableFilter
@@ -40,11 +40,15 @@ from dictlearn.theano_util import parameter_stats
 from dictlearn.data import LanguageModellingData
 from dictlearn.extensions import (
     DumpTensorflowSummaries, StartFuelServer, LoadNoUnpickling,
-    RetrievalPrintStats, IntermediateCheckpoint)
+    RetrievalPrintStats, IntermediateCheckpoint, LastBatchMonitoring,
+    ResetStates)
 
 from dictlearn.language_model import LanguageModel
 from dictlearn.retrieval import Retrieval, Dictionary
 from dictlearn.vocab import Vocabulary
+from dictlearn.embedding_store import EmbeddingStore, sync_references
+from dictlearn.sparse_updates import rules_from_config, sparse_updates
+from dictlearn.function_cache import CachedGradientDescent
 
 from tests.util import temporary_content_path
 
@@ -82,7 +86,7 @@ def initialize_data_and_model(config):
     elif c['embedding_path']:
         assert(c['dict_path'])
         emb_full_path = os.path.join(fuel_path, c['embedding_path'])
-        embedding_matrix = numpy.load(emb_full_path)
+        embedding_store = EmbeddingStore.get(emb_full_path)
         dict_full_path = os.path.join(fuel_path, c['dict_path'])
         dict_ = Dictionary(dict_full_path) # should be key=value=word
         if not c['standalone_def_lookup']:
@@ -109,12 +113,19 @@ def initialize_data_and_model(config):
                        c['compose_type'],
                        very_rare_threshold=c['very_rare_threshold'],
                        cache_size=c['cache_size'],
+                       def_reader_buckets=c['def_reader_buckets'],
+                       def_cache_max_age=c['def_cache_max_age'],
+                       num_sampled=c['num_sampled'],
+                       debug_rnn=c['debug_rnn'],
                        weights_init=Uniform(width=0.1),
                        biases_init=Constant(0.))
     lm.initialize()
 
     if c['embedding_path']:
-        lm.set_def_embeddings(embedding_matrix)
+        # the embeddings are frozen, no need for a private copy
+        lm.set_def_embeddings(
+            embedding_store.as_dtype(theano.config.floatX, frozen=True),
+            borrow=True)
         logger.debug("Embeddings loaded")
 
     return (data, lm, retrieval)
@@ -135,6 +146,11 @@ def train_language_model(new_training_job, config, save_path, params,
     state_path = os.path.join(save_path, 'training_state.tar')
     stream_path = os.path.join(save_path, 'stream.pkl')
     best_tar_path = os.path.join(save_path, "best_model.tar")
+    if c['embedding_path']:
+        sync_references(
+            save_path,
+            {'embedding_path': os.path.join(fuel.config.data_path[0], c['embedding_path'])},
+            new_training_job)
 
     words = tensor.ltensor3('words')
     words_mask = tensor.matrix('words_mask')
@@ -154,13 +170,35 @@ def train_language_model(new_training_job, config, save_path, params,
         with open(params) as src:
             cg.set_parameter_values(load_parameters(src))
 
+    if c['num_sampled'] or c['stateful']:
+        # the full softmax is only computed for validation, and
+        # validation sentences are read independently
+        train_costs, updates = lm.apply(words, words_mask,
+                                        sampled=bool(c['num_sampled']),
+                                        stateful=c['stateful'])
+        train_cost = rename(train_costs.mean(), 'mean_cost')
+        train_cg = ComputationGraph(train_cost)
+    else:
+        train_cost = cost
+        train_cg = cg
+
     length = rename(words.shape[1], 'length')
     perplexity, = VariableFilter(name='perplexity')(cg)
     perplexities = VariableFilter(name_regex='perplexity.*')(cg)
     monitored_vars = [length, cost] + perplexities
+    train_monitored_vars = [length, train_cost]
+    # The diagnostics are either computed by the training function at
+    # every batch or by a separate function every `mon_freq_train` batches
+    if c['monitor_every_batch']:
+        batch_monitored_vars = train_monitored_vars
+    else:
+        batch_monitored_vars = []
+    batch_monitored_vars.extend(VariableFilter(name_regex='perplexity.*')(train_cg))
     if c['dict_path']:
         num_definitions, = VariableFilter(name='num_definitions')(cg)
         monitored_vars.extend([num_definitions])
+        train_num_definitions, = VariableFilter(name='num_definitions')(train_cg)
+        batch_monitored_vars.extend([train_num_definitions])
 
     parameters = cg.get_parameter_dict()
     trained_parameters = parameters.values()
@@ -178,11 +216,23 @@ def train_language_model(new_training_job, config, save_path, params,
         trained_parameters = [p for p in trained_parameters
                               if not p == lm.get_cache_params()]
 
+    sparse_rules = rules_from_config(
+        parameters, c['sparse_updates'], c['learning_rate'], beta1=c['momentum'])
+    sparse_parameters, lookup_updates = sparse_updates(
+        train_cost, {p: rule for p, rule in sparse_rules.items() if p in trained_parameters},
+        clip_threshold=c['grad_clip_threshold'])
+    trained_parameters = [p for p in trained_parameters
+                          if p not in sparse_parameters]
+
+    def status(parameter):
+        if parameter in sparse_parameters:
+            return 'sparse'
+        return 'trained' if parameter in trained_parameters else 'frozen'
     logger.info("Cost parameters" + "\n" +
                 pprint.pformat(
                     [" ".join((
                        key, str(parameters[key].get_value().shape),
-                       'trained' if parameters[key] in trained_parameters else 'frozen'))
+                       status(parameters[key])))
                      for key in sorted(parameters.keys())],
                     width=120))
 
@@ -191,33 +241,45 @@ def train_language_model(new_training_job, config, save_path, params,
         rules.append(StepClipping(c['grad_clip_threshold']))
     rules.append(Adam(learning_rate=c['learning_rate'],
                       beta1=c['momentum']))
-    algorithm = GradientDescent(
-        cost=cost,
+    algorithm = CachedGradientDescent(
+        cost=train_cost,
         parameters=trained_parameters,
         step_rule=CompositeRule(rules))
 
-    if c['cache_size'] != 0:
+    algorithm.add_updates(lookup_updates)
+    if c['cache_size'] != 0 or c['stateful']:
         algorithm.add_updates(updates)
+    if c['def_cache_max_age']:
+        algorithm.add_updates(train_cg.updates)
 
-    train_monitored_vars = list(monitored_vars)
     if c['grad_clip_threshold']:
         train_monitored_vars.append(algorithm.total_gradient_norm)
 
-    word_emb_RMS, = VariableFilter(name='word_emb_RMS')(cg)
-    main_rnn_in_RMS, = VariableFilter(name='main_rnn_in_RMS')(cg)
-    train_monitored_vars.extend([word_emb_RMS, main_rnn_in_RMS])
+    word_emb_RMS, = VariableFilter(name='word_emb_RMS')(train_cg)
+    main_rnn_in_RMS, = VariableFilter(name='main_rnn_in_RMS')(train_cg)
+    batch_monitored_vars.extend([word_emb_RMS, main_rnn_in_RMS])
+    if c['def_cache_max_age']:
+        hit_rate, = VariableFilter(name='def_cache_hit_rate')(train_cg)
+        staleness, = VariableFilter(name='def_cache_staleness')(train_cg)
+        train_monitored_vars.extend([hit_rate, staleness])
 
     if c['monitor_parameters']:
-        train_monitored_vars.extend(parameter_stats(parameters, algorithm))
+        train_monitored_vars.extend(parameter_stats(
+            {key: p for key, p in parameters.items() if p in trained_parameters},
+            algorithm))
 
 
     # We use a completely random seed on purpose. With Fuel server
     # it's currently not possible to restore the state of the training
     # stream. That's why it's probably better to just have it stateless.
     stream_seed = numpy.random.randint(0, 10000000) if fuel_server else None
-    training_stream = data.get_stream(
-        'train', batch_size=c['batch_size'], max_length=c['max_length'],
-        seed=stream_seed)
+    if c['stateful']:
+        training_stream = data.get_stateful_stream(
+            'train', batch_size=c['batch_size'], max_length=c['max_length'])
+    else:
+        training_stream = data.get_stream(
+            'train', batch_size=c['batch_size'], max_length=c['max_length'],
+            seed=stream_seed)
     valid_stream = data.get_stream('valid', batch_size=c['batch_size_valid'],
                                 max_length=c['max_length'], seed=stream_seed)
     original_training_stream = training_stream
@@ -297,6 +359,8 @@ def train_language_model(new_training_job, config, save_path, params,
                             before_training=fuel_server),
             Timing(every_n_batches=c['mon_freq_train'])
         ]
+    if c['stateful']:
+        extensions.append(ResetStates(lm, before_epoch=True))
 
     if retrieval:
         extensions.append(
@@ -307,7 +371,13 @@ def train_language_model(new_training_job, config, save_path, params,
     extensions.extend([
         TrainingDataMonitoring(
             train_monitored_vars, prefix="train",
-            every_n_batches=c['mon_freq_train']),
+            every_n_batches=c['mon_freq_train'])])
+    if not c['monitor_every_batch']:
+        extensions.append(
+            LastBatchMonitoring(
+                batch_monitored_vars, prefix="train",
+                every_n_batches=c['mon_freq_train']))
+    extensions.extend([
         validation,
         track_the_best,
         checkpoint])
@@ -329,6 +399,9 @@ def train_language_model(new_training_job, config, save_path, params,
 
     logger.info("monitored variables during training:" + "\n" +
                 pprint.pformat(train_monitored_vars, width=120))
+    if not c['monitor_every_batch']:
+        logger.info("monitored variables on the last batch:" + "\n" +
+                    pprint.pformat(batch_monitored_vars, width=120))
     logger.info("monitored variables during valid:" + "\n" +
                 pprint.pformat(monitored_vars, width=120))
 
@@ -6,7 +6,7 @@ Idea: Then start tarining gate late?
 
 """
 from blocks.bricks import Initializable, Linear, MLP, Tanh, Rectifier
-from blocks.bricks.base import application, _variable_name
+from blocks.bricks.base import application, _variable_name, Brick
 from blocks.bricks.lookup import LookupTable
 from blocks.bricks.recurrent import LSTM
 from blocks.bricks.simple import Softmax
@@ -14,12 +14,14 @@ from blocks.bricks.bn import BatchNormalization
 from blocks.initialization import Uniform, Constant
 from blocks.bricks import Softmax, Rectifier, Logistic
 
+import numpy
 import theano
+import theano.sparse
 import theano.tensor as T
 
 from dictlearn.inits import GlorotUniform
 from dictlearn.util import masked_root_mean_square
-from dictlearn.theano_util import apply_dropout, unk_ratio
+from dictlearn.theano_util import apply_dropout, unk_ratio, is_required
 from dictlearn.ops import RetrievalOp
 
 import logging
@@ -45,12 +47,21 @@ class LSTMReadDefinitions(Initializable):
     lookup: None or LookupTable
 
     fork_and_rnn: None or tuple (Linear, RNN)
+
+    num_buckets: int, default: 1
+        If larger than 1, the definitions are sorted by length and split
+        into that many buckets of equal size. The RNN is run separately
+        for every bucket, only for as many steps as the longest definition
+        in the bucket has. The number of buckets is fixed, so the same
+        compiled graph serves all batches.
     """
     def __init__(self, num_input_words, emb_dim, dim, vocab, lookup=None,
-                 fork_and_rnn=None, cache=None, **kwargs):
+                 fork_and_rnn=None, cache=None, num_buckets=1, **kwargs):
 
         self._vocab = vocab
+        self._dim = dim
         self._cache = cache
+        self._num_buckets = num_buckets
         children = []
         if num_input_words > 0:
             logger.info("Restricting def vocab to " + str(num_input_words))
@@ -77,31 +88,55 @@ class LSTMReadDefinitions(Initializable):
 
     @application
     def apply(self, application_call,
-              defs, def_mask):
+              defs, def_mask, auxiliary=None):
         """
         Returns vector per each word in sequence using the dictionary based lookup
-        """
-        # Short listing
-        defs_sl_main = (T.lt(defs, self._num_input_words) * defs
-                   + T.ge(defs, self._num_input_words) * self._vocab.unk)
-        defs_sl_cache = (T.ge(defs, self._num_input_words) * defs
-                   + T.lt(defs, self._num_input_words) * self._vocab.unk)
 
-        application_call.add_auxiliary_variable(
-            unk_ratio(defs_sl_main, def_mask, self._vocab.unk),
-            name='def_unk_ratio')
+        `auxiliary` is the set of the auxiliary variables to build, see
+        `is_required`.
+        """
+        if is_required(auxiliary, 'def_unk_ratio'):
+            application_call.add_auxiliary_variable(
+                unk_ratio(self._shortlist(defs), def_mask, self._vocab.unk),
+                name='def_unk_ratio')
+
+        if self._num_buckets <= 1:
+            return self._read(defs, def_mask)
+
+        lengths = T.cast(def_mask.sum(axis=1), 'int64')
+        order = T.argsort(lengths)
+        num_defs = defs.shape[0]
+        bucket_states = []
+        for i in range(self._num_buckets):
+            rows = order[num_defs * i // self._num_buckets:
+                         num_defs * (i + 1) // self._num_buckets]
+            # A bucket can be empty when there are fewer definitions than
+            # buckets, in which case it is read for one step
+            bucket_length = T.max(T.concatenate([lengths[rows], [1]]))
+            bucket_states.append(self._read(defs[rows, :bucket_length],
+                                            def_mask[rows, :bucket_length]))
+        # scatter the states back to the original order
+        return T.concatenate(bucket_states)[T.argsort(order)]
+
+    def _shortlist(self, defs):
+        return (T.lt(defs, self._num_input_words) * defs
+                + T.ge(defs, self._num_input_words) * self._vocab.unk)
 
-        embedded_def_words = self._def_lookup.apply(defs_sl_main)
-        cached_embeddings = self._cache.apply(defs_sl_cache) 
-        final_embeddings = (T.lt(defs, self._num_input_words).dimshuffle(0,1,'x') * embedded_def_words
-                + T.ge(defs, self._num_input_words).dimshuffle(0, 1, 'x') * cached_embeddings)
+    def _read(self, defs, def_mask):
+        embedded_def_words = self._def_lookup.apply(self._shortlist(defs))
+        if self._cache:
+            defs_sl_cache = (T.ge(defs, self._num_input_words) * defs
+                       + T.lt(defs, self._num_input_words) * self._vocab.unk)
+            cached_embeddings = self._cache.apply(defs_sl_cache)
+            final_embeddings = (T.lt(defs, self._num_input_words).dimshuffle(0,1,'x') * embedded_def_words
+                    + T.ge(defs, self._num_input_words).dimshuffle(0, 1, 'x') * cached_embeddings)
+        else:
+            final_embeddings = embedded_def_words
 
-        def_embeddings = self._def_rnn.apply(
+        return self._def_rnn.apply(
             T.transpose(self._def_fork.apply(final_embeddings), (1, 0, 2)),
             mask=def_mask.T)[0][-1]
 
-        return def_embeddings
-
 
 class MeanPoolReadDefinitions(Initializable):
     """
@@ -119,9 +154,16 @@ class MeanPoolReadDefinitions(Initializable):
     emb_dim : int
         Dimensionality of word embeddings
 
+    sparse : bool, default: False
+        If True, definitions are pooled as a product of a sparse
+        (num_defs, vocab_size) count matrix and the embedding matrix,
+        instead of looking up a dense (num_defs, max_def_len, emb_dim)
+        tensor. The translation is then applied after pooling, which
+        gives the same result since it is linear.
+
     """
     def __init__(self, num_input_words, emb_dim, dim, vocab,
-                 lookup=None, translate=True, normalize=True, **kwargs):
+                 lookup=None, translate=True, normalize=True, sparse=False, **kwargs):
 
         if num_input_words > 0:
             logger.info("Restricting def vocab to " + str(num_input_words))
@@ -130,8 +172,10 @@ class MeanPoolReadDefinitions(Initializable):
             self._num_input_words = vocab.size()
 
         self._vocab = vocab
+        self._dim = dim
         self._translate = translate
         self._normalize = normalize
+        self._sparse = sparse
 
         children = []
 
@@ -161,22 +205,28 @@ class MeanPoolReadDefinitions(Initializable):
 
     @application
     def apply(self, application_call,
-              defs, def_mask):
+              defs, def_mask, auxiliary=None):
         """
         Returns vector per each word in sequence using the dictionary based lookup
+
+        `auxiliary` is the set of the auxiliary variables to build, see
+        `is_required`.
         """
         # Short listing
         defs = (T.lt(defs, self._num_input_words) * defs
                 + T.ge(defs, self._num_input_words) * self._vocab.unk)
+        if self._sparse:
+            return self._apply_sparse(application_call, defs, def_mask, auxiliary)
         # Memory bottleneck:
         # For instance (16101,52,300) ~= 32GB.
         # [(16786, 52, 1), (16786, 52, 100)]
         # TODO: Measure memory consumption here and check if it is in sensible range
         # or maybe introduce some control in Retrieval?
         defs_emb = self._def_lookup.apply(defs)
-        application_call.add_auxiliary_variable(
-            unk_ratio(defs, def_mask, self._vocab.unk),
-            name='def_unk_ratio')
+        if is_required(auxiliary, 'def_unk_ratio'):
+            application_call.add_auxiliary_variable(
+                unk_ratio(defs, def_mask, self._vocab.unk),
+                name='def_unk_ratio')
 
         if self._translate:
             logger.info("Translating in MeanPoolReadDefinitions")
@@ -190,6 +240,36 @@ class MeanPoolReadDefinitions(Initializable):
 
         return defs_emb
 
+    def _apply_sparse(self, application_call, defs, def_mask, auxiliary):
+        if is_required(auxiliary, 'def_unk_ratio'):
+            application_call.add_auxiliary_variable(
+                unk_ratio(defs, def_mask, self._vocab.unk),
+                name='def_unk_ratio')
+
+        # Only the real tokens go to the sparse matrix. T.nonzero returns
+        # them in row-major order, so the rows of the CSR matrix are
+        # delimited by the cumulative token counts.
+        flat_mask = def_mask.flatten()
+        tokens = T.nonzero(flat_mask)[0]
+        num_tokens = T.neq(def_mask, 0).sum(axis=1)
+        indptr = T.concatenate([T.zeros((1,), dtype='int64'),
+                                T.cumsum(num_tokens).astype('int64')])
+        counts = theano.sparse.CSR(
+            flat_mask[tokens], defs.flatten()[tokens].astype('int64'), indptr,
+            T.stack([defs.shape[0], self._def_lookup.W.shape[0]]).astype('int64'))
+        defs_emb = theano.sparse.structured_dot(counts, self._def_lookup.W)
+
+        lengths = def_mask.sum(axis=1)[:, None]
+        if self._normalize:
+            defs_emb = defs_emb / lengths
+        if self._translate:
+            logger.info("Translating in MeanPoolReadDefinitions")
+            defs_emb = self._def_translate.apply(defs_emb)
+            if not self._normalize and self._def_translate.use_bias:
+                # every token of the definition used to bring its own bias
+                defs_emb += (lengths - 1) * self._def_translate.b[None, :]
+        return defs_emb
+
 
 class MeanPoolCombiner(Initializable):
     """
@@ -271,54 +351,103 @@ class MeanPoolCombiner(Initializable):
     @application
     def apply(self, application_call,
               word_embs, words_mask,
-              def_embeddings, def_map, train_phase=False, word_ids=False, call_name=""):
+              def_embeddings, def_map, train_phase=False, word_ids=False, call_name="",
+              auxiliary=None):
         """ return a triple:
         * final embeddings
         * unique def embeddings
         * position of the def embeddings in the sentence (so that id can be retrieved)
+
+        `auxiliary` is the set of the auxiliary variables to build,
+        see `is_required`.
         """
         batch_shape = word_embs.shape
         # batch_shape[1] = bs?
         flat_indices = def_map[:, 0] * batch_shape[1] + def_map[:, 1] # Index of word in flat
-        unique_indices = T.extra_ops.Unique()(flat_indices)
 
         # def_map is a list of (seq_pos, word_pos, def_index)
         # def_embeddings is (id, emb_dim)
+        unique_indices, updated_embeddings = self.aggregate(
+            def_embeddings, flat_indices, def_map[:, 2])
+
+        # we take the newly computed embeddings.
+        # we want to update the lookup but we don't have access to the word ids here
+        # we can return the updated embeddings along with their positions in the text
+        def_mean = T.set_subtensor(
+            T.zeros((batch_shape[0] * batch_shape[1], def_embeddings.shape[1]))[unique_indices],
+            updated_embeddings)
+        def_mean = def_mean.reshape((batch_shape[0], batch_shape[1], -1))
 
-        def_sum = T.zeros((batch_shape[0] * batch_shape[1], def_embeddings.shape[1]))
-        def_lens = T.zeros_like(def_sum[:, 0])
-        def_lens = T.inc_subtensor(def_lens[flat_indices], 1)
+        final_embeddings = self._compose(
+            application_call, word_embs, words_mask, def_mean,
+            train_phase, word_ids, call_name, auxiliary)
+        return final_embeddings, updated_embeddings, unique_indices
+
+    @application
+    def apply_precomputed(self, application_call,
+                          word_embs, words_mask, def_mean,
+                          train_phase=False, word_ids=False, call_name="",
+                          auxiliary=None):
+        """Composes word embeddings with precomputed definition embeddings.
+
+        `def_mean` has the same shape as `word_embs` and is all-zeros
+        for the words without definitions, see
+        `dictlearn.def_embeddings`.
+
+        """
+        return self._compose(
+            application_call, word_embs, words_mask, def_mean,
+            train_phase, word_ids, call_name, auxiliary)
+
+    @application
+    def aggregate(self, application_call,
+                  def_embeddings, flat_indices, def_indices):
+        """Aggregates the definitions of every word that has any.
+
+        Returns the unique `flat_indices` and the definition embedding
+        of each of them.
+
+        """
+        # The definitions are aggregated per segment, i.e. per word that
+        # has definitions, so that the buffers scale with the number of
+        # such words rather than with the batch size times the length.
+        unique_indices, segments, def_lens = T.extra_ops.Unique(
+            return_inverse=True, return_counts=True)(flat_indices)
+        num_segments = unique_indices.shape[0]
+        linked_embeddings = def_embeddings[def_indices]
 
         if self._def_word_gating == "none":
-            def_sum = T.inc_subtensor(def_sum[flat_indices],
-                def_embeddings[def_map[:, 2]])
-            def_mean = def_sum / T.maximum(def_lens[:, None], 1)
+            segment_sum = T.inc_subtensor(
+                T.zeros((num_segments, def_embeddings.shape[1]))[segments],
+                linked_embeddings)
+            segment_mean = segment_sum / def_lens[:, None].astype(theano.config.floatX)
         elif self._def_word_gating == "self_attention":
-            gates = def_embeddings[def_map[:, 2]]
-            gates = self._gate_mlp.apply(gates)[:, 0]
+            gates = self._gate_mlp.apply(linked_embeddings)[:, 0]
             application_call.add_auxiliary_variable(gates, name='def_gates')
 
             # Dima: this is numerically unstable. But maybe it can work.
             # If it can work, we can avoid too much coding.
-            def_normalization = T.zeros_like(def_lens)
-            def_normalization = T.inc_subtensor(
-                def_normalization[flat_indices], T.exp(gates))
-            gates = T.exp(gates) / def_normalization[flat_indices]
-
-            def_mean = T.inc_subtensor(def_sum[flat_indices],
-                gates[:, None] * def_embeddings[def_map[:, 2]])
+            exp_gates = T.exp(gates)
+            segment_normalization = T.inc_subtensor(
+                T.zeros((num_segments,))[segments], exp_gates)
+            gates = exp_gates / segment_normalization[segments]
+
+            segment_mean = T.inc_subtensor(
+                T.zeros((num_segments, def_embeddings.shape[1]))[segments],
+                gates[:, None] * linked_embeddings)
         else:
             raise NotImplementedError()
-        
-        # we take the newly computed embeddings.
-        # we want to update the lookup but we don't have access to the word ids here
-        # we can return the updated embeddings along with their positions in the text
-        updated_embeddings = def_mean[unique_indices]
 
-        def_mean = def_mean.reshape((batch_shape[0], batch_shape[1], -1))
+        return unique_indices, segment_mean
 
-        application_call.add_auxiliary_variable(
-            masked_root_mean_square(def_mean, words_mask), name=call_name + '_def_mean_rootmean2')
+    def _compose(self, application_call, word_embs, words_mask, def_mean,
+                 train_phase, word_ids, call_name, auxiliary):
+        batch_shape = word_embs.shape
+
+        if is_required(auxiliary, call_name + '_def_mean_rootmean2'):
+            application_call.add_auxiliary_variable(
+                masked_root_mean_square(def_mean, words_mask),
+                name=call_name + '_def_mean_rootmean2')
 
         if train_phase and self._dropout != 0.0:
             if self._dropout_type == "per_unit":
@@ -367,9 +496,10 @@ class MeanPoolCombiner(Initializable):
                 if not self._compose_type == "sum" and not self._compose_type == "transform_and_sum":
                     raise NotImplementedError()
 
-        application_call.add_auxiliary_variable(
-            def_mean.copy(),
-            name=call_name + '_dict_word_embeddings')
+        if is_required(auxiliary, call_name + '_dict_word_embeddings'):
+            application_call.add_auxiliary_variable(
+                def_mean.copy(),
+                name=call_name + '_dict_word_embeddings')
 
         if self._compose_type == 'sum':
             final_embeddings = word_embs + def_mean
@@ -388,9 +518,10 @@ class MeanPoolCombiner(Initializable):
             else:
                 final_embeddings = gates * word_embs + (1 - gates) * self._def_state_transform.apply(def_mean)
 
-            application_call.add_auxiliary_variable(
-                masked_root_mean_square(gates.reshape((batch_shape[0], batch_shape[1], -1)), words_mask),
-                name=call_name + '_compose_gate_rootmean2')
+            if is_required(auxiliary, call_name + '_compose_gate_rootmean2'):
+                application_call.add_auxiliary_variable(
+                    masked_root_mean_square(gates.reshape((batch_shape[0], batch_shape[1], -1)), words_mask),
+                    name=call_name + '_compose_gate_rootmean2')
         elif self._compose_type.startswith('fully_connected'):
             concat = T.concatenate([word_embs, def_mean], axis=2)
             final_embeddings = self._def_state_compose.apply(concat)
@@ -410,9 +541,153 @@ class MeanPoolCombiner(Initializable):
                                def_mean * T.eq(word_ids, self._vocab.unk).dimshuffle(0, 1, "x")
 
 
-        application_call.add_auxiliary_variable(
-            masked_root_mean_square(final_embeddings, words_mask),
-            name=call_name + '_merged_input_rootmean2')
+        if is_required(auxiliary, call_name + '_merged_input_rootmean2'):
+            application_call.add_auxiliary_variable(
+                masked_root_mean_square(final_embeddings, words_mask),
+                name=call_name + '_merged_input_rootmean2')
 
-        return final_embeddings, updated_embeddings, unique_indices
+        return final_embeddings
+
+
+
+class DefinitionCache(Brick):
+    """Caches definition embeddings across training steps.
+
+    The definitions of a word are only read when its cached embedding
+    was computed at least `max_age` updates ago, the other words are
+    served from the cache. The cached embeddings are constants, so
+    `max_age` trades the freshness of the definition embeddings and
+    the amount of gradient the definition reader receives for speed.
+    With `max_age=1` all the definitions are read at every step.
+
+    The cache is refreshed by the updates attached to `apply` that the
+    training algorithm has to perform, see `ComputationGraph.updates`.
+    When they are not performed, e.g. at evaluation time, all the
+    definitions are read.
+
+    Parameters
+    ----------
+    def_reader : LSTMReadDefinitions or MeanPoolReadDefinitions
+        The definition reader of the model. It is not a child of the
+        cache.
+    combiner : MeanPoolCombiner
+        The combiner of the model, its `aggregate` is used to average
+        the definitions of each word.
+    num_words : int
+        The size of the vocabulary the cache is indexed by.
+    max_age : int
+        The number of updates after which a cached embedding is stale.
+    unk : int
+        The id of the UNK token. It stands for many words with different
+        definitions, so it is never served from the cache.
+
+    """
+    def __init__(self, def_reader, combiner, num_words, max_age, unk, **kwargs):
+        super(DefinitionCache, self).__init__(**kwargs)
+        if max_age < 1:
+            raise ValueError("max_age must be positive")
+        self._def_reader = def_reader
+        self._combiner = combiner
+        self._dim = def_reader._dim
+        self._max_age = max_age
+        self._unk = unk
+
+        self.embeddings = theano.shared(
+            numpy.zeros((num_words, self._dim), dtype=theano.config.floatX),
+            name='def_cache_embeddings')
+        # all entries are stale at the beginning
+        self.last_update = theano.shared(
+            numpy.zeros((num_words,), dtype='int64') - max_age,
+            name='def_cache_last_update')
+        self.step = theano.shared(numpy.int64(0), name='def_cache_step')
+
+    @application
+    def apply(self, application_call, defs, def_mask, word_ids, def_maps,
+              auxiliary=None):
+        """Returns the definition embeddings of several batches of text.
+
+        Parameters
+        ----------
+        defs : int matrix
+            The definitions, as returned by the retrieval.
+        def_mask : float matrix
+        word_ids : list of int matrices
+            The ids of the words the cache is indexed by, one (B, L)
+            matrix per batch of text.
+        def_maps : list of int matrices
+            The def maps of the batches of text, see `Retrieval`.
+        auxiliary : set
+            The auxiliary variables of the reader to build, see
+            `is_required`.
+
+        Returns
+        -------
+        One (B, L, dim) tensor per batch of text, all-zeros for the words
+        without definitions, see `MeanPoolCombiner.apply_precomputed`.
 
+        """
+        flat_indices = []
+        link_words = []
+        link_defs = []
+        offsets = []
+        offset = 0
+        for ids, def_map in zip(word_ids, def_maps):
+            flat_indices.append(offset + def_map[:, 0] * ids.shape[1] + def_map[:, 1])
+            link_words.append(ids[def_map[:, 0], def_map[:, 1]])
+            link_defs.append(def_map[:, 2])
+            offset = offset + ids.shape[0] * ids.shape[1]
+            offsets.append(offset)
+        flat_indices = T.concatenate(flat_indices)
+        link_words = T.concatenate(link_words)
+        link_defs = T.concatenate(link_defs)
+
+        # a word is fresh or stale in all the links it has
+        age = self.step - self.last_update[link_words]
+        fresh = T.lt(age, self._max_age) * T.neq(link_words, self._unk)
+        fresh_links = fresh.nonzero()[0]
+        stale_links = T.eq(fresh, 0).nonzero()[0]
+
+        # only the definitions of the stale words are read
+        read_defs, stale_def_indices = T.extra_ops.Unique(return_inverse=True)(
+            link_defs[stale_links])
+        def_embs = self._def_reader.apply(defs[read_defs], def_mask[read_defs],
+                                          auxiliary=auxiliary)
+        stale_indices, stale_means = self._combiner.aggregate(
+            def_embs, flat_indices[stale_links], stale_def_indices)
+        # `aggregate` returns the sorted unique positions as well
+        _, first_stale_links = T.extra_ops.Unique(return_index=True)(
+            flat_indices[stale_links])
+        stale_words = link_words[stale_links][first_stale_links]
+
+        fresh_indices, first_fresh_links = T.extra_ops.Unique(return_index=True)(
+            flat_indices[fresh_links])
+        fresh_words = link_words[fresh_links][first_fresh_links]
+
+        def_means = T.zeros((offset, self._dim))
+        def_means = T.set_subtensor(
+            def_means[fresh_indices], self.embeddings[fresh_words])
+        def_means = T.set_subtensor(def_means[stale_indices], stale_means)
+
+        application_call.updates[self.embeddings] = T.set_subtensor(
+            self.embeddings[stale_words], stale_means)
+        application_call.updates[self.last_update] = T.set_subtensor(
+            self.last_update[stale_words], self.step)
+        application_call.updates[self.step] = self.step + 1
+
+        floatX = theano.config.floatX
+        num_fresh = fresh.sum().astype(floatX)
+        application_call.add_auxiliary_variable(
+            num_fresh / T.maximum(link_words.shape[0], 1).astype(floatX),
+            name='def_cache_hit_rate')
+        # the mean age of the cached embeddings that were used
+        application_call.add_auxiliary_variable(
+            (age * fresh).sum().astype(floatX) / T.maximum(num_fresh, 1),
+            name='def_cache_staleness')
+
+        outputs = []
+        start = 0
+        for ids, end in zip(word_ids, offsets):
+            outputs.append(
+                def_means[start:end].reshape((ids.shape[0], ids.shape[1], self._dim)))
+            start = end
+        return outputs
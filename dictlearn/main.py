@@ -10,6 +10,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 from dictlearn.util import run_with_redirection
+from dictlearn.function_cache import set_function_cache
 
 
 def add_config_arguments(config, parser):
@@ -42,6 +43,8 @@ def main(config_registry, training_func, **training_func_kwargs):
                         help="Load parameters from a main loop")
     parser.add_argument("--seed", type=int,
                         help="The random seed")
+    parser.add_argument("--function-cache",
+                        help="A directory to cache the compiled Theano functions")
     parser.add_argument("config", help="The configuration")
     parser.add_argument("save_path", help="The destination for saving")
     add_config_arguments(config_registry.get_root_config(), parser)
@@ -54,6 +57,8 @@ def main(config_registry, training_func, **training_func_kwargs):
         if key in args and getattr(args, key) is not None:
             config[key] = getattr(args, key)
 
+    set_function_cache(args.function_cache, config)
+
     new_training_job = False
     if not os.path.exists(args.save_path):
         new_training_job = True
@@ -74,15 +79,26 @@ def main(config_registry, training_func, **training_func_kwargs):
         call_training_func)()
 
 
-def main_evaluate(config_registry, evaluate_func):
+def main_evaluate(config_registry, evaluate_func, extra_arguments=()):
+    """Parses the arguments of an evaluation script and runs it.
+
+    `extra_arguments` are the `(flags, options)` of the arguments that
+    only `evaluate_func` understands, they are passed to it as keyword
+    arguments when they are set.
+
+    """
     parser = argparse.ArgumentParser("Evaluation script")
     parser.add_argument("--part", default='train', help="Part")
     parser.add_argument("--dataset", help="Provide a dataset explicitly")
     parser.add_argument("--dest", help="Destination for outputs")
     parser.add_argument("--num-examples", type=int, help="Number of examples to read", default=-1)
     parser.add_argument("--qids", type=str, help="Comma-separate qids")
+    parser.add_argument("--function-cache",
+                        help="A directory to cache the compiled Theano functions")
     parser.add_argument("config", help="The configuration")
     parser.add_argument("tar_path", help="The tar file with parameters")
+    extra_dests = [parser.add_argument(*flags, **options).dest
+                   for flags, options in extra_arguments]
     add_config_arguments(config_registry.get_root_config(), parser)
 
     args = parser.parse_args()
@@ -100,9 +116,14 @@ def main_evaluate(config_registry, evaluate_func):
 
     # For now this script just runs the language model training.
     # More stuff to come.
+    set_function_cache(args.function_cache, config)
+
     kwargs = {}
     if args.qids:
         kwargs['qids'] = args.qids
     if args.dataset:
         kwargs['dataset'] = args.dataset
+    for dest in extra_dests:
+        if getattr(args, dest) not in (None, False):
+            kwargs[dest] = getattr(args, dest)
     evaluate_func(config, args.tar_path, args.part, args.num_examples, args.dest, **kwargs)
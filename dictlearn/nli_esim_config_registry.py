@@ -43,15 +43,23 @@ nli_esim_config_registry.set_root_config({
     "combiner_shortcut": False,
     'reader_type': 'mean',
     'share_def_lookup': False,
+    'def_reader_buckets': 1, # length buckets of the rnn reader
+    'def_cache_max_age': 0, # when 0: definitions are read at every step
     'combiner_bn': False,
 
     'num_input_words': -1, # Will take vocab size
     "dropout": 0.5,
     'batch_size': 32,
     'lr': 0.0004,
+    # parameter name regexp -> 'adam' or 'sgd', for row-wise updates
+    # of lookup tables
+    'sparse_updates': {},
 
     # Misc. Monitor every 100% of epoch
     'monitor_parameters': 0,
+    # when False: the diagnostics are computed on the last batch every
+    # mon_freq batches instead of by the training function
+    'monitor_every_batch': False,
     'mon_freq': int((500000) / 32) / 2, # 2 times per epoch
     'save_freq_epochs': 1,
     'mon_freq_valid': int((500000) / 32) / 2,
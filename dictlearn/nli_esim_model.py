@@ -26,7 +26,8 @@ from blocks.bricks.recurrent.misc import Bidirectional
 from blocks.initialization import IsotropicGaussian, Constant, NdarrayInitialization, Uniform
 
 from dictlearn.inits import GlorotUniform
-from dictlearn.theano_util import apply_dropout
+from dictlearn.lookup import DefinitionCache
+from dictlearn.theano_util import apply_dropout, is_required
 
 def masked_softmax(a, m, axis):
     e_a = T.exp(a)
@@ -34,6 +35,34 @@ def masked_softmax(a, m, axis):
     sum_masked_e = T.sum(masked_e, axis, keepdims=True)
     return masked_e / sum_masked_e
 
+def soft_align(s1, s1_mask, s2, s2_mask):
+    """The soft alignment of the premise and the hypothesis.
+
+    Returns
+    -------
+    E : (batch_size, s1_len, s2_len)
+        The attention scores (eq. 11), E_ij = <s1[i], s2[j]>.
+    s1_tilde : (batch_size, s1_len, dim)
+    s2_tilde : (batch_size, s2_len, dim)
+        The tilde vectors (eq. 12 and 13).
+
+    """
+    # NOTE: No point in masking here
+    E = T.batched_dot(s1, s2.dimshuffle(0, 2, 1))
+
+    def compute_tilde_vectors(e, s, s_mask):
+        # e is (batch_size, seq_len, s_seq_len), softmax is taken over the last axis
+        # s is (batch_size, s_seq_len, dim)
+        # s_mask is (batch_size, s_seq_len)
+        # s_tilde_i = \sum_j softmax(e_i)_j s_j
+        score = masked_softmax(e, s_mask.dimshuffle(0, "x", 1), axis=2)
+        return T.batched_dot(score, s * s_mask.dimshuffle(0, 1, "x"))
+
+    s1_tilde = compute_tilde_vectors(E, s2, s2_mask)
+    s2_tilde = compute_tilde_vectors(E.dimshuffle(0, 2, 1), s1, s1_mask)
+    return E, s1_tilde, s2_tilde
+
+
 class ESIM(Initializable):
     """
     ESIM model based on https://github.com/NYU-MLL/multiNLI/blob/master/python/models/esim.py
@@ -42,6 +71,7 @@ class ESIM(Initializable):
     # seq_length, emb_dim, hidden_dim
     def __init__(self, dim, emb_dim, vocab, def_emb_translate_dim=-1, def_dim=-1, encoder='bilstm', bn=True,
             def_reader=None, def_combiner=None, dropout=0.5, num_input_words=-1,
+            def_cache_max_age=0,
             # Others
             **kwargs):
 
@@ -50,6 +80,8 @@ class ESIM(Initializable):
         self._emb_dim = emb_dim
         self._def_reader = def_reader
         self._def_combiner = def_combiner
+        self._def_table = None
+        self._def_cache = None
 
         if encoder != 'bilstm':
             raise NotImplementedError()
@@ -87,6 +119,12 @@ class ESIM(Initializable):
             self._def_reader = def_reader
             self._def_combiner = def_combiner
             children.extend([self._def_reader, self._def_combiner])
+
+            if def_cache_max_age > 0:
+                self._def_cache = DefinitionCache(
+                    self._def_reader, self._def_combiner, vocab.size(),
+                    def_cache_max_age, vocab.unk, name='def_cache')
+                children.append(self._def_cache)
         else:
             self._final_emb_dim = self._emb_dim
 
@@ -128,19 +166,31 @@ class ESIM(Initializable):
     def get_embeddings_lookups(self):
         return [self._lookup]
 
-    def set_embeddings(self, embeddings):
-        self._lookup.parameters[0].set_value(embeddings.astype(theano.config.floatX))
+    def set_embeddings(self, embeddings, borrow=False):
+        self._lookup.parameters[0].set_value(
+            embeddings.astype(theano.config.floatX, copy=False), borrow=borrow)
 
     def get_def_embeddings_lookups(self):
         return [self._def_reader._def_lookup]
 
-    def set_def_embeddings(self, embeddings):
-        self._def_reader._def_lookup.parameters[0].set_value(embeddings.astype(theano.config.floatX))
+    def set_def_embeddings(self, embeddings, borrow=False):
+        self._def_reader._def_lookup.parameters[0].set_value(
+            embeddings.astype(theano.config.floatX, copy=False), borrow=borrow)
+
+    def set_def_table(self, table):
+        """Use precomputed definition embeddings instead of the reader.
+
+        Has to be called before `apply`. See `dictlearn.def_embeddings`.
+
+        """
+        self._def_table = theano.shared(
+            table.astype(theano.config.floatX, copy=False), name='def_table', borrow=True)
 
     @application
     def apply(self, application_call,
             s1_preunk, s1_mask, s2_preunk, s2_mask, def_mask=None,
-            defs=None, s1_def_map=None, s2_def_map=None, train_phase=True):
+            defs=None, s1_def_map=None, s2_def_map=None, train_phase=True,
+            auxiliary=None):
         # Shortlist words (sometimes we want smaller vocab, especially when dict is small)
         s1 = (tensor.lt(s1_preunk, self._num_input_words) * s1_preunk
               + tensor.ge(s1_preunk, self._num_input_words) * self._vocab.unk)
@@ -152,14 +202,13 @@ class ESIM(Initializable):
         s1_emb = self._lookup.apply(s1)
         s2_emb = self._lookup.apply(s2)
 
-        application_call.add_auxiliary_variable(
-            1 * s1_emb,
-            name='s1_word_embeddings')
+        if is_required(auxiliary, 's1_word_embeddings'):
+            application_call.add_auxiliary_variable(
+                1 * s1_emb,
+                name='s1_word_embeddings')
 
         if self._def_reader:
-            assert defs is not None
-
-            def_embs = self._def_reader.apply(defs, def_mask)
+            assert defs is not None or self._def_table is not None
 
             if self._translate_pre_def:
                 logger.info("Translate pre def")
@@ -170,13 +219,38 @@ class ESIM(Initializable):
                 s1_emb = s1_emb.reshape((s1_preunk.shape[0], s1_preunk.shape[1], -1))
                 s2_emb = s2_emb.reshape((s2_preunk.shape[0], s2_preunk.shape[1], -1))
 
-            s1_emb = self._def_combiner.apply(
-                s1_emb, s1_mask,
-                def_embs, s1_def_map, word_ids=s1, train_phase=train_phase, call_name="s1")
-
-            s2_emb = self._def_combiner.apply(
-                s2_emb, s2_mask,
-                def_embs, s2_def_map, word_ids=s2, train_phase=train_phase, call_name="s2")
+            if self._def_table is not None:
+                s1_def_mean = self._def_table[s1_preunk]
+                s2_def_mean = self._def_table[s2_preunk]
+            elif self._def_cache and train_phase:
+                s1_def_mean, s2_def_mean = self._def_cache.apply(
+                    defs, def_mask, [s1_preunk, s2_preunk], [s1_def_map, s2_def_map],
+                    auxiliary=auxiliary)
+            else:
+                s1_def_mean = s2_def_mean = None
+
+            if s1_def_mean is not None:
+                s1_emb = self._def_combiner.apply_precomputed(
+                    s1_emb, s1_mask, s1_def_mean,
+                    word_ids=s1, train_phase=train_phase, call_name="s1",
+                    auxiliary=auxiliary)
+
+                s2_emb = self._def_combiner.apply_precomputed(
+                    s2_emb, s2_mask, s2_def_mean,
+                    word_ids=s2, train_phase=train_phase, call_name="s2",
+                    auxiliary=auxiliary)
+            else:
+                def_embs = self._def_reader.apply(defs, def_mask, auxiliary=auxiliary)
+
+                s1_emb = self._def_combiner.apply(
+                    s1_emb, s1_mask,
+                    def_embs, s1_def_map, word_ids=s1, train_phase=train_phase, call_name="s1",
+                    auxiliary=auxiliary)[0]
+
+                s2_emb = self._def_combiner.apply(
+                    s2_emb, s2_mask,
+                    def_embs, s2_def_map, word_ids=s2, train_phase=train_phase, call_name="s2",
+                    auxiliary=auxiliary)[0]
         else:
             if train_phase and self._dropout > 0:
                 s1_emb = apply_dropout(s1_emb, drop_prob=self._dropout)
@@ -193,56 +267,13 @@ class ESIM(Initializable):
         s2_bilstm = flip01(s2_bilstm)
         ### Attention ###
 
-        # Compute E matrix (eq. 11)
-        # E_ij = <s1[i], s2[j]>
-        # each call computes E[i, :]
-        def compute_e_row(s2_i, s1_bilstm, s1_mask):
-            b_size = s1_bilstm.shape[0]
-            # s2_i is (batch_size, emb_dim)
-            # s1_bilstm is (batch_size, seq_len, emb_dim)
-            # s1_mask is (batch_size, seq_len)
-            # s2_i = s2_i.reshape((s2_i.shape[0], s2_i.shape[1], 1))
-            s2_i = s2_i.reshape((b_size, s2_i.shape[1], 1))
-            s2_i = T.repeat(s2_i, 2, axis=2)
-            # s2_i is (batch_size, emb_dim, 2)
-            assert s1_bilstm.ndim == 3
-            assert s2_i.ndim == 3
-            score = T.batched_dot(s1_bilstm, s2_i) # (batch_size, seq_len, 1)
-            score = score[:, :, 0].reshape((b_size, -1)) # (batch_size, seq_len)
-            return score # E[i, :]
-
-        # NOTE: No point in masking here
-        E, _ = theano.scan(compute_e_row, sequences=[s1_bilstm.transpose(1, 0, 2)],
-            non_sequences=[s2_bilstm, s2_mask])
-        # (seq_len, batch_size, seq_len)
-        E = E.dimshuffle(1, 0, 2)
+        E, s1_tilde, s2_tilde = soft_align(s1_bilstm, s1_mask, s2_bilstm, s2_mask)
         assert E.ndim == 3
 
         s2s_att_weights = self._ndim_softmax.apply(E, extra_ndim=1)
-        application_call.add_auxiliary_variable(
-            s2s_att_weights.copy(), name='s2s_att_weights')
-
-        # (batch_size, seq_len, seq_len)
-
-        ### Compute tilde vectors (eq. 12 and 13) ###
-
-        def compute_tilde_vector(e_i, s, s_mask):
-            # e_i is (batch_size, seq_len)
-            # s_mask is (batch_size, seq_len)
-            # s_tilde_i = \sum e_ij b_j, (batch_size, seq_len)
-            score = masked_softmax(e_i, s_mask, axis=1)
-            score = score.dimshuffle(0, 1, "x")
-
-            s_tilde_i = (score * (s * s_mask.dimshuffle(0, 1, "x"))).sum(axis=1)
-            return s_tilde_i
-
-        # (batch_size, seq_len, def_dim)
-        s1_tilde, _ = theano.scan(compute_tilde_vector,
-            sequences=[E.dimshuffle(1, 0, 2)], non_sequences=[s2_bilstm, s2_mask])
-        s1_tilde = s1_tilde.dimshuffle(1, 0, 2)
-        s2_tilde, _ = theano.scan(compute_tilde_vector,
-            sequences=[E.dimshuffle(2, 0, 1)], non_sequences=[s1_bilstm, s1_mask])
-        s2_tilde = s2_tilde.dimshuffle(1, 0, 2)
+        if is_required(auxiliary, 's2s_att_weights'):
+            application_call.add_auxiliary_variable(
+                s2s_att_weights.copy(), name='s2s_att_weights')
 
         ### Compose (eq. 14 and 15) ###
 
@@ -0,0 +1,137 @@
+"""NumPy inference for `NLISimple`.
+
+A trained `NLISimple` is saved with `NLISimple.export_numpy` (see
+`bin/export_nli_numpy.py`) into a single `.npz` file, which this module
+runs without Theano or Blocks. The definitions are not read: the models
+that use them are exported with a table of precomputed definition
+embeddings, see `dictlearn.def_embeddings`.
+
+Only NumPy is imported, so that the module starts in milliseconds and can
+be used from many worker processes.
+
+"""
+import json
+
+import numpy
+
+
+def _relu(x):
+    return numpy.maximum(x, 0)
+
+
+def _sigmoid(x):
+    return 1. / (1. + numpy.exp(-x))
+
+
+def _softmax(x):
+    e = numpy.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+class NumpyNLISimple(object):
+    """An exported `NLISimple`.
+
+    Parameters
+    ----------
+    path : str
+        The `.npz` file written by `NLISimple.export_numpy`.
+
+    """
+    def __init__(self, path):
+        with numpy.load(path) as data:
+            self._arrays = {key: data[key] for key in data.files}
+        self.config = json.loads(str(self._arrays.pop('config')))
+
+    def _linear(self, name, x):
+        return x.dot(self._arrays[name + '.W']) + self._arrays[name + '.b']
+
+    def _bn(self, name, x):
+        a = self._arrays
+        return ((x - a[name + '.mean']) / a[name + '.stdev']
+                * a[name + '.scale'] + a[name + '.shift'])
+
+    def _lstm(self, inputs, mask):
+        a = self._arrays
+        dim = a['lstm.W_state'].shape[0]
+        batch_size = inputs.shape[0]
+        states = numpy.repeat(a['lstm.initial_state'][None, :], batch_size, 0)
+        cells = numpy.repeat(a['lstm.initial_cells'][None, :], batch_size, 0)
+        for t in range(inputs.shape[1]):
+            activation = states.dot(a['lstm.W_state']) + inputs[:, t]
+            in_gate = _sigmoid(activation[:, :dim] + cells * a['lstm.W_cell_to_in'])
+            forget_gate = _sigmoid(activation[:, dim:2 * dim]
+                                   + cells * a['lstm.W_cell_to_forget'])
+            next_cells = (forget_gate * cells
+                          + in_gate * numpy.tanh(activation[:, 2 * dim:3 * dim]))
+            out_gate = _sigmoid(activation[:, 3 * dim:]
+                                + next_cells * a['lstm.W_cell_to_out'])
+            next_states = out_gate * numpy.tanh(next_cells)
+            step_mask = mask[:, t, None]
+            states = step_mask * next_states + (1 - step_mask) * states
+            cells = step_mask * next_cells + (1 - step_mask) * cells
+        return states
+
+    def _compose(self, word_embs, def_mean, word_ids):
+        c = self.config
+        compose_type = c['compose_type']
+        if compose_type == 'sum':
+            final = word_embs + def_mean
+        elif compose_type == 'transform_and_sum':
+            final = word_embs + self._linear('state_transform', def_mean)
+        elif compose_type in ('gated_sum', 'gated_transform_and_sum'):
+            gates = _sigmoid(self._linear(
+                'compose_gate', numpy.concatenate([word_embs, def_mean], axis=2)))
+            if compose_type == 'gated_sum':
+                final = gates * word_embs + (1 - gates) * def_mean
+            else:
+                final = (gates * word_embs + (1 - gates)
+                         * self._linear('state_transform', def_mean))
+        elif compose_type == 'fully_connected_linear':
+            final = self._linear(
+                'def_state_compose', numpy.concatenate([word_embs, def_mean], axis=2))
+        else:
+            raise NotImplementedError(compose_type)
+
+        if c['shortcut_unk_and_excluded']:
+            excluded = (word_ids < c['exclude_top_k'])[:, :, None]
+            final = numpy.where(excluded, word_embs, final)
+            final = numpy.where((word_ids == c['unk'])[:, :, None], def_mean, final)
+        return final
+
+    def _encode(self, preunk, mask):
+        c = self.config
+        a = self._arrays
+        ids = numpy.where(preunk < c['num_input_words'], preunk, c['unk'])
+        embs = a['lookup'][ids]
+        if c['use_definitions']:
+            if c['translate_pre_def']:
+                embs = self._linear('translate_pre_def', embs)
+            embs = self._compose(embs, a['def_table'][preunk], ids)
+            if c['translate_after_emb']:
+                embs = _relu(self._linear('translation', embs))
+        elif c['translate_after_emb']:
+            embs = _relu(self._linear('translation', embs))
+
+        if c['encoder'] == 'sum':
+            return (mask[:, :, None] * embs).sum(axis=1)
+        return self._lstm(self._linear('rnn_fork', embs), mask)
+
+    def predict(self, s1, s1_mask, s2, s2_mask):
+        """Returns the probabilities of the three classes.
+
+        The arguments are the padded word ids and the masks of the
+        premises and the hypotheses, as in the data streams.
+
+        """
+        c = self.config
+        prem = self._encode(numpy.asarray(s1), numpy.asarray(s1_mask))
+        hyp = self._encode(numpy.asarray(s2), numpy.asarray(s2_mask))
+        if c['bn']:
+            prem = self._bn('prem_bn', prem)
+            hyp = self._bn('hyp_bn', hyp)
+        joint = numpy.concatenate([prem, hyp], axis=1)
+        for i in range(c['n_layers']):
+            joint = _relu(self._linear('mlp_{}'.format(i), joint))
+            if c['bn']:
+                joint = self._bn('bn_{}'.format(i), joint)
+        return _softmax(self._linear('pred', joint))
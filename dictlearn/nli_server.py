@@ -0,0 +1,373 @@
+"""A local server that scores sentence pairs with a trained NLI model.
+
+Running the compiled prediction function once per request leaves most of
+the CPU idle, so the requests are put in a queue and the `MicroBatcher`
+thread scores the queued pairs together. A batch is run as soon as it
+has `max_batch_size` pairs or its oldest pair waited `max_wait` seconds,
+which bounds the latency added by the batching.
+
+The server speaks HTTP, over TCP or over a Unix socket:
+
+- `POST /predict` with `{"pairs": [[premise, hypothesis], ...]}` answers
+  `{"labels": [...], "probabilities": [[...], ...]}`, one row of class
+  probabilities per pair.
+- `GET /metrics` answers the throughput and latency statistics, see
+  `Metrics.snapshot`.
+
+See `bin/serve_nli.py`.
+
+"""
+import os
+import json
+import time
+import Queue
+import logging
+import threading
+import SocketServer
+import BaseHTTPServer
+from collections import deque
+
+import numpy
+from nltk.tokenize import TreebankWordTokenizer
+
+from blocks.model import Model
+
+from dictlearn.data import retrieve_and_pad_snli, digitize
+from dictlearn.h5py_conversion import SNLI_LABEL2INT
+from dictlearn.function_cache import function
+
+logger = logging.getLogger(__name__)
+
+LABELS = sorted(SNLI_LABEL2INT, key=SNLI_LABEL2INT.get)
+
+
+def _percentiles(values, qs=(50, 90, 99)):
+    if not values:
+        return {'p{}'.format(q): None for q in qs}
+    return {'p{}'.format(q): float(numpy.percentile(values, q)) for q in qs}
+
+
+class Metrics(object):
+    """Throughput and latency statistics of the server.
+
+    Parameters
+    ----------
+    window : int
+        The latencies and the batch sizes are kept for this many last
+        requests and batches.
+
+    """
+    def __init__(self, window=10000):
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._num_requests = 0
+        self._num_pairs = 0
+        self._num_batches = 0
+        self._num_errors = 0
+        self._busy_time = 0.
+        self._latencies = deque(maxlen=window)
+        self._batch_sizes = deque(maxlen=window)
+        self._batch_times = deque(maxlen=window)
+
+    def record_request(self, latency, error=False):
+        with self._lock:
+            self._num_requests += 1
+            self._num_errors += int(error)
+            self._latencies.append(latency)
+
+    def record_batch(self, size, duration):
+        with self._lock:
+            self._num_batches += 1
+            self._num_pairs += size
+            self._busy_time += duration
+            self._batch_sizes.append(size)
+            self._batch_times.append(duration)
+
+    def snapshot(self):
+        """Returns the statistics as a JSON-serializable dict.
+
+        The latencies are in milliseconds and are measured from the
+        arrival of a request to its answer, the throughput is the number
+        of pairs scored per second since the start.
+
+        """
+        with self._lock:
+            uptime = time.time() - self._start
+            latencies = 1000 * numpy.array(self._latencies)
+            batch_times = 1000 * numpy.array(self._batch_times)
+            return {
+                'uptime': uptime,
+                'requests': self._num_requests,
+                'errors': self._num_errors,
+                'pairs': self._num_pairs,
+                'batches': self._num_batches,
+                'pairs_per_second': self._num_pairs / uptime if uptime else 0.,
+                'utilization': self._busy_time / uptime if uptime else 0.,
+                'mean_batch_size': (float(numpy.mean(self._batch_sizes))
+                                    if self._batch_sizes else None),
+                'latency_ms': _percentiles(list(latencies)),
+                'batch_time_ms': _percentiles(list(batch_times))}
+
+
+class _Request(object):
+    def __init__(self, num_pairs):
+        self.arrival = time.time()
+        self.results = [None] * num_pairs
+        self.remaining = num_pairs
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """Scores the pairs of concurrent requests in batches.
+
+    Parameters
+    ----------
+    predict : callable
+        Takes a list of `(premise, hypothesis)` pairs and returns an
+        array of their class probabilities.
+    max_batch_size : int
+        The maximum number of pairs in a batch. The pairs of a large
+        request are split between several batches.
+    max_wait : float
+        The maximum time in seconds a pair waits for a batch to fill.
+    metrics : Metrics
+        Where the statistics are recorded, a new `Metrics` by default.
+
+    """
+    def __init__(self, predict, max_batch_size=32, max_wait=0.01, metrics=None):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be positive")
+        self._predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.metrics = metrics or Metrics()
+        self._queue = Queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def predict(self, pairs, timeout=None):
+        """Returns the probabilities for `pairs`, blocks until scored.
+
+        Raises `RuntimeError` if the pairs are not scored within
+        `timeout` seconds.
+
+        """
+        if not pairs:
+            return numpy.zeros((0, len(LABELS)))
+        request = _Request(len(pairs))
+        for i, pair in enumerate(pairs):
+            self._queue.put((request, i, pair))
+        if not request.done.wait(timeout):
+            self.metrics.record_request(time.time() - request.arrival, error=True)
+            raise RuntimeError("the pairs were not scored in {}s".format(timeout))
+        self.metrics.record_request(time.time() - request.arrival,
+                                    error=request.error is not None)
+        if request.error is not None:
+            raise request.error
+        return numpy.array(request.results)
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except Queue.Empty:
+            return []
+        deadline = batch[0][0].arrival + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # take what is already queued without waiting
+                    batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            start = time.time()
+            try:
+                probabilities = self._predict([pair for _, _, pair in batch])
+                error = None
+            except Exception as e:
+                logger.error("Could not score a batch", exc_info=True)
+                probabilities = [None] * len(batch)
+                error = e
+            self.metrics.record_batch(len(batch), time.time() - start)
+            for (request, i, _), row in zip(batch, probabilities):
+                request.results[i] = row
+                request.error = request.error or error
+                request.remaining -= 1
+                if not request.remaining:
+                    request.done.set()
+
+
+class NLIPredictor(object):
+    """Tokenizes and scores a batch of sentence pairs.
+
+    Parameters
+    ----------
+    predict_function : callable
+        The compiled prediction function, it is called with the inputs
+        of the model as keyword arguments named like the sources of
+        `SNLIData` streams.
+    vocab : Vocabulary
+        The vocabulary of the model.
+    retrieval : Retrieval
+        The retrieval of the definitions, `None` if the model does not
+        read definitions.
+    lowercase : bool
+        Lowercase the sentences, for the models trained on lowercased
+        data.
+
+    """
+    def __init__(self, predict_function, vocab, retrieval=None, lowercase=False):
+        self._function = predict_function
+        self._vocab = vocab
+        self._retrieval = retrieval
+        self._lowercase = lowercase
+        self._tokenizer = TreebankWordTokenizer()
+
+    def tokenize(self, sentence):
+        if self._lowercase:
+            sentence = sentence.lower()
+        return self._tokenizer.tokenize(sentence)
+
+    def inputs(self, pairs):
+        """Returns the inputs of the model for `pairs`."""
+        s1 = [self.tokenize(premise) for premise, _ in pairs]
+        s2 = [self.tokenize(hypothesis) for _, hypothesis in pairs]
+        if not all(s1) or not all(s2):
+            raise ValueError("empty sentence")
+        inputs = {}
+        if self._retrieval:
+            defs, def_mask, s1_def_map, s2_def_map = retrieve_and_pad_snli(
+                self._retrieval, (s1, s2, numpy.zeros(len(pairs))))
+            inputs.update(defs=defs, def_mask=def_mask,
+                          sentence1_def_map=s1_def_map,
+                          sentence2_def_map=s2_def_map)
+        for name, sentences in [('sentence1', s1), ('sentence2', s2)]:
+            lengths = numpy.array([len(sentence) for sentence in sentences])
+            ids = numpy.zeros((len(pairs), lengths.max()), dtype='int64')
+            mask = numpy.zeros(ids.shape, dtype='float32')
+            for i, sentence_ids in enumerate(digitize(self._vocab, sentences)):
+                ids[i, :lengths[i]] = sentence_ids
+                mask[i, :lengths[i]] = 1
+            inputs[name] = ids
+            inputs[name + '_mask'] = mask
+        return inputs
+
+    def __call__(self, pairs):
+        return self._function(**self.inputs(pairs))
+
+
+def load_predictor(model, config, tar_path, lowercase=False, **kwargs):
+    """Loads a trained `simple` or `esim` model like `evaluate` does.
+
+    `kwargs` override the config, e.g. `def_table_path`.
+
+    """
+    from dictlearn.nli_training import (
+        load_evaluation_config, build_prediction_graph, load_checkpoint)
+    c = load_evaluation_config(config, model=model, **kwargs)
+    _, data, retrieval, cg, bn_params = build_prediction_graph(c, model)
+    load_checkpoint(Model(cg.outputs), cg, bn_params, tar_path)
+    pred, = cg.outputs
+    return NLIPredictor(function(cg.inputs, pred, name='predict'),
+                        data.vocab, retrieval, lowercase=lowercase)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _reply(self, code, content):
+        body = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._reply(200, self.server.batcher.metrics.snapshot())
+        else:
+            self._reply(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._reply(404, {'error': 'unknown path ' + self.path})
+            return
+        try:
+            length = int(self.headers.getheader('Content-Length', 0))
+            pairs = json.loads(self.rfile.read(length))['pairs']
+            if not all(len(pair) == 2 for pair in pairs):
+                raise ValueError("a pair must have two sentences")
+            # a bad pair would fail the whole batch it is scored in
+            if not all(isinstance(sentence, basestring) and sentence.strip()
+                       for pair in pairs for sentence in pair):
+                raise ValueError("the sentences must be non-empty strings")
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': 'bad request: {}'.format(e)})
+            return
+        try:
+            probabilities = self.server.batcher.predict(
+                pairs, timeout=self.server.timeout_)
+        except RuntimeError as e:
+            self._reply(503, {'error': str(e)})
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+        else:
+            self._reply(200, {'labels': LABELS,
+                              'probabilities': numpy.asarray(probabilities).tolist()})
+
+    def address_string(self):
+        # the clients of a Unix socket have no address
+        return str(self.client_address)
+
+    def log_message(self, format, *args):
+        logger.debug("%s: %s", self.address_string(), format % args)
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(batcher, address, timeout=None):
+    """Creates the HTTP server of a `MicroBatcher`.
+
+    Parameters
+    ----------
+    address : tuple or str
+        A `(host, port)` pair, or the path of a Unix socket.
+    timeout : float
+        The maximum time in seconds a request waits for its answer,
+        the server answers 503 after it.
+
+    """
+    if isinstance(address, basestring):
+        if os.path.exists(address):
+            os.remove(address)
+        server = _UnixServer(address, _Handler)
+    else:
+        server = _TCPServer(address, _Handler)
+    server.batcher = batcher
+    server.timeout_ = timeout
+    return server
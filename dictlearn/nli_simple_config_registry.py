@@ -36,6 +36,8 @@ snli_config_registry.set_root_config({
     "combiner_shortcut": False,
     'reader_type': 'rnn',
     'share_def_lookup': False,
+    'def_reader_buckets': 1, # length buckets of the rnn reader
+    'def_cache_max_age': 0, # when 0: definitions are read at every step
     'combiner_bn': False,
 
     'num_input_words': 0, # Will take vocab size
@@ -45,10 +47,16 @@ snli_config_registry.set_root_config({
     "dropout": 0.3,
     'batch_size': 512,
     'lr': 0.001,
+    # parameter name regexp -> 'adam' or 'sgd', for row-wise updates
+    # of lookup tables
+    'sparse_updates': {},
     'l2': 4e-6,
 
     # Misc
     'monitor_parameters': 0,
+    # when False: the diagnostics are computed on the last batch every
+    # mon_freq batches instead of by the training function
+    'monitor_every_batch': False,
     'mon_freq': 1000,
     'save_freq_epochs': 1,
     'mon_freq_valid': 1000,
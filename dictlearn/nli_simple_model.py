@@ -9,6 +9,9 @@ TODO: Recurrent dropout
 TODO: Pass translate intelligently
 TODO: Debug simlex?
 """
+import json
+
+import numpy
 import theano
 import theano.tensor as T
 from theano import tensor
@@ -25,8 +28,9 @@ from blocks.bricks.lookup import LookupTable
 from blocks.initialization import IsotropicGaussian, Constant, NdarrayInitialization, Uniform
 
 from dictlearn.inits import GlorotUniform
-from dictlearn.lookup import MeanPoolCombiner, LSTMReadDefinitions, MeanPoolReadDefinitions
-from dictlearn.theano_util import apply_dropout
+from dictlearn.lookup import (
+    MeanPoolCombiner, LSTMReadDefinitions, MeanPoolReadDefinitions, DefinitionCache)
+from dictlearn.theano_util import apply_dropout, is_required
 
 class NLISimple(Initializable):
     """
@@ -43,7 +47,7 @@ class NLISimple(Initializable):
             combiner_dropout_type="regular", share_def_lookup=False, exclude_top_k=-1,
             combiner_reader_translate=True, def_vocab=None, def_emb_dim=-1,
             combiner_gating="none", def_emb_translate_dim=-1,
-            combiner_shortcut=False,
+            combiner_shortcut=False, def_reader_buckets=1, def_cache_max_age=0,
             # Others
             **kwargs):
 
@@ -58,11 +62,13 @@ class NLISimple(Initializable):
         self._encoder = encoder
         self._dropout = dropout
         self._retrieval = retrieval
+        self._def_table = None
+        self._def_cache = None
         self._only_def = disregard_word_embeddings
         self._num_input_def_words = num_input_def_words
         self._translate_after_emb = translate_after_emb
 
-        if reader_type not in {"rnn", "mean"}:
+        if reader_type not in {"rnn", "mean", "sparse_mean"}:
             raise NotImplementedError("Not implemented " + reader_type)
 
         if num_input_words > 0:
@@ -92,14 +98,16 @@ class NLISimple(Initializable):
             if reader_type== "rnn":
                 self._def_reader = LSTMReadDefinitions(num_input_words=self._num_input_def_words,
                     dim=def_emb_translate_dim,
-                    emb_dim=def_emb_dim, vocab=def_vocab, lookup=def_lookup)
-            elif reader_type == "mean":
+                    emb_dim=def_emb_dim, vocab=def_vocab, lookup=def_lookup,
+                    num_buckets=def_reader_buckets)
+            elif reader_type in {"mean", "sparse_mean"}:
                 if combiner_reader_translate:
                     logger.warning("Translate in MeanPoolReadDefinitions is redundant")
                 self._def_reader = MeanPoolReadDefinitions(num_input_words=self._num_input_def_words,
                     translate=combiner_reader_translate,
                     lookup=def_lookup, dim=def_emb_translate_dim,
-                    emb_dim=def_emb_dim, vocab=def_vocab)
+                    emb_dim=def_emb_dim, vocab=def_vocab,
+                    sparse=(reader_type == "sparse_mean"))
 
             self._combiner = MeanPoolCombiner(dim=def_dim, emb_dim=def_emb_translate_dim,
                 dropout=combiner_dropout, dropout_type=combiner_dropout_type,
@@ -109,6 +117,12 @@ class NLISimple(Initializable):
                 compose_type=compose_type)
             children.extend([self._def_reader, self._combiner])
 
+            if def_cache_max_age > 0:
+                self._def_cache = DefinitionCache(
+                    self._def_reader, self._combiner, vocab.size(),
+                    def_cache_max_age, vocab.unk, name='def_cache')
+                children.append(self._def_cache)
+
             if self._encoder == "rnn":
                 self._rnn_fork = Linear(input_dim=def_emb_dim, output_dim=4 * translate_dim)
                 # TODO(kudkudak): Better LSTM weight init
@@ -183,16 +197,106 @@ class NLISimple(Initializable):
     def get_def_embeddings_lookups(self):
         return [self._def_reader._def_lookup]
 
-    def set_def_embeddings(self, embeddings):
-        self._def_reader._def_lookup.parameters[0].set_value(embeddings.astype(theano.config.floatX))
-
-    def set_embeddings(self, embeddings):
-        self._lookup.parameters[0].set_value(embeddings.astype(theano.config.floatX))
+    def set_def_embeddings(self, embeddings, borrow=False):
+        self._def_reader._def_lookup.parameters[0].set_value(
+            embeddings.astype(theano.config.floatX, copy=False), borrow=borrow)
+
+    def set_embeddings(self, embeddings, borrow=False):
+        self._lookup.parameters[0].set_value(
+            embeddings.astype(theano.config.floatX, copy=False), borrow=borrow)
+
+    def set_def_table(self, table):
+        """Use precomputed definition embeddings instead of the reader.
+
+        Has to be called before `apply`. See `dictlearn.def_embeddings`.
+
+        """
+        self._def_table = theano.shared(
+            table.astype(theano.config.floatX, copy=False), name='def_table', borrow=True)
+
+    def export_numpy(self, path, def_table=None):
+        """Saves the model for `dictlearn.nli_numpy`.
+
+        Parameters
+        ----------
+        path : str
+            The destination `.npz` file.
+        def_table : numpy.ndarray
+            The precomputed definition embeddings, required if the model
+            uses definitions.
+
+        """
+        if self._only_def:
+            raise NotImplementedError("models without word embeddings can not be exported")
+        if self._retrieval is not None and def_table is None:
+            raise ValueError("the model uses definitions, a def_table is required")
+
+        def value(variable):
+            if hasattr(variable, 'get_value'):
+                return variable.get_value()
+            return variable.eval()
+
+        arrays = {'lookup': self._lookup.W.get_value()}
+
+        def add_linear(name, brick):
+            arrays[name + '.W'] = brick.W.get_value()
+            arrays[name + '.b'] = brick.b.get_value()
+
+        def add_bn(name, brick):
+            arrays[name + '.mean'] = brick.population_mean.get_value()
+            arrays[name + '.stdev'] = (
+                numpy.ones_like(arrays[name + '.mean'])
+                if getattr(brick, 'mean_only', False)
+                else brick.population_stdev.get_value())
+            arrays[name + '.scale'] = value(brick.scale) * numpy.ones_like(arrays[name + '.mean'])
+            arrays[name + '.shift'] = value(brick.shift) * numpy.ones_like(arrays[name + '.mean'])
+
+        config = {'encoder': self._encoder, 'bn': self._bn,
+                  'n_layers': len(self._mlp),
+                  'num_input_words': self._num_input_words,
+                  'unk': self._vocab.unk,
+                  'use_definitions': self._retrieval is not None,
+                  'translate_after_emb': self._translate_after_emb,
+                  'translate_pre_def': False}
+        if self._retrieval is not None:
+            combiner = self._combiner
+            arrays['def_table'] = def_table
+            config.update({
+                'translate_pre_def': self._translate_pre_def is not None,
+                'compose_type': combiner._compose_type,
+                'shortcut_unk_and_excluded': combiner._shortcut_unk_and_excluded,
+                'exclude_top_k': combiner._exclude_top_K})
+            if self._translate_pre_def:
+                add_linear('translate_pre_def', self._translate_pre_def)
+            if hasattr(combiner, '_def_state_transform'):
+                add_linear('state_transform', combiner._def_state_transform)
+            if hasattr(combiner, '_compose_gate_mlp'):
+                add_linear('compose_gate', combiner._compose_gate_mlp)
+            if hasattr(combiner, '_def_state_compose'):
+                add_linear('def_state_compose',
+                           combiner._def_state_compose.linear_transformations[0])
+        if self._translate_after_emb:
+            add_linear('translation', self._translation)
+        if self._encoder == 'rnn':
+            add_linear('rnn_fork', self._rnn_fork)
+            for name in ['W_state', 'W_cell_to_in', 'W_cell_to_forget',
+                         'W_cell_to_out', 'initial_cells']:
+                arrays['lstm.' + name] = getattr(self._rnn_encoder, name).get_value()
+            arrays['lstm.initial_state'] = self._rnn_encoder.initial_state_.get_value()
+        if self._bn:
+            add_bn('prem_bn', self._prem_bn)
+            add_bn('hyp_bn', self._hyp_bn)
+        for i, (dense, _, bn) in enumerate(self._mlp):
+            add_linear('mlp_{}'.format(i), dense)
+            if bn:
+                add_bn('bn_{}'.format(i), bn)
+        add_linear('pred', self._pred.linear_transformations[0])
+        numpy.savez(path, config=numpy.array(json.dumps(config)), **arrays)
 
     @application
     def apply(self, application_call,
             s1_preunk, s1_mask, s2_preunk, s2_mask, def_mask=None, defs=None, s1_def_map=None,
-            s2_def_map=None, train_phase=True):
+            s2_def_map=None, train_phase=True, auxiliary=None):
         # Shortlist words (sometimes we want smaller vocab, especially when dict is small)
         s1 = (tensor.lt(s1_preunk, self._num_input_words) * s1_preunk
               + tensor.ge(s1_preunk, self._num_input_words) * self._vocab.unk)
@@ -203,12 +307,13 @@ class NLISimple(Initializable):
         s1_emb = self._lookup.apply(s1)
         s2_emb = self._lookup.apply(s2)
 
-        application_call.add_auxiliary_variable(
-            1 * s1_emb,
-            name='s1_word_embeddings')
+        if is_required(auxiliary, 's1_word_embeddings'):
+            application_call.add_auxiliary_variable(
+                1 * s1_emb,
+                name='s1_word_embeddings')
 
         if self._retrieval is not None:
-            assert defs is not None
+            assert defs is not None or self._def_table is not None
 
             if self._translate_pre_def:
                 logger.info("Translate pre def")
@@ -219,15 +324,38 @@ class NLISimple(Initializable):
                 s1_emb = s1_emb.reshape((s1_preunk.shape[0], s1_preunk.shape[1], -1))
                 s2_emb = s2_emb.reshape((s2_preunk.shape[0], s2_preunk.shape[1], -1))
 
-            def_embs = self._def_reader.apply(defs, def_mask)
+            if self._def_table is not None:
+                s1_def_mean = self._def_table[s1_preunk]
+                s2_def_mean = self._def_table[s2_preunk]
+            elif self._def_cache and train_phase:
+                s1_def_mean, s2_def_mean = self._def_cache.apply(
+                    defs, def_mask, [s1_preunk, s2_preunk], [s1_def_map, s2_def_map],
+                    auxiliary=auxiliary)
+            else:
+                s1_def_mean = s2_def_mean = None
+
+            if s1_def_mean is not None:
+                s1_transl = self._combiner.apply_precomputed(
+                    s1_emb, s1_mask, s1_def_mean,
+                    word_ids=s1, train_phase=train_phase, call_name="s1",
+                    auxiliary=auxiliary)
+
+                s2_transl = self._combiner.apply_precomputed(
+                    s2_emb, s2_mask, s2_def_mean,
+                    word_ids=s2, train_phase=train_phase, call_name="s2",
+                    auxiliary=auxiliary)
+            else:
+                def_embs = self._def_reader.apply(defs, def_mask, auxiliary=auxiliary)
 
-            s1_transl = self._combiner.apply(
-                s1_emb, s1_mask,
-                def_embs, s1_def_map, word_ids=s1, train_phase=train_phase, call_name="s1")
+                s1_transl = self._combiner.apply(
+                    s1_emb, s1_mask,
+                    def_embs, s1_def_map, word_ids=s1, train_phase=train_phase, call_name="s1",
+                    auxiliary=auxiliary)[0]
 
-            s2_transl = self._combiner.apply(
-                s2_emb, s2_mask,
-                def_embs, s2_def_map, word_ids=s2, train_phase=train_phase, call_name="s2")
+                s2_transl = self._combiner.apply(
+                    s2_emb, s2_mask,
+                    def_embs, s2_def_map, word_ids=s2, train_phase=train_phase, call_name="s2",
+                    auxiliary=auxiliary)[0]
 
             if self._translate_after_emb:
                 # Note: for some reader/combiner it can be redundant, but let's keep it
@@ -253,9 +381,10 @@ class NLISimple(Initializable):
                 s2_transl = self._translation_act.apply(s2_transl)
                 s1_transl = s1_transl.reshape((s1_emb.shape[0], s1_emb.shape[1], -1))
                 s2_transl = s2_transl.reshape((s2_emb.shape[0], s2_emb.shape[1], -1))
-                application_call.add_auxiliary_variable(
-                    1*s1_transl,
-                    name='s1_translated_word_embeddings')
+                if is_required(auxiliary, 's1_translated_word_embeddings'):
+                    application_call.add_auxiliary_variable(
+                        1*s1_transl,
+                        name='s1_translated_word_embeddings')
                 assert s1_transl.ndim == 3
             else:
                 s1_transl = s1_emb_flatten
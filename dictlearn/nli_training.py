@@ -27,6 +27,9 @@ from blocks.initialization import Constant, Uniform
 from dictlearn.vocab import Vocabulary
 from dictlearn.inits import GlorotUniform
 from dictlearn.extensions import LoadNoUnpickling
+from dictlearn.embedding_store import EmbeddingStore, sync_references
+from dictlearn.sparse_updates import rules_from_config, sparse_updates
+from dictlearn.function_cache import CachedGradientDescent, function
 
 import os
 import time
@@ -37,16 +40,16 @@ import pprint
 import pandas as pd
 import subprocess
 import tqdm
-import cPickle as pickle
 import json
 import numpy
 import theano
 import logging
+from collections import OrderedDict
 
 from theano import tensor as T
 
 from blocks.algorithms import (
-    GradientDescent, Adam)
+    Adam)
 from blocks.graph import ComputationGraph, apply_batch_normalization, get_batch_normalization_updates
 from blocks.model import Model
 from blocks.graph.bn import (
@@ -62,9 +65,9 @@ from blocks.filter import VariableFilter
 
 from fuel.streams import ServerDataStream
 
-from dictlearn.util import configure_logger
+from dictlearn.util import configure_logger, checkpoint_paths, write_results_table
 from dictlearn.extensions import StartFuelServer, DumpCSVSummaries, SimilarityWordEmbeddingEval, construct_embedder, \
-    construct_dict_embedder, RetrievalPrintStats, PrintMessage
+    construct_dict_embedder, RetrievalPrintStats, PrintMessage, LastBatchMonitoring
 from dictlearn.data import SNLIData
 from dictlearn.nli_simple_model import NLISimple
 from dictlearn.nli_esim_model import ESIM
@@ -95,6 +98,13 @@ class OnLogStatusExceed(object):
                 other.record_name == self.record_name)
 
 
+def _load_embeddings(setter, path, frozen):
+    # Frozen embeddings are used directly from the memory map, so that
+    # the jobs running on the same machine share them.
+    store = EmbeddingStore.get(path)
+    setter(store.as_dtype(theano.config.floatX, frozen=frozen), borrow=frozen)
+
+
 # vocab defaults to data.vocab
 # vocab_text defaults to vocab
 # Vocab def defaults to vocab
@@ -154,6 +164,8 @@ def _initialize_simple_model_and_data(c):
         combiner_gating=c['combiner_gating'], combiner_shortcut=c['combiner_shortcut'],
         combiner_reader_translate=c['combiner_reader_translate'], def_dim=c['def_dim'],
         num_input_def_words=c['num_input_def_words'], def_emb_translate_dim=def_emb_translate_dim,
+        def_reader_buckets=c.get('def_reader_buckets', 1),
+        def_cache_max_age=c.get('def_cache_max_age', 0),
 
         # Init
         weights_init=GlorotUniform(), biases_init=Constant(0.0)
@@ -164,12 +176,12 @@ def _initialize_simple_model_and_data(c):
     simple.initialize()
 
     if c.get('embedding_def_path', ''):
-        embeddings = np.load(c['embedding_def_path'])
-        simple.set_def_embeddings(embeddings.astype(theano.config.floatX))
+        _load_embeddings(simple.set_def_embeddings, c['embedding_def_path'],
+                         frozen=not c.get('train_def_emb', 1))
 
     if c['embedding_path']:
-        embeddings = np.load(c['embedding_path'])
-        simple.set_embeddings(embeddings.astype(theano.config.floatX))
+        _load_embeddings(simple.set_embeddings, c['embedding_path'],
+                         frozen=not c['train_emb'])
 
     return simple, data, dict, retrieval, vocab
 
@@ -220,12 +232,13 @@ def _initialize_esim_model_and_data(c):
             def_reader = LSTMReadDefinitions(num_input_words=num_input_def_words,
                 weights_init=Uniform(width=0.1), biases_init=Constant(0.), dim=c['def_dim'],
                 emb_dim=def_emb_dim,
-                vocab=vocab, lookup=None)
-        elif c['reader_type'] == "mean":
+                vocab=vocab, lookup=None, num_buckets=c.get('def_reader_buckets', 1))
+        elif c['reader_type'] in {"mean", "sparse_mean"}:
            def_reader = MeanPoolReadDefinitions(num_input_words=num_input_def_words,
                 translate=c['combiner_reader_translate'], vocab=vocab,
                 weights_init=Uniform(width=0.1), lookup=None, dim=def_emb_translate_dim,
-                biases_init=Constant(0.), emb_dim=def_emb_dim)
+                biases_init=Constant(0.), emb_dim=def_emb_dim,
+                sparse=(c['reader_type'] == "sparse_mean"))
         else:
             raise NotImplementedError()
 
@@ -253,6 +266,7 @@ def _initialize_esim_model_and_data(c):
         bn=c.get('bn', True),
 
         def_combiner=def_combiner, def_reader=def_reader,
+        def_cache_max_age=c.get('def_cache_max_age', 0),
 
         # Init
         weights_init=GlorotUniform(), biases_init=Constant(0.0)
@@ -265,12 +279,12 @@ def _initialize_esim_model_and_data(c):
     simple.initialize()
 
     if c['embedding_path']:
-        embeddings = np.load(c['embedding_path'])
-        simple.set_embeddings(embeddings.astype(theano.config.floatX))
+        _load_embeddings(simple.set_embeddings, c['embedding_path'],
+                         frozen=not c['train_emb'])
 
     if c.get('embedding_def_path', ''):
-        embeddings = np.load(c['embedding_def_path'])
-        simple.set_def_embeddings(embeddings.astype(theano.config.floatX))
+        _load_embeddings(simple.set_def_embeddings, c['embedding_def_path'],
+                         frozen=not c.get('train_def_emb', 1))
 
     return simple, data, dict, retrieval, vocab
 
@@ -306,6 +320,10 @@ def train_snli_model(new_training_job, config, save_path, params, fast_start, fu
         nli_model, data, used_dict, used_retrieval, _ = _initialize_esim_model_and_data(c)
     else:
         raise NotImplementedError()
+    sync_references(
+        save_path,
+        {key: c.get(key, '') for key in ['embedding_path', 'embedding_def_path']},
+        new_training_job)
 
     # Compute cost
     s1, s2 = T.lmatrix('sentence1'), T.lmatrix('sentence2')
@@ -402,13 +420,23 @@ def train_snli_model(new_training_job, config, save_path, params, fast_start, fu
     train_params = [p for p in cg[True].parameters if p not in frozen_params]
     train_params_keys = [get_brick(p).get_hierarchical_name(p) for p in train_params]
 
+    # Row-wise updates of the lookup tables
+    adam = Adam(learning_rate=c['lr'])
+    sparse_rules = rules_from_config(
+        dict(zip(train_params_keys, train_params)),
+        c.get('sparse_updates', {}), adam.learning_rate)
+    sparse_params, lookup_updates = sparse_updates(final_cost, sparse_rules)
+
     # Optimizer
-    algorithm = GradientDescent(
+    algorithm = CachedGradientDescent(
         cost=final_cost,
         on_unused_sources='ignore',
-        parameters=train_params,
-        step_rule=Adam(learning_rate=c['lr']))
+        parameters=[p for p in train_params if p not in sparse_params],
+        step_rule=adam)
     algorithm.add_updates(extra_updates)
+    algorithm.add_updates(lookup_updates)
+    if c.get('def_cache_max_age', 0):
+        algorithm.add_updates(cg[True].updates)
     m = Model(final_cost)
 
     parameters = m.get_parameter_dict()  # Blocks version mismatch
@@ -424,20 +452,33 @@ def train_snli_model(new_training_job, config, save_path, params, fast_start, fu
     train_monitored_vars = [final_cost] + cg[True].outputs
     monitored_vars = cg[False].outputs
     val_acc = monitored_vars[1]
+    # Unless asked otherwise, the diagnostics are computed on the last
+    # batch every `mon_freq` batches by a separate function
+    monitor_every_batch = c.get('monitor_every_batch', False)
+    if monitor_every_batch:
+        batch_monitored_vars = train_monitored_vars
+    else:
+        batch_monitored_vars = []
     to_monitor_names = ['def_unk_ratio', 's1_merged_input_rootmean2', 's1_def_mean_rootmean2',
         's1_gate_rootmean2', 's1_compose_gate_rootmean2']
     for k in to_monitor_names:
         train_v, valid_v = VariableFilter(name=k)(cg[True]), VariableFilter(name=k)(cg[False])
         if len(train_v):
             logger.info("Adding {} tracking".format(k))
-            train_monitored_vars.append(train_v[0])
+            batch_monitored_vars.append(train_v[0])
             monitored_vars.append(valid_v[0])
         else:
             logger.warning("Didnt find {} in cg".format(k))
+    if c.get('def_cache_max_age', 0):
+        # the cache is only used in the training graph
+        for k in ['def_cache_hit_rate', 'def_cache_staleness']:
+            train_monitored_vars.append(VariableFilter(name=k)(cg[True])[0])
 
     if c['monitor_parameters']:
         for name in train_params_keys:
             param = parameters[name]
+            if param in sparse_params:
+                continue
             num_elements = numpy.product(param.get_value().shape)
             norm = param.norm(2) / num_elements
             grad_norm = algorithm.gradients[param].norm(2) / num_elements
@@ -477,6 +518,11 @@ def train_snli_model(new_training_job, config, save_path, params, fast_start, fu
             train_monitored_vars, prefix="train",
             every_n_batches=c['mon_freq']),
     ]
+    if not monitor_every_batch and batch_monitored_vars:
+        extensions.append(
+            LastBatchMonitoring(
+                batch_monitored_vars, prefix="train",
+                every_n_batches=c['mon_freq']))
 
     if c['layout'] == 'snli':
         validation = DataStreamMonitoring(
@@ -526,13 +572,14 @@ def train_snli_model(new_training_job, config, save_path, params, fast_start, fu
 
             if "dict" in name:
                 embedder = construct_dict_embedder(
-                    theano.function([s1, defs, def_mask, s1_def_map], s1_emb, allow_input_downcast=True),
+                    function([s1, defs, def_mask, s1_def_map], s1_emb, name=name,
+                             allow_input_downcast=True),
                     vocab=data.vocab, retrieval=retrieval_all)
                 extensions.append(
                     SimilarityWordEmbeddingEval(embedder=embedder, prefix=name, every_n_batches=c['mon_freq_valid'],
                         before_training=not fast_start))
             else:
-                embedder = construct_embedder(theano.function([s1], s1_emb, allow_input_downcast=True),
+                embedder = construct_embedder(function([s1], s1_emb, name=name, allow_input_downcast=True),
                     vocab=data.vocab)
                 extensions.append(
                     SimilarityWordEmbeddingEval(embedder=embedder, prefix=name, every_n_batches=c['mon_freq_valid'],
@@ -615,18 +662,12 @@ def train_snli_model(new_training_job, config, save_path, params, fast_start, fu
     main_loop.run()
 
 
-def evaluate(c, tar_path, *args, **kwargs):
-    """
-    Performs rudimentary evaluation of SNLI/MNLI run
+def load_evaluation_config(c, **kwargs):
+    """Loads the config of a trained NLI model for its evaluation.
 
-    * Runs on valid and test given network
-    * Saves all predictions
-    * Saves embedding matrix
-    * Saves results.json and predictions.csv
-    """
+    The data paths are made absolute and `kwargs` override the config.
 
-    # Load and configure
-    model = kwargs['model']
+    """
     assert c.endswith("json")
     c = json.load(open(c))
 
@@ -653,14 +694,28 @@ def evaluate(c, tar_path, *args, **kwargs):
     # NOTE: This assures we don't miss crucial definition for some def heavy words
     # usually it is a good idea
     c['max_def_per_word'] = c['max_def_per_word'] * 2
+    return c
 
-    assert tar_path.endswith("tar")
-    dest_path = os.path.dirname(tar_path)
-    prefix = os.path.splitext(os.path.basename(tar_path))[0]
 
+def build_prediction_graph(c, model, auxiliary=()):
+    """Builds the inference graph of a `simple` or `esim` model.
+
+    Returns
+    -------
+    model : Brick
+    data : SNLIData
+    used_retrieval : Retrieval
+        `None` if the model does not read definitions, or uses a table
+        of precomputed definition embeddings.
+    cg : ComputationGraph
+        The graph of the predicted probabilities.
+    bn_params : list
+        The population statistics of the batch normalization.
+
+    """
     s1_decoded, s2_decoded = T.lmatrix('sentence1'), T.lmatrix('sentence2')
 
-    if c['dict_path']:
+    if c['dict_path'] and not c.get('def_table_path', ''):
         s1_def_map, s2_def_map = T.lmatrix('sentence1_def_map'), T.lmatrix('sentence2_def_map')
         def_mask = T.fmatrix("def_mask")
         defs = T.lmatrix("defs")
@@ -678,31 +733,34 @@ def evaluate(c, tar_path, *args, **kwargs):
     else:
         raise NotImplementedError()
 
+    if c.get('def_table_path', ''):
+        logging.info("Using precomputed definition embeddings from " + c['def_table_path'])
+        model.set_def_table(EmbeddingStore.get(c['def_table_path']).matrix)
+        data.set_retrieval(None)
+        used_retrieval = None
+
     pred = model.apply(s1_decoded, s1_mask, s2_decoded, s2_mask, def_mask=def_mask, defs=defs, s1_def_map=s1_def_map,
-        s2_def_map=s2_def_map, train_phase=False)
+        s2_def_map=s2_def_map, train_phase=False, auxiliary=set(auxiliary))
 
     cg = ComputationGraph([pred])
     if c.get("bn", True):
         bn_params = [p for p in VariableFilter(bricks=[BatchNormalization])(cg) if hasattr(p, "set_value")]
     else:
         bn_params = []
+    return model, data, used_retrieval, cg, bn_params
 
-    to_evaluate = {"pred": pred}
-    if kwargs['model'] == "esim":
-        s2s_att_weights, = VariableFilter(name='s2s_att_weights')(cg)
-        to_evaluate.update({'s2s_att_weights': s2s_att_weights})
 
-    # Load model
-    model = Model(cg.outputs)
-    parameters = model.get_parameter_dict()  # Blocks version mismatch
-    logging.info("Trainable parameters" + "\n" +
-                pprint.pformat(
-                    [(key, parameters[key].get_value().shape)
-                        for key in sorted([get_brick(param).get_hierarchical_name(param) for param in cg.parameters])],
-                    width=120))
-    logging.info("# of parameters {}".format(
-        sum([np.prod(parameters[key].get_value().shape)
-            for key in sorted([get_brick(param).get_hierarchical_name(param) for param in cg.parameters])])))
+def load_checkpoint(model, cg, bn_params, tar_path):
+    """Sets the parameters and the batch normalization statistics.
+
+    Parameters
+    ----------
+    model : Model
+        The model of `cg`.
+    bn_params : list
+        The population statistics, see `build_prediction_graph`.
+
+    """
     with open(tar_path) as src:
         params = load_parameters(src)
 
@@ -715,13 +773,61 @@ def evaluate(c, tar_path, *args, **kwargs):
         logging.info(model_params_set - loaded_params_set)
     model.set_parameter_values(params)
 
-    if c.get("bn", True):
+    if bn_params:
         logging.info("Loading " + str([get_brick(param).get_hierarchical_name(param) for param in bn_params]))
         for param in bn_params:
             param.set_value(params[get_brick(param).get_hierarchical_name(param)])
         for p in bn_params:
             model._parameter_dict[get_brick(p).get_hierarchical_name(p)] = p
 
+
+# The arguments of the evaluation scripts that only `evaluate` understands,
+# see `dictlearn.main.main_evaluate`
+EVALUATE_ARGUMENTS = [
+    (["--def-table"],
+     dict(dest="def_table_path",
+          help="Precomputed definition embeddings, see bin/precompute_def_embeddings.py"))]
+
+
+def evaluate(c, tar_path, *args, **kwargs):
+    """
+    Performs rudimentary evaluation of SNLI/MNLI run
+
+    * Runs on valid and test given network
+    * Saves all predictions
+    * Saves embedding matrix
+    * Saves results.json and predictions.csv
+    """
+
+    # Load and configure
+    c = load_evaluation_config(c, **kwargs)
+
+    assert tar_path.endswith("tar")
+    dest_path = os.path.dirname(tar_path)
+
+    # only build the auxiliary variables that are saved below
+    auxiliary = {'s2s_att_weights'} if kwargs['model'] == 'esim' else set()
+    model, data, used_retrieval, cg, bn_params = build_prediction_graph(
+        c, kwargs['model'], auxiliary)
+    used_vocab = data.vocab
+    pred, = cg.outputs
+
+    to_evaluate = {"pred": pred}
+    if kwargs['model'] == "esim":
+        s2s_att_weights, = VariableFilter(name='s2s_att_weights')(cg)
+        to_evaluate.update({'s2s_att_weights': s2s_att_weights})
+
+    # Load model
+    model = Model(cg.outputs)
+    parameters = model.get_parameter_dict()  # Blocks version mismatch
+    logging.info("Trainable parameters" + "\n" +
+                pprint.pformat(
+                    [(key, parameters[key].get_value().shape)
+                        for key in sorted([get_brick(param).get_hierarchical_name(param) for param in cg.parameters])],
+                    width=120))
+    logging.info("# of parameters {}".format(
+        sum([np.prod(parameters[key].get_value().shape)
+            for key in sorted([get_brick(param).get_hierarchical_name(param) for param in cg.parameters])])))
     # Read logs
     logs = pd.read_csv(os.path.join(dest_path, "logs.csv"))
     best_val_acc = logs['valid_misclassificationrate_apply_error_rate'].min()
@@ -751,86 +857,121 @@ def evaluate(c, tar_path, *args, **kwargs):
     #             logging.info("Calculating {} embeddings for {}".format(name, v_name))
 
     # Predict
-    predict_fnc = theano.function(cg.inputs, to_evaluate)
-    results = {}
+    predict_fnc = function(cg.inputs, to_evaluate, name='predict')
     batch_size = 14
-    for subset in ['valid', 'test']:
-        logging.info("Predicting on " + subset)
-        stream = data.get_stream(subset, batch_size=batch_size, seed=778)
-        it = stream.get_epoch_iterator()
-        rows = []
-        logs = []
-        for ex in tqdm.tqdm(it, total=10000/batch_size):
-            ex = dict(zip(stream.sources, ex))
-            inp = [ex[v.name] for v in cg.inputs]
-            outs = predict_fnc(*inp)
-            pred = outs['pred']
-            label_pred = np.argmax(pred, axis=1)
-
-
-
-            for id in range(len(pred)):
-                s1_decoded = used_vocab.decode(ex['sentence1'][id]).split()
-                s2_decoded = used_vocab.decode(ex['sentence2'][id]).split()
-
-                assert used_vocab == data.vocab
-
-                s1_decoded = ['*' + w + '*' if used_vocab.word_to_id(w) > c['num_input_words'] else w for w in s1_decoded]
-                s2_decoded = ['*' + w + '*' if used_vocab.word_to_id(w) > c['num_input_words'] else w for w in s2_decoded]
-
-                # Different difficulty metrics
-
-                # text_unk_percentage
-                s1_no_pad = [w for w in ex['sentence1'][id] if w != 0]
-                s2_no_pad = [w for w in ex['sentence2'][id] if w != 0]
-
-                s1_unk_percentage = sum([1. for w in s1_no_pad if w == used_vocab.unk]) / len(s1_no_pad)
-                s2_unk_percentage = sum([1. for w in s1_no_pad if w == used_vocab.unk]) / len(s2_no_pad)
-
-                # mean freq word
-                s1_mean_freq = np.mean([0 if w == data.vocab.unk else used_vocab._id_to_freq[w] for w in s1_no_pad])
-                s2_mean_freq = np.mean([0 if w == data.vocab.unk else used_vocab._id_to_freq[w] for w in s2_no_pad])
-
-                # mean rank word (UNK is max rank)
-                # NOTE(kudkudak): Will break if we reindex unk between vocabs :P
-                s1_mean_rank = np.mean([reference_vocab.size() if
-                    reference_vocab.word_to_id(used_vocab.id_to_word(w)) == reference_vocab.unk
-                    else reference_vocab.word_to_id(used_vocab.id_to_word(w)) for w in s1_no_pad])
-
-                s2_mean_rank = np.mean([reference_vocab.size()
-                    if reference_vocab.word_to_id(used_vocab.id_to_word(w)) == reference_vocab.unk else
-                    reference_vocab.word_to_id(used_vocab.id_to_word(w)) for w in s2_no_pad])
-
-                rows.append({"pred": label_pred[id], "true_label": ex['label'][id],
-                    "s1": ' '.join(s1_decoded),
-                    "s2": ' '.join(s2_decoded),
-                    "s1_unk_percentage": s1_unk_percentage,
-                    "s2_unk_percentage": s2_unk_percentage,
-                    "s1_mean_freq": s1_mean_freq,
-                    "s2_mean_freq": s2_mean_freq,
-                    "s1_mean_rank": s1_mean_rank,
-                    "s2_mean_rank": s2_mean_rank,
-                    "p_0": pred[id, 0], "p_1": pred[id, 1], "p_2": pred[id, 2]})
-
-                if kwargs['model'] == "esim":
-                    # valid/test in SNLI are small so this format should be fine
-                    logs.append({"s2s_att_weights": outs['s2s_att_weights'][id]})
-
-        preds = pd.DataFrame(rows, columns=rows[0].keys())
-        preds.to_csv(os.path.join(dest_path, prefix + '_predictions_{}.csv'.format(subset)))
-        pickle.dump(logs, open(os.path.join(dest_path, prefix + '_logs_{}.pkl'.format(subset)), "w"))
-
-        results[subset] = {}
-        results[subset]['misclassification'] = 1 - np.mean(preds.pred == preds.true_label)
-
-        if subset == "valid" and np.abs(( 1 - np.mean(preds.pred == preds.true_label)) - best_val_acc) > 0.001:
-            logging.error("!!!")
-            logging.error("Found different best_val_acc. Probably due to changed specification of the model class.")
-            logging.error("Discrepancy {}".format(( 1 - np.mean(preds.pred == preds.true_label)) - best_val_acc))
-            logging.error("!!!")
-
-        logging.info(results)
-
-    json.dump(results, open(os.path.join(dest_path, prefix + '_results.json'), "w"))
+    streams = {subset: data.get_stream(subset, batch_size=batch_size, seed=778)
+               for subset in ['valid', 'test']}
+    write_chunk_size = 1000
+
+    # The per-word statistics of the report are looked up in arrays
+    # indexed by the ids of the used vocabulary
+    words = np.array(used_vocab.words, dtype=object)
+    marked_words = np.where(np.arange(used_vocab.size()) > c['num_input_words'],
+                            ['*' + w + '*' for w in words], words)
+    freqs = np.array(used_vocab.frequencies, dtype='float64')
+    freqs[used_vocab.unk] = 0
+    # the rank of a word is its id in the reference vocabulary,
+    # unknown words have the maximum rank
+    ranks = reference_vocab.words_to_ids(used_vocab.words).astype('float64')
+    ranks[ranks == reference_vocab.unk] = reference_vocab.size()
+
+    def evaluate_checkpoint(tar_path, check_best_val_acc):
+        prefix = os.path.splitext(os.path.basename(tar_path))[0]
+        load_checkpoint(model, cg, bn_params, tar_path)
+
+        results = {}
+        for subset in ['valid', 'test']:
+            logging.info("Predicting on " + subset)
+            stream = streams[subset]
+            it = stream.get_epoch_iterator()
+            predictions_path = os.path.join(
+                dest_path, prefix + '_predictions_{}.csv'.format(subset))
+            if os.path.exists(predictions_path):
+                os.remove(predictions_path)
+            att_weights_dst = None
+            if kwargs['model'] == "esim":
+                att_weights_dst = open(os.path.join(
+                    dest_path, prefix + '_s2s_att_weights_{}.npy'.format(subset)), 'wb')
+            chunk = []
+            num_examples = 0
+            num_correct = 0
+            for ex in tqdm.tqdm(it, total=10000/batch_size):
+                ex = dict(zip(stream.sources, ex))
+                inp = [ex[v.name] for v in cg.inputs]
+                outs = predict_fnc(*inp)
+                pred = outs['pred']
+                label_pred = np.argmax(pred, axis=1)
+
+                columns = OrderedDict([
+                    ("pred", label_pred), ("true_label", ex['label'])])
+                for source, short in [('sentence1', 's1'), ('sentence2', 's2')]:
+                    ids = ex[source]
+                    no_pad = ids != 0
+                    columns[short] = [' '.join(marked_words[row[row_no_pad]])
+                                      for row, row_no_pad in zip(ids, no_pad)]
+                    lengths = no_pad.sum(axis=1).astype('float64')
+                    # Different difficulty metrics
+                    columns[short + "_unk_percentage"] = (
+                        ((ids == used_vocab.unk) & no_pad).sum(axis=1) / lengths)
+                    columns[short + "_mean_freq"] = (
+                        (freqs[ids] * no_pad).sum(axis=1) / lengths)
+                    columns[short + "_mean_rank"] = (
+                        (ranks[ids] * no_pad).sum(axis=1) / lengths)
+                for i in range(3):
+                    columns["p_{}".format(i)] = pred[:, i]
+                chunk.append(pd.DataFrame(
+                    columns, index=np.arange(num_examples, num_examples + len(pred))))
+                num_examples += len(pred)
+                num_correct += (label_pred == ex['label']).sum()
+
+                if att_weights_dst is not None:
+                    # the weights of each example are appended to the file,
+                    # read them back by calling np.load on it repeatedly
+                    s1_lengths = ex['sentence1_mask'].sum(axis=1).astype('int64')
+                    s2_lengths = ex['sentence2_mask'].sum(axis=1).astype('int64')
+                    for weights, s1_length, s2_length in zip(
+                            outs['s2s_att_weights'], s1_lengths, s2_lengths):
+                        np.save(att_weights_dst,
+                                weights[:s1_length, :s2_length].astype('float32'))
+
+                if sum(map(len, chunk)) >= write_chunk_size:
+                    pd.concat(chunk).to_csv(
+                        predictions_path, mode='a',
+                        header=not os.path.exists(predictions_path))
+                    chunk = []
+            if chunk:
+                pd.concat(chunk).to_csv(
+                    predictions_path, mode='a',
+                    header=not os.path.exists(predictions_path))
+            if att_weights_dst is not None:
+                att_weights_dst.close()
+
+            results[subset] = {}
+            results[subset]['misclassification'] = 1 - num_correct / float(num_examples)
+
+            if check_best_val_acc and subset == "valid" and np.abs(results[subset]['misclassification'] - best_val_acc) > 0.001:
+                logging.error("!!!")
+                logging.error("Found different best_val_acc. Probably due to changed specification of the model class.")
+                logging.error("Discrepancy {}".format(results[subset]['misclassification'] - best_val_acc))
+                logging.error("!!!")
+
+            logging.info(results)
+
+        json.dump(results, open(os.path.join(dest_path, prefix + '_results.json'), "w"))
+        return results
+
+    # A glob of checkpoints is evaluated with the same function and
+    # streams, only the parameters are changed
+    tar_paths = checkpoint_paths(tar_path)
+    rows = []
+    for path in tar_paths:
+        logging.info("Evaluating " + path)
+        # only the best checkpoint is expected to match the logs
+        results = evaluate_checkpoint(path, len(tar_paths) == 1)
+        rows.append({'checkpoint': path,
+                     'valid_misclassification': results['valid']['misclassification'],
+                     'test_misclassification': results['test']['misclassification']})
+    if len(tar_paths) > 1:
+        write_results_table(rows, os.path.join(dest_path, 'sweep_results.csv'))
 
 
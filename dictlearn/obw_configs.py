@@ -23,10 +23,18 @@ lm_config_registry.set_root_config({
     'emb_def_dim': 500,
     'dim' : 500,
     'compose_type' : 'sum',
+    'num_sampled': 0, # when positive: sampled softmax for training
+    # when True: contiguous batches and LSTM states carried between them
+    'stateful': False,
     'disregard_word_embeddings' : False,
+    # when True: the gates of the main LSTM can be monitored
+    'debug_rnn': False,
     'learning_rate' : 0.001,
     'momentum' : 0.9,
     'grad_clip_threshold' : 5.0,
+    # parameter name regexp -> 'adam' or 'sgd', for row-wise updates
+    # of lookup tables, e.g. {'main_lookup': 'adam'}
+    'sparse_updates': {},
 
     # embeddings
     'embedding_path': '',
@@ -36,6 +44,8 @@ lm_config_registry.set_root_config({
     'standalone_def_rnn' : False,
     'standalone_def_lookup': False,
     'cache_size': 0, # when 0: no cache
+    'def_reader_buckets': 1, # length buckets of the LSTM def reader
+    'def_cache_max_age': 0, # when 0: definitions are read at every step
 
     # monitoring and checkpointing
     'mon_freq_train' : 200,
@@ -45,6 +55,9 @@ lm_config_registry.set_root_config({
     'very_rare_threshold': [1000,100,10], 
     'n_batches' : 0,
     'monitor_parameters' : False,
+    # when False: the diagnostics are computed on the last batch every
+    # mon_freq_train batches instead of by the training function
+    'monitor_every_batch': False,
     'fast_checkpoint' : False
 })
 
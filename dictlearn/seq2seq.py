@@ -61,8 +61,9 @@ class Seq2Seq(Initializable):
 
         super(LanguageModel, self).__init__(children=children, **kwargs)
 
-    def set_def_embeddings(self, embeddings):
-        self._main_lookup.parameters[0].set_value(embeddings.astype(theano.config.floatX))
+    def set_def_embeddings(self, embeddings, borrow=False):
+        self._main_lookup.parameters[0].set_value(
+            embeddings.astype(theano.config.floatX, copy=False), borrow=borrow)
 
     def get_def_embeddings_params(self):
         return self._main_lookup.parameters[0]
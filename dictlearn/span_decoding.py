@@ -0,0 +1,158 @@
+"""Decoding of the answer spans of the extractive QA model.
+
+The model scores the beginning and the end of the answer separately.
+Taking the two `argmax` independently can give an end before the
+beginning or an unreasonably long answer. The decoders below find the
+best span `(begin, end)` with `begin < end <= begin + max_answer_len`,
+where, like in the data, `end` is the position after the last word of
+the answer.
+
+`best_spans` works on NumPy arrays of scores for a whole batch. The best
+beginning for every end is a sliding window maximum over the beginning
+scores, which is computed in O(T) per example with the van Herk/Gil-Werman
+algorithm. `best_span` builds the same decoding in a Theano graph, there
+the window maximum is taken over `max_answer_len` shifted copies of the
+scores.
+
+"""
+import numpy
+from theano import tensor
+
+
+def _log_softmax(scores, mask):
+    scores = numpy.where(mask, scores, -numpy.inf)
+    maxima = scores.max(axis=1, keepdims=True)
+    log_sums = numpy.log(numpy.exp(scores - maxima).sum(axis=1, keepdims=True))
+    return scores - maxima - log_sums
+
+
+def _running_argmax(blocks, indices, reverse=False):
+    """The running maximum along the last axis and its positions.
+
+    The position is the last one where the maximum is reached, which
+    is an argmax since the running maximum never decreases.
+
+    """
+    if reverse:
+        blocks = blocks[..., ::-1]
+        indices = indices[..., ::-1]
+    maxima = numpy.maximum.accumulate(blocks, axis=-1)
+    if reverse:
+        positions = numpy.minimum.accumulate(
+            numpy.where(blocks == maxima, indices, indices.max() + 1), axis=-1)
+        return maxima[..., ::-1], positions[..., ::-1]
+    positions = numpy.maximum.accumulate(
+        numpy.where(blocks == maxima, indices, -1), axis=-1)
+    return maxima, positions
+
+
+def _window_argmax(values, window):
+    """The maxima of `values[:, s:s + window]` for every `s`."""
+    batch_size, length = values.shape
+    num_blocks = -(-length // window)
+    padded = numpy.full((batch_size, num_blocks * window), -numpy.inf)
+    padded[:, :length] = values
+    blocks = padded.reshape(batch_size, num_blocks, window)
+    indices = numpy.arange(num_blocks * window).reshape(1, num_blocks, window)
+    indices = numpy.broadcast_to(indices, blocks.shape)
+    prefix, prefix_positions = _running_argmax(blocks, indices)
+    suffix, suffix_positions = _running_argmax(blocks, indices, reverse=True)
+
+    starts = numpy.arange(length - window + 1)
+    prefix = prefix.reshape(batch_size, -1)[:, starts + window - 1]
+    prefix_positions = prefix_positions.reshape(batch_size, -1)[:, starts + window - 1]
+    suffix = suffix.reshape(batch_size, -1)[:, starts]
+    suffix_positions = suffix_positions.reshape(batch_size, -1)[:, starts]
+    from_suffix = suffix >= prefix
+    return (numpy.where(from_suffix, suffix, prefix),
+            numpy.where(from_suffix, suffix_positions, prefix_positions))
+
+
+def best_spans(begin_scores, end_scores, mask=None, max_answer_len=None, k=1):
+    """Finds the best answer spans for a batch.
+
+    Parameters
+    ----------
+    begin_scores : numpy.ndarray
+        The scores of the beginnings, of shape (batch size, length).
+        Any scores that are log-probabilities up to a constant, e.g.
+        the readouts of the model, will do.
+    end_scores : numpy.ndarray
+        The scores of the ends, of the same shape.
+    mask : numpy.ndarray
+        The mask of the contexts, all the positions are used by default.
+    max_answer_len : int
+        The maximum number of words in the answer, by default the
+        length is not limited.
+    k : int
+        The number of spans to return for every example.
+
+    Returns
+    -------
+    begins : numpy.ndarray
+    ends : numpy.ndarray
+    scores : numpy.ndarray
+        The spans and the sums of the log-probabilities of their
+        beginnings and ends, of shape (batch size, k) and sorted from
+        the best. The `k` spans of an example have different ends, each
+        end comes with its best beginning. Spans are padded with a
+        score of `-inf` if an example has less than `k` of them.
+
+    """
+    if mask is None:
+        mask = numpy.ones(begin_scores.shape, dtype='bool')
+    mask = mask.astype('bool')
+    batch_size, length = begin_scores.shape
+    begin_scores = _log_softmax(begin_scores, mask)
+    end_scores = _log_softmax(end_scores, mask)
+    window = min(max_answer_len or length, length)
+    k = min(k, length)
+
+    # padded[e + window - d] is the score of beginning d words
+    # before the end e, the best beginning is the maximum over a window
+    padded = numpy.full((batch_size, length + window - 1), -numpy.inf)
+    padded[:, window:] = begin_scores[:, :length - 1]
+    best_begin_scores, positions = _window_argmax(padded, window)
+    begins = positions - window
+    scores = best_begin_scores + end_scores
+
+    rows = numpy.arange(batch_size)[:, None]
+    if k == 1:
+        ends = scores.argmax(axis=1)[:, None]
+    else:
+        ends = numpy.argpartition(-scores, k - 1, axis=1)[:, :k]
+        ends = ends[rows, numpy.argsort(-scores[rows, ends], axis=1)]
+    return begins[rows, ends], ends, scores[rows, ends]
+
+
+def best_span(begin_scores, end_scores, max_answer_len):
+    """Builds the decoding of the best span in a Theano graph.
+
+    Parameters
+    ----------
+    begin_scores : TensorVariable
+        The scores of the beginnings, of shape (batch size, length),
+        with very low scores for the padding.
+    end_scores : TensorVariable
+        The scores of the ends.
+    max_answer_len : int
+        The maximum number of words in the answer.
+
+    Returns
+    -------
+    The beginnings and the ends of the best spans.
+
+    """
+    batch_size, length = begin_scores.shape
+    filler = tensor.alloc(numpy.array(-1e9, dtype=begin_scores.dtype),
+                          batch_size, max_answer_len)
+    padded = tensor.concatenate([filler, begin_scores], axis=1)
+    # shifted[d - 1, :, e] is the score of beginning d words before e
+    shifted = tensor.stack(
+        [padded[:, max_answer_len - d:max_answer_len - d + length]
+         for d in range(1, max_answer_len + 1)])
+    best_begin_scores = shifted.max(axis=0)
+    distances = shifted.argmax(axis=0) + 1
+    ends = (best_begin_scores + end_scores).argmax(axis=1)
+    begins = ends - distances[tensor.arange(batch_size), ends]
+    return begins, ends
@@ -0,0 +1,184 @@
+"""Row-wise updates of lookup tables.
+
+A batch only touches a few rows of a large embedding matrix, but the
+Blocks step rules update the whole matrix and, for Adam, its moments at
+every step. The rules below only update the rows that were looked up.
+The gradient is taken with respect to the result of the lookup, i.e. the
+`AdvancedSubtensor1` node `W[indices]`, so that the dense gradient of `W`
+is never built.
+
+The Adam rule is lazy: the moments of the rows that are not looked up
+are not decayed.
+
+"""
+import logging
+import re
+
+from theano import tensor
+from theano.tensor.subtensor import AdvancedSubtensor1
+
+from blocks.graph import ComputationGraph
+from blocks.utils import shared_floatx_zeros_matching, shared_floatx
+
+logger = logging.getLogger(__name__)
+
+
+class SparseSGD(object):
+    """Row-wise SGD."""
+    def __init__(self, learning_rate=1.0):
+        self.learning_rate = learning_rate
+
+    def compute_updates(self, parameter, rows, gradient):
+        return [(parameter, tensor.inc_subtensor(
+            parameter[rows], -self.learning_rate * gradient))]
+
+
+class SparseAdam(object):
+    """Row-wise Adam.
+
+    The parameters have the same meaning as for `blocks.algorithms.Adam`,
+    which gives the same steps as long as all the rows are looked up.
+
+    """
+    def __init__(self, learning_rate=0.002, beta1=0.1, beta2=0.001,
+                 epsilon=1e-8, decay_factor=(1 - 1e-8)):
+        self.learning_rate = learning_rate
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.decay_factor = decay_factor
+
+    def compute_updates(self, parameter, rows, gradient):
+        mean = shared_floatx_zeros_matching(parameter, 'mean')
+        variance = shared_floatx_zeros_matching(parameter, 'variance')
+        time = shared_floatx(0., 'time')
+
+        t1 = time + 1
+        beta_1t = self.beta1 * self.decay_factor ** (t1 - 1)
+        learning_rate = (self.learning_rate *
+                         tensor.sqrt(1. - (1 - self.beta2) ** t1) /
+                         (1. - (1 - self.beta1) ** t1))
+        mean_t = beta_1t * gradient + (1. - beta_1t) * mean[rows]
+        variance_t = (self.beta2 * tensor.sqr(gradient) +
+                      (1. - self.beta2) * variance[rows])
+        step = learning_rate * mean_t / (tensor.sqrt(variance_t) + self.epsilon)
+        return [(mean, tensor.set_subtensor(mean[rows], mean_t)),
+                (variance, tensor.set_subtensor(variance[rows], variance_t)),
+                (parameter, tensor.inc_subtensor(
+                    parameter[rows], -step.astype(parameter.dtype))),
+                (time, t1)]
+
+
+def find_lookups(cost, parameters):
+    """Finds the lookups into `parameters` that `cost` depends on.
+
+    Returns
+    -------
+    A dictionary from the parameters that are only used through
+    `AdvancedSubtensor1` lookups to the lists of these lookups.
+
+    """
+    lookups = {parameter: [] for parameter in parameters}
+    dense = set()
+    for variable in ComputationGraph(cost).variables:
+        node = variable.owner
+        if node is None:
+            continue
+        for position, input_ in enumerate(node.inputs):
+            if input_ in lookups:
+                if isinstance(node.op, AdvancedSubtensor1) and position == 0:
+                    lookups[input_].append(variable)
+                else:
+                    dense.add(input_)
+    for parameter in dense:
+        logger.warning("{} is not only used through lookups,"
+                       " it will be updated densely".format(parameter.name))
+    return {parameter: parameter_lookups
+            for parameter, parameter_lookups in lookups.items()
+            if parameter_lookups and parameter not in dense}
+
+
+def sparse_updates(cost, rules, clip_threshold=None):
+    """Computes row-wise updates for lookup tables.
+
+    Parameters
+    ----------
+    cost : TensorVariable
+    rules : dict
+        Maps the parameters to their `SparseSGD` or `SparseAdam` rules.
+    clip_threshold : float
+        If given, the row gradients are rescaled to have at most this
+        norm, like `StepClipping` does. The norm is computed over the
+        sparse parameters only.
+
+    Returns
+    -------
+    The parameters that are updated sparsely, which should be excluded
+    from the `GradientDescent` parameters, and the updates.
+
+    """
+    lookups = find_lookups(cost, rules.keys())
+    parameters = [parameter for parameter in rules if parameter in lookups]
+    gradients = tensor.grad(
+        cost, [lookup for parameter in parameters for lookup in lookups[parameter]])
+
+    row_gradients = []
+    all_rows = []
+    start = 0
+    for parameter in parameters:
+        end = start + len(lookups[parameter])
+        indices = tensor.concatenate(
+            [lookup.owner.inputs[1] for lookup in lookups[parameter]])
+        gradient = tensor.concatenate(gradients[start:end])
+        start = end
+        # the same row can be looked up several times
+        rows, positions = tensor.extra_ops.Unique(return_inverse=True)(indices)
+        row_gradients.append(tensor.inc_subtensor(
+            tensor.zeros((rows.shape[0], parameter.shape[1]),
+                         dtype=gradient.dtype)[positions],
+            gradient))
+        all_rows.append(rows)
+
+    if clip_threshold and parameters:
+        norm = tensor.sqrt(sum(tensor.sqr(gradient).sum()
+                               for gradient in row_gradients))
+        multiplier = clip_threshold / tensor.maximum(clip_threshold, norm)
+        row_gradients = [gradient * multiplier for gradient in row_gradients]
+
+    updates = []
+    for parameter, rows, gradient in zip(parameters, all_rows, row_gradients):
+        updates.extend(rules[parameter].compute_updates(parameter, rows, gradient))
+    return parameters, updates
+
+
+def rules_from_config(parameters, sparse_config, learning_rate, beta1=0.1):
+    """Selects the sparse step rules from a training config.
+
+    Parameters
+    ----------
+    parameters : dict
+        The parameters by their hierarchical names, see
+        `Model.get_parameter_dict`.
+    sparse_config : dict
+        Maps regular expressions searched in the parameter names to
+        'adam' or 'sgd'.
+    learning_rate : float or shared variable
+        Passing the learning rate variable of the dense step rule
+        keeps them in sync when it is annealed.
+
+    """
+    rules = {}
+    for regexp, rule in sparse_config.items():
+        matched = [name for name in parameters if re.search(regexp, name)]
+        if not matched:
+            raise ValueError("no parameter matches {}".format(regexp))
+        for name in matched:
+            if rule == 'adam':
+                rules[parameters[name]] = SparseAdam(
+                    learning_rate=learning_rate, beta1=beta1)
+            elif rule == 'sgd':
+                rules[parameters[name]] = SparseSGD(learning_rate=learning_rate)
+            else:
+                raise ValueError("unknown sparse rule {}".format(rule))
+            logger.info("Sparse {} updates for {}".format(rule, name))
+    return rules
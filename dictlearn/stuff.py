@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
-"""Useful stuff for debugging."""
+"""Recurrent bricks, including a variant for debugging.
+
+`PeepholeLSTM` and `DebugLSTM` have the same parameters, so the
+checkpoints of one can be loaded into the other.
+
+"""
 from theano import tensor
 
 from blocks.bricks.base import application, lazy
@@ -10,7 +15,7 @@ from blocks.bricks.recurrent.base import BaseRecurrent, recurrent
 
 
 
-class DebugLSTM(BaseRecurrent, Initializable):
+class PeepholeLSTM(BaseRecurrent, Initializable):
     u"""Long Short Term Memory.
 
     Every unit of an LSTM is equipped with input, forget and output gates.
@@ -63,7 +68,7 @@ class DebugLSTM(BaseRecurrent, Initializable):
 
         children = [self.activation, self.gate_activation]
         kwargs.setdefault('children', []).extend(children)
-        super(DebugLSTM, self).__init__(**kwargs)
+        super(PeepholeLSTM, self).__init__(**kwargs)
 
     def get_dim(self, name):
         if name == 'inputs':
@@ -72,7 +77,7 @@ class DebugLSTM(BaseRecurrent, Initializable):
             return self.dim
         if name == 'mask':
             return 0
-        return super(DebugLSTM, self).get_dim(name)
+        return super(PeepholeLSTM, self).get_dim(name)
 
 
     def _allocate(self):
@@ -106,8 +111,8 @@ class DebugLSTM(BaseRecurrent, Initializable):
             self.weights_init.initialize(weights, self.rng)
 
     @recurrent(sequences=['inputs', 'mask'], states=['states', 'cells'],
-               contexts=[], outputs=['states', 'cells', 'input_gates', 'forget_gates', 'output_gates'])
-    def inner_apply(self, inputs, states, cells, mask=None):
+               contexts=[], outputs=['states', 'cells'])
+    def apply(self, inputs, states, cells, mask=None):
         """Apply the Long Short Term Memory transition.
 
         Parameters
@@ -141,6 +146,10 @@ class DebugLSTM(BaseRecurrent, Initializable):
             Next cell activations of the network.
 
         """
+        return self._step(inputs, states, cells, mask)[:2]
+
+    def _step(self, inputs, states, cells, mask):
+        """Returns the next states and cells and the three gates."""
         def slice_last(x, no):
             return x[:, no*self.dim: (no+1)*self.dim]
 
@@ -164,6 +173,26 @@ class DebugLSTM(BaseRecurrent, Initializable):
 
         return next_states, next_cells, in_gate, forget_gate, out_gate
 
+    @application(outputs=apply.states)
+    def initial_states(self, batch_size, *args, **kwargs):
+        return [tensor.repeat(self.initial_state_[None, :], batch_size, 0),
+                tensor.repeat(self.initial_cells[None, :], batch_size, 0)]
+
+
+class DebugLSTM(PeepholeLSTM):
+    """A `PeepholeLSTM` that also outputs its gates.
+
+    The gates of every step are added as the auxiliary variables
+    `input_gates`, `forget_gates` and `output_gates`. They are kept by
+    the scan, which costs three extra (T, B, dim) tensors in the forward
+    and the backward pass, so only use it to monitor the gates.
+
+    """
+    @recurrent(sequences=['inputs', 'mask'], states=['states', 'cells'],
+               contexts=[], outputs=['states', 'cells', 'input_gates', 'forget_gates', 'output_gates'])
+    def inner_apply(self, inputs, states, cells, mask=None):
+        return self._step(inputs, states, cells, mask)
+
     @application(outputs=['states', 'cells'])
     def apply(self, application_call, *args, **kwargs):
         results = self.inner_apply(*args, **kwargs)
@@ -171,9 +200,3 @@ class DebugLSTM(BaseRecurrent, Initializable):
         application_call.add_auxiliary_variable(results[3].copy(), name='forget_gates')
         application_call.add_auxiliary_variable(results[4].copy(), name='output_gates')
         return results[:2]
-
-
-    @application(outputs=inner_apply.states)
-    def initial_states(self, batch_size, *args, **kwargs):
-        return [tensor.repeat(self.initial_state_[None, :], batch_size, 0),
-                tensor.repeat(self.initial_cells[None, :], batch_size, 0)]
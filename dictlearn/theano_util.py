@@ -70,6 +70,64 @@ def parameter_stats(parameters, algorithm):
     return vars_
 
 
+def is_required(auxiliary, name):
+    """Tells if an `apply` method has to build an auxiliary variable.
+
+    `auxiliary` is the set of the names of the auxiliary variables that
+    are needed, `None` stands for all of them.
+
+    """
+    return auxiliary is None or name in auxiliary
+
+
 def unk_ratio(words, mask, unk):
     num_unk = (tensor.eq(words, unk) * mask).sum()
     return num_unk / mask.sum()
+
+
+def load_brick_parameters(brick, tar_path):
+    """Loads the parameters of `brick` and its children from a checkpoint.
+
+    Unlike `Model.set_parameter_values` this does not require a
+    computation graph that uses all the parameters. The parameters
+    missing from the checkpoint (e.g. frozen embeddings) are left as is.
+
+    Returns the names of the missing parameters.
+
+    """
+    from blocks.select import Selector
+    from blocks.serialization import load_parameters
+    with open(tar_path) as src:
+        values = load_parameters(src)
+    missing = []
+    for name, parameter in Selector(brick).get_parameters().items():
+        if name in values:
+            parameter.set_value(values[name])
+        else:
+            missing.append(name)
+    return missing
+
+
+def load_population_statistics(brick, tar_path):
+    """Loads the batch normalization statistics of `brick` from a checkpoint.
+
+    The population means and deviations are not parameters, so
+    `load_brick_parameters` does not load them.
+
+    Returns the names of the statistics missing from the checkpoint.
+
+    """
+    from blocks.bricks.bn import BatchNormalization
+    from blocks.serialization import load_parameters
+    from blocks.utils import find_bricks
+    with open(tar_path) as src:
+        values = load_parameters(src)
+    missing = []
+    for bn in find_bricks([brick], lambda b: isinstance(b, BatchNormalization)):
+        for statistic in [bn.population_mean, bn.population_stdev]:
+            name = bn.get_hierarchical_name(statistic)
+            if name in values:
+                statistic.set_value(values[name])
+            else:
+                missing.append(name)
+    return missing
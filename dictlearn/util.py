@@ -2,7 +2,7 @@
 Few utilities
 """
 
-import os, sys, logging
+import os, sys, logging, glob, re, csv
 from contextlib import contextmanager
 from logging import handlers
 import datetime
@@ -62,6 +62,32 @@ def get_free_port():
 
 
 
+def checkpoint_paths(pattern):
+    """Expands a glob of checkpoints.
+
+    The checkpoints of `IntermediateCheckpoint` are sorted by the number
+    of batches, the others come last.
+
+    """
+    paths = glob.glob(pattern)
+    if not paths:
+        raise ValueError("no checkpoint matches {}".format(pattern))
+    def sort_key(path):
+        match = re.search(r'after_batch_(\d+)', path)
+        return (int(match.group(1)) if match else float('inf'), path)
+    return sorted(paths, key=sort_key)
+
+
+def write_results_table(rows, path):
+    """Writes one row of results per checkpoint to a CSV file."""
+    columns = ['checkpoint'] + sorted(
+        set(key for row in rows for key in row) - {'checkpoint'})
+    with open(path, 'w') as dst:
+        writer = csv.DictWriter(dst, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
 def kwargs_namer(**fnc_kwargs):
     return "_".join("{}={}".format(k, v) for k, v in OrderedDict(**fnc_kwargs).iteritems() if k not in ['run_name'])
 
@@ -83,6 +83,41 @@ class Vocabulary(object):
             return id_
         return self.unk
 
+    def words_to_ids(self, words):
+        """Vectorized `word_to_id` for an array of words.
+
+        The words are looked up with a binary search in the sorted
+        vocabulary, which is much faster than calling `word_to_id`
+        for every element of a large array. Byte strings are assumed
+        to be utf-8 encoded.
+
+        """
+        words = numpy.asarray(words)
+        if not words.size:
+            return numpy.zeros(words.shape, dtype='int64')
+        if words.dtype.kind == 'S':
+            words = numpy.char.decode(words, 'utf-8')
+        elif words.dtype.kind != 'U':
+            words = words.astype(numpy.unicode_)
+        sorted_words, sorted_ids = self._sorted_words()
+        # `side='right'` picks the last of duplicate entries, just like
+        # `_word_to_id` does
+        positions = numpy.searchsorted(sorted_words, words, side='right') - 1
+        clipped = numpy.maximum(positions, 0)
+        found = (positions >= 0) & (sorted_words[clipped] == words)
+        return numpy.where(found, sorted_ids[clipped], self.unk).astype('int64')
+
+    def _sorted_words(self):
+        # Not computed in the constructor, because most of the
+        # vocabularies are never used for vectorized lookups.
+        if getattr(self, '_sorted_words_cache', None) is None:
+            words = numpy.array(
+                [word if isinstance(word, text_type) else word.decode('utf-8')
+                 for word in self._id_to_word], dtype=numpy.unicode_)
+            order = numpy.argsort(words, kind='mergesort')
+            self._sorted_words_cache = (words[order], order)
+        return self._sorted_words_cache
+
     def id_to_word(self, cur_id):
         return self._id_to_word[cur_id]
 
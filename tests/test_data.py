@@ -3,14 +3,18 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import pickle
 import tempfile
 import base64
 
+import numpy
+
 from fuel.datasets import IndexableDataset
 from fuel.streams import DataStream
 
 from dictlearn.data import (
-    LanguageModellingData, ExtractiveQAData, RandomSpanScheme)
+    LanguageModellingData, ExtractiveQAData, RandomSpanScheme,
+    StatefulSpanScheme)
 from dictlearn.vocab import Vocabulary
 from dictlearn.util import vec2str
 
@@ -87,3 +91,38 @@ def test_random_span_scheme():
     stream = DataStream(dataset, iteration_scheme=scheme)
     it = stream.get_epoch_iterator()
     assert next(it) == (['def', 'xyz'],)
+
+
+def test_stateful_span_scheme():
+    # two segments of 5 tokens, read by spans of 2 tokens
+    scheme = StatefulSpanScheme(11, 2, 2)
+    requests = list(scheme.get_request_iterator())
+    assert requests == [slice(0, 3), slice(5, 8), slice(2, 5), slice(7, 10)]
+
+    dataset = IndexableDataset(['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'])
+    stream = DataStream(dataset, iteration_scheme=StatefulSpanScheme(8, 2, 3))
+    assert list(stream.get_epoch_iterator()) == [(['a', 'b', 'c', 'd'],),
+                                                 (['e', 'f', 'g', 'h'],)]
+
+
+def test_token_dataset():
+    temp_dir = tempfile.mkdtemp()
+    train_path = os.path.join(temp_dir, "train.txt")
+    with open(train_path, 'w') as dst:
+        print(TEST_TEXT, file=dst)
+
+    data = LanguageModellingData(temp_dir, 'standard')
+    dataset = data.get_token_dataset('train')
+    assert dataset.num_examples == 10
+    assert dataset.tokens.dtype == numpy.int32
+    assert dataset.types.tolist() == ['abc', 'def', 'xyz']
+    assert dataset.get_data(request=slice(2, 5))[0].tolist() == ['def', 'def', 'def']
+    # the memory-mapped ids are not pickled
+    assert pickle.loads(pickle.dumps(dataset)).get_data(
+        request=[9, 0])[0].tolist() == ['xyz', 'abc']
+
+    stream = data.get_stateful_stream('train', batch_size=2, max_length=2)
+    words, words_mask = next(stream.get_epoch_iterator())
+    assert words.shape == (2, 3, 100)
+    assert vec2str(words[0, 0]) == 'abc'
+    assert vec2str(words[1, 0]) == 'xyz'
@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+import numpy
+from blocks.initialization import Uniform
+
+from dictlearn.vocab import Vocabulary
+from dictlearn.retrieval import Retrieval, Dictionary
+from dictlearn.language_model import LanguageModel
+from dictlearn.def_embeddings import (
+    precompute_def_embeddings, check_def_embeddings)
+
+from tests.util import (
+    TEST_VOCAB, TEST_DICT_JSON, temporary_content_path)
+
+
+def test_precompute_def_embeddings():
+    with temporary_content_path(TEST_VOCAB) as path:
+        vocab = Vocabulary(path)
+    with temporary_content_path(TEST_DICT_JSON, suffix=".json") as path:
+        dict_ = Dictionary(path)
+    retrieval = Retrieval(vocab, dict_)
+
+    lm = LanguageModel(7, 7, 7, vocab.size(), vocab.size(), vocab.size(),
+                       vocab=vocab, retrieval=retrieval,
+                       weights_init=Uniform(width=0.1),
+                       biases_init=Uniform(width=0.1))
+    lm.initialize()
+
+    dest = os.path.join(tempfile.mkdtemp(), 'def_embeddings.npy')
+    precompute_def_embeddings(lm, retrieval, vocab, dest, batch_size=4)
+    table = numpy.load(dest, mmap_mode='r')
+    assert table.shape == (vocab.size(), 7)
+    # 'c' has no definitions, 'a' and 'e' do
+    assert not table[vocab.word_to_id('c')].any()
+    assert table[vocab.word_to_id('a')].any()
+    assert table[vocab.word_to_id('e')].any()
+
+    error = check_def_embeddings(
+        lm, retrieval, vocab, table, [['a', 'b', 'e'], ['c', 'a']])
+    assert error < 1e-5
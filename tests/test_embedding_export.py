@@ -0,0 +1,55 @@
+import os
+import json
+import tempfile
+
+import numpy
+from blocks.initialization import Uniform
+
+from dictlearn.vocab import Vocabulary
+from dictlearn.retrieval import Retrieval, Dictionary
+from dictlearn.language_model import LanguageModel
+from dictlearn.def_embeddings import precompute_def_embeddings
+from dictlearn.embedding_export import export_embeddings
+
+from tests.util import (
+    TEST_VOCAB, TEST_DICT_JSON, temporary_content_path)
+
+
+def test_export_embeddings():
+    with temporary_content_path(TEST_VOCAB) as path:
+        vocab = Vocabulary(path)
+    with temporary_content_path(TEST_DICT_JSON, suffix=".json") as path:
+        dict_ = Dictionary(path)
+    retrieval = Retrieval(vocab, dict_)
+
+    lm = LanguageModel(7, 7, 7, vocab.size(), vocab.size(), vocab.size(),
+                       vocab=vocab, retrieval=retrieval,
+                       weights_init=Uniform(width=0.1),
+                       biases_init=Uniform(width=0.1))
+    lm.initialize()
+
+    dest = tempfile.mkdtemp()
+    expected = numpy.array(precompute_def_embeddings(
+        lm, retrieval, vocab, os.path.join(dest, 'table.npy'), batch_size=4))
+    export_embeddings(lm, retrieval, vocab, vocab.words, dest, batch_size=4)
+
+    with open(os.path.join(dest, 'words.txt')) as src:
+        assert [line.strip().decode('utf-8') for line in src] == vocab.words
+    word_embeddings = numpy.load(os.path.join(dest, 'word_embeddings.npy'))
+    assert numpy.allclose(word_embeddings,
+                          lm._main_lookup.parameters[0].get_value())
+    def_embeddings = numpy.load(os.path.join(dest, 'def_embeddings.npy'))
+    assert numpy.allclose(def_embeddings, expected)
+
+    # an interrupted export is continued where it stopped
+    with open(os.path.join(dest, 'progress.json')) as src:
+        progress = json.load(src)
+    progress['done'] = 4
+    with open(os.path.join(dest, 'progress.json'), 'w') as dst:
+        json.dump(progress, dst)
+    def_embeddings[4:] = 0
+    numpy.save(os.path.join(dest, 'def_embeddings.npy'), def_embeddings)
+    export_embeddings(lm, retrieval, vocab, vocab.words, dest, batch_size=4,
+                      resume=True)
+    assert numpy.allclose(
+        numpy.load(os.path.join(dest, 'def_embeddings.npy')), expected)
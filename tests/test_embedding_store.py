@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+import numpy
+from numpy.testing import assert_equal
+
+from dictlearn.embedding_store import (
+    EmbeddingStore, save_references, check_references)
+
+
+def test_embedding_store():
+    temp_dir = tempfile.mkdtemp()
+    path = os.path.join(temp_dir, 'embeddings.npy')
+    embeddings = numpy.arange(12, dtype='float32').reshape(4, 3)
+    numpy.save(path, embeddings)
+
+    store = EmbeddingStore.get(path)
+    assert EmbeddingStore.get(path) is store
+    assert isinstance(store.matrix, numpy.memmap)
+    assert_equal(store.matrix, embeddings)
+
+    # frozen embeddings are not copied, trained ones are
+    assert store.as_dtype('float32', frozen=True) is store.matrix
+    copy = store.as_dtype('float32', frozen=False)
+    assert not isinstance(copy, numpy.memmap)
+    copy[0] = 1.
+    assert_equal(store.matrix, embeddings)
+    assert store.as_dtype('float64', frozen=True).dtype == numpy.float64
+
+    paths = {'embedding_path': path, 'embedding_def_path': ''}
+    save_references(temp_dir, paths)
+    check_references(temp_dir, paths)
+
+    numpy.save(path, embeddings + 1)
+    # a new process would hash the file again
+    EmbeddingStore._stores.clear()
+    try:
+        check_references(temp_dir, {'embedding_path': path})
+        assert False
+    except ValueError:
+        pass
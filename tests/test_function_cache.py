@@ -0,0 +1,25 @@
+import tempfile
+
+import numpy
+import theano
+from theano import tensor
+
+from dictlearn.function_cache import set_function_cache, function
+
+
+def test_function_cache():
+    floatX = theano.config.floatX
+    set_function_cache(tempfile.mkdtemp(), {'dim': 3})
+    try:
+        compiled = []
+        for i in range(2):
+            x = tensor.vector('x')
+            W = theano.shared(numpy.ones(3, dtype=floatX) * (i + 1), name='W')
+            f = function([x], (x * W).sum(), updates=[(W, W + 1)], name='f')
+            compiled.append(f)
+            # the function from the cache uses the new shared variable
+            assert f(numpy.ones(3, dtype=floatX)) == 3 * (i + 1)
+            assert numpy.allclose(W.get_value(), i + 2)
+        assert not hasattr(compiled[1], 'compilation_time')
+    finally:
+        set_function_cache(None)
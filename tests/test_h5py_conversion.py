@@ -4,20 +4,48 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import json
 import tempfile
 import h5py
+import numpy
 
 from fuel.datasets.hdf5 import H5PYDataset
 
 from dictlearn.corenlp import start_corenlp
 from dictlearn.h5py_conversion import (
-    text_to_h5py_dataset, squad_to_h5py_dataset, add_words_ids_to_squad)
+    text_to_h5py_dataset, squad_to_h5py_dataset, add_words_ids_to_squad,
+    _find_sublist, _find_sublists)
 from dictlearn.datasets import SQuADDataset
 from dictlearn.vocab import Vocabulary
 from dictlearn.util import get_free_port
 
 from tests.util import TEST_SQUAD_RAW_DATA
 
+def _naive_find_sublist(list_, sublist):
+    indices = []
+    for i in range(len(list_) - len(sublist) + 1):
+        if list_[i:i + len(sublist)] == sublist:
+            indices.append(i)
+    return indices
+
+
+def test_find_sublist():
+    rng = numpy.random.RandomState(1)
+    for _ in range(500):
+        # a small alphabet makes for many overlapping matches
+        alphabet = rng.randint(1, 4)
+        list_ = rng.randint(0, alphabet, rng.randint(0, 30)).tolist()
+        sublists = [rng.randint(0, alphabet, rng.randint(0, 5)).tolist()
+                    for _ in range(rng.randint(1, 5))]
+        expected = [_naive_find_sublist(list_, sublist) for sublist in sublists]
+        assert [_find_sublist(list_, sublist) for sublist in sublists] == expected
+        assert _find_sublists(list_, sublists) == expected
+
+    words = [u'the', u'cat', u'sat', u'on', u'the', u'cat']
+    assert _find_sublist(words, [u'the', u'cat']) == [0, 4]
+    assert _find_sublists(words, [[u'the', u'cat'], [u'mat'], [u'sat']]) == [[0, 4], [], [2]]
+
+
 def test_text_to_h5py_dataset():
     test_dir = tempfile.mkdtemp()
     text_path = os.path.join(test_dir, 'text.txt')
@@ -67,6 +95,54 @@ def test_squad_to_h5py_dataset():
             u'France', u'?'])
         assert example['contexts'][answer_span].tolist() == map(vocab.word_to_id,
             [u'Saint', u'Bernadette', u'Soubirous'])
+
+        # the parallel pipeline should produce exactly the same data
+        url = "http://localhost:{}".format(port)
+        parallel_h5_path = os.path.join(test_dir, 'data_parallel.h5')
+        squad_to_h5py_dataset(json_path, parallel_h5_path, [url, url])
+        with h5py.File(h5_path, 'r') as h5_file:
+            with h5py.File(parallel_h5_path, 'r') as parallel_h5_file:
+                for name in ['text', 'contexts', 'questions', 'q_ids']:
+                    assert (h5_file[name][:].tolist()
+                            == parallel_h5_file[name][:].tolist())
+                for name in ['answer_begins', 'answer_ends']:
+                    assert ([span.tolist() for span in h5_file[name][:]]
+                            == [span.tolist() for span in parallel_h5_file[name][:]])
+
+        # answers whose text occurs several times in the context
+        context = u"A known cat met a well-known cat. Later a known cat left."
+        last_cat = context.rindex(u'cat')
+        inside_word = context.index(u'known cat', context.index(u'well-'))
+        repeated_json_path = os.path.join(test_dir, 'repeated.json')
+        with open(repeated_json_path, 'w') as json_file:
+            json.dump({'version': '1.1', 'data': [{'title': 'Cats', 'paragraphs': [{
+                'context': context,
+                'qas': [{'id': 'exact', 'question': u'Which cat left?',
+                         'answers': [{'answer_start': last_cat, 'text': u'cat'}]},
+                        {'id': 'relaxed', 'question': u'Which cat met?',
+                         'answers': [{'answer_start': inside_word,
+                                      'text': u'known cat'}]}]}]}]},
+                json_file)
+        spans = []
+        for urls in [url, [url, url]]:
+            repeated_h5_path = os.path.join(test_dir, 'repeated.h5')
+            squad_to_h5py_dataset(repeated_json_path, repeated_h5_path, urls,
+                                  exact_span=False)
+            with h5py.File(repeated_h5_path, 'r') as h5_file:
+                text = h5_file['text'][:].tolist()
+                context_begin, context_end = h5_file['contexts'][0]
+                tokens = text[context_begin:context_end]
+                assert h5_file['q_ids'][:].tolist() == [u'exact', u'relaxed']
+                spans.append([
+                    (begins.tolist(), ends.tolist()) for begins, ends
+                    in zip(h5_file['answer_begins'][:], h5_file['answer_ends'][:])])
+        assert spans[0] == spans[1]
+        (exact_begins, exact_ends), (relaxed_begins, relaxed_ends) = spans[0]
+        # the occurrence at the answer start, not the first one
+        last_cat_token = len(tokens) - 1 - tokens[::-1].index(u'cat')
+        assert (exact_begins, exact_ends) == ([last_cat_token], [last_cat_token + 1])
+        assert tokens[relaxed_begins[0]:relaxed_ends[0]] == [u'known', u'cat']
+        assert relaxed_begins[0] != tokens.index(u'known')
     finally:
         if corenlp and corenlp.returncode is None:
             corenlp.kill()
@@ -60,6 +60,15 @@ def test_language_model():
     for v,p in zip(perplexities_v,perplexities):
         print p.name, ":", v
     assert(np.allclose(mask_def_v, mask_def_emb_val))
+
+    # Only the requested auxiliary variables are built
+    assert 'perplexity_after_def_embs' in lm.perplexity_names()
+    lean_costs, _ = lm.apply(words, mask, auxiliary={'perplexity_'})
+    lean_cg = ComputationGraph(lean_costs)
+    assert ([p.tag.name for p in VariableFilter(name_regex='perplexity.*')(lean_cg)]
+            == ['perplexity_'])
+    assert not VariableFilter(name='mask_def_emb')(lean_cg)
+    assert not VariableFilter(name='_dict_word_embeddings')(lean_cg)
     
     #costs_value, def_spans_value = f()
     #assert (def_spans_value.tolist() ==
@@ -0,0 +1,200 @@
+import numpy
+
+import theano
+from theano import tensor
+from blocks.initialization import Uniform
+from blocks.graph import ComputationGraph
+from blocks.filter import VariableFilter
+from blocks.select import Selector
+
+from dictlearn.vocab import Vocabulary
+from dictlearn.lookup import (
+    MeanPoolReadDefinitions, MeanPoolCombiner, DefinitionCache)
+
+from tests.util import (
+    TEST_VOCAB, temporary_content_path)
+
+
+def test_sparse_mean_pool_read_definitions():
+    with temporary_content_path(TEST_VOCAB) as path:
+        vocab = Vocabulary(path)
+    floatX = theano.config.floatX
+
+    defs_val = numpy.array([[5, 6, 6, 0], [7, 8, 0, 0], [9, 100, 5, 8]])
+    def_mask_val = numpy.array([[1, 1, 1, 0], [1, 1, 0, 0], [1, 1, 1, 1]],
+                               dtype=floatX)
+
+    defs = tensor.lmatrix('defs')
+    def_mask = tensor.matrix('def_mask', dtype=floatX)
+    for translate, normalize in [(False, True), (True, True), (True, False)]:
+        dim = 4 if translate else 3
+        readers = [MeanPoolReadDefinitions(
+            num_input_words=8, emb_dim=3, dim=dim, vocab=vocab,
+            translate=translate, normalize=normalize, sparse=sparse,
+            weights_init=Uniform(width=0.1), biases_init=Uniform(width=0.1),
+            seed=1)
+            for sparse in [False, True]]
+        for reader in readers:
+            reader.initialize()
+
+        values = []
+        for reader in readers:
+            output = reader.apply(defs, def_mask)
+            cost = (output ** 2).sum()
+            parameters = [parameter for _, parameter in
+                          sorted(Selector(reader).get_parameters().items())]
+            grads = tensor.grad(cost, parameters)
+            values.append(theano.function([defs, def_mask], [output] + grads)(
+                defs_val, def_mask_val))
+        for dense_value, sparse_value in zip(*values):
+            assert numpy.allclose(dense_value, sparse_value, atol=1e-6)
+
+
+def test_def_unk_ratio_is_optional():
+    with temporary_content_path(TEST_VOCAB) as path:
+        vocab = Vocabulary(path)
+    defs = tensor.lmatrix('defs')
+    def_mask = tensor.matrix('def_mask', dtype=theano.config.floatX)
+    for sparse in [False, True]:
+        reader = MeanPoolReadDefinitions(
+            num_input_words=8, emb_dim=3, dim=3, vocab=vocab,
+            translate=False, sparse=sparse)
+        for auxiliary, expected in [(None, 1), (set(), 0),
+                                    ({'def_unk_ratio'}, 1)]:
+            cg = ComputationGraph(
+                reader.apply(defs, def_mask, auxiliary=auxiliary))
+            assert len(VariableFilter(name='def_unk_ratio')(cg)) == expected
+
+
+def dense_aggregate(combiner, def_embeddings, flat_indices, def_indices,
+                    num_positions):
+    """The scatter over all the positions that `aggregate` replaced."""
+    def_sum = tensor.zeros((num_positions, def_embeddings.shape[1]))
+    def_lens = tensor.zeros_like(def_sum[:, 0])
+    def_lens = tensor.inc_subtensor(def_lens[flat_indices], 1)
+    if combiner._def_word_gating == "none":
+        def_sum = tensor.inc_subtensor(def_sum[flat_indices],
+            def_embeddings[def_indices])
+        def_mean = def_sum / tensor.maximum(def_lens[:, None], 1)
+    else:
+        gates = combiner._gate_mlp.apply(def_embeddings[def_indices])[:, 0]
+        def_normalization = tensor.zeros_like(def_lens)
+        def_normalization = tensor.inc_subtensor(
+            def_normalization[flat_indices], tensor.exp(gates))
+        gates = tensor.exp(gates) / def_normalization[flat_indices]
+        def_mean = tensor.inc_subtensor(def_sum[flat_indices],
+            gates[:, None] * def_embeddings[def_indices])
+    unique_indices = tensor.extra_ops.Unique()(flat_indices)
+    return unique_indices, def_mean[unique_indices], def_mean
+
+
+def test_mean_pool_combiner_aggregate():
+    floatX = theano.config.floatX
+    rng = numpy.random.RandomState(1)
+    num_positions = 6
+    def_embeddings_val = rng.normal(size=(5, 3)).astype(floatX)
+    # the position 0 has two definitions, 3 has the definition 3 twice,
+    # 4 has two definitions, the positions 1 and 5 have none
+    flat_indices_val = numpy.array([4, 0, 3, 2, 0, 3, 4])
+    def_indices_val = numpy.array([4, 0, 3, 2, 1, 3, 0])
+    weights_val = rng.normal(size=(num_positions, 3)).astype(floatX)
+
+    def_embeddings = tensor.matrix('def_embeddings', dtype=floatX)
+    flat_indices = tensor.lvector('flat_indices')
+    def_indices = tensor.lvector('def_indices')
+    inputs = [def_embeddings, flat_indices, def_indices]
+    for gating in ["none", "self_attention"]:
+        combiner = MeanPoolCombiner(
+            emb_dim=3, dim=3, def_word_gating=gating,
+            weights_init=Uniform(width=1.), biases_init=Uniform(width=1.),
+            seed=1)
+        combiner.initialize()
+
+        unique_indices, segment_mean = combiner.aggregate(
+            def_embeddings, flat_indices, def_indices)
+        def_mean = tensor.set_subtensor(
+            tensor.zeros((num_positions, 3))[unique_indices], segment_mean)
+        outputs = [(unique_indices, segment_mean, def_mean),
+                   dense_aggregate(combiner, def_embeddings, flat_indices,
+                                   def_indices, num_positions)]
+        values = []
+        for unique_indices, updated, def_mean in outputs:
+            cost = (weights_val * def_mean).sum() + (updated ** 2).sum()
+            wrt = [def_embeddings] + [
+                parameter for _, parameter in
+                sorted(Selector(combiner).get_parameters().items())]
+            values.append(theano.function(
+                inputs, [unique_indices, updated, def_mean] + tensor.grad(cost, wrt))(
+                    def_embeddings_val, flat_indices_val, def_indices_val))
+        assert values[0][0].tolist() == [0, 2, 3, 4]
+        for value, reference in zip(*values):
+            assert numpy.allclose(value, reference, atol=1e-6)
+
+
+def test_definition_cache():
+    with temporary_content_path(TEST_VOCAB) as path:
+        vocab = Vocabulary(path)
+    floatX = theano.config.floatX
+
+    defs_val = numpy.array([[5, 6, 0], [7, 8, 9], [9, 5, 0]])
+    def_mask_val = numpy.array([[1, 1, 0], [1, 1, 1], [1, 1, 0]],
+                               dtype=floatX)
+    # 'b' has the definitions 0 and 1, 'c' has 2, and so does the UNK
+    word_ids_val = numpy.array([[6, 7, 0], [7, 6, 6]])
+    def_map_val = numpy.array([[0, 0, 0], [0, 0, 1], [0, 1, 2], [0, 2, 2],
+                               [1, 0, 2], [1, 1, 0], [1, 1, 1],
+                               [1, 2, 0], [1, 2, 1]])
+
+    reader = MeanPoolReadDefinitions(
+        num_input_words=10, emb_dim=3, dim=3, vocab=vocab,
+        translate=False, weights_init=Uniform(width=0.1))
+    combiner = MeanPoolCombiner(emb_dim=3, dim=3)
+    cache = DefinitionCache(reader, combiner, vocab.size(), max_age=2,
+                            unk=vocab.unk)
+    reader.initialize()
+
+    defs = tensor.lmatrix('defs')
+    def_mask = tensor.matrix('def_mask', dtype=floatX)
+    word_ids = tensor.lmatrix('word_ids')
+    def_map = tensor.lmatrix('def_map')
+    inputs = [defs, def_mask, word_ids, def_map]
+
+    positions, def_means = combiner.aggregate(
+        reader.apply(defs, def_mask),
+        def_map[:, 0] * word_ids.shape[1] + def_map[:, 1], def_map[:, 2])
+    read_all = theano.function(inputs, [positions, def_means],
+                               on_unused_input='ignore')
+    def expected():
+        positions_val, def_means_val = read_all(
+            defs_val, def_mask_val, word_ids_val, def_map_val)
+        result = numpy.zeros((word_ids_val.size, 3), dtype=floatX)
+        result[positions_val] = def_means_val
+        return result.reshape(word_ids_val.shape + (3,))
+
+    cached = cache.apply(defs, def_mask, [word_ids], [def_map])
+    cg = ComputationGraph(cached)
+    hit_rate, = VariableFilter(name='def_cache_hit_rate')(cg)
+    read_cached = theano.function(inputs, [cached, hit_rate],
+                                  updates=cg.updates)
+
+    value, hit_rate_value = read_cached(
+        defs_val, def_mask_val, word_ids_val, def_map_val)
+    assert hit_rate_value == 0.
+    assert numpy.allclose(value, expected())
+    old_value = value
+
+    # 'b' and 'c' are served from the cache, the UNK is read again
+    lookup = reader._def_lookup.W
+    lookup.set_value(2 * lookup.get_value())
+    value, hit_rate_value = read_cached(
+        defs_val, def_mask_val, word_ids_val, def_map_val)
+    assert numpy.isclose(hit_rate_value, 8. / 9)
+    assert numpy.allclose(value[:, :2], old_value[:, :2])
+    assert numpy.allclose(value[1, 2], old_value[1, 2])
+    assert numpy.allclose(value[0, 2], expected()[0, 2])
+
+    # the cached embeddings are now stale
+    value, hit_rate_value = read_cached(
+        defs_val, def_mask_val, word_ids_val, def_map_val)
+    assert hit_rate_value == 0.
+    assert numpy.allclose(value, expected())
@@ -0,0 +1,111 @@
+import numpy
+
+import theano
+from theano import tensor
+from blocks.initialization import Uniform, Constant
+from blocks.graph import ComputationGraph
+from blocks.filter import get_brick
+
+from dictlearn.vocab import Vocabulary
+from dictlearn import nli_esim_model
+from dictlearn.nli_esim_model import ESIM, soft_align, masked_softmax
+
+from tests.util import TEST_VOCAB, temporary_content_path
+
+
+def scan_soft_align(s1, s1_mask, s2, s2_mask):
+    """The scan-based formulation `soft_align` replaced."""
+    def compute_e_row(s2_i, s1_bilstm, s1_mask):
+        b_size = s1_bilstm.shape[0]
+        s2_i = s2_i.reshape((b_size, s2_i.shape[1], 1))
+        s2_i = tensor.repeat(s2_i, 2, axis=2)
+        score = tensor.batched_dot(s1_bilstm, s2_i)
+        return score[:, :, 0].reshape((b_size, -1))
+
+    E, _ = theano.scan(compute_e_row, sequences=[s1.transpose(1, 0, 2)],
+                       non_sequences=[s2, s2_mask])
+    E = E.dimshuffle(1, 0, 2)
+
+    def compute_tilde_vector(e_i, s, s_mask):
+        score = masked_softmax(e_i, s_mask, axis=1)
+        score = score.dimshuffle(0, 1, "x")
+        return (score * (s * s_mask.dimshuffle(0, 1, "x"))).sum(axis=1)
+
+    s1_tilde, _ = theano.scan(compute_tilde_vector,
+        sequences=[E.dimshuffle(1, 0, 2)], non_sequences=[s2, s2_mask])
+    s2_tilde, _ = theano.scan(compute_tilde_vector,
+        sequences=[E.dimshuffle(2, 0, 1)], non_sequences=[s1, s1_mask])
+    return E, s1_tilde.dimshuffle(1, 0, 2), s2_tilde.dimshuffle(1, 0, 2)
+
+
+def _masks(lengths, max_length):
+    floatX = theano.config.floatX
+    return numpy.array([[1] * length + [0] * (max_length - length)
+                        for length in lengths], dtype=floatX)
+
+
+def test_soft_align():
+    floatX = theano.config.floatX
+    rng = numpy.random.RandomState(1)
+    # the padding is not zero, like the states of a masked RNN
+    s1_val = rng.normal(size=(3, 4, 6)).astype(floatX)
+    s2_val = rng.normal(size=(3, 5, 6)).astype(floatX)
+    s1_mask_val = _masks([4, 2, 1], 4)
+    s2_mask_val = _masks([3, 5, 1], 5)
+    weights = [rng.normal(size=shape).astype(floatX)
+               for shape in [(3, 4, 5), (3, 4, 6), (3, 5, 6)]]
+
+    s1 = tensor.tensor3('s1')
+    s2 = tensor.tensor3('s2')
+    s1_mask = tensor.matrix('s1_mask')
+    s2_mask = tensor.matrix('s2_mask')
+    values = []
+    for align in [soft_align, scan_soft_align]:
+        outputs = align(s1, s1_mask, s2, s2_mask)
+        cost = sum((weight * output).sum()
+                   for weight, output in zip(weights, outputs))
+        grads = tensor.grad(cost, [s1, s2])
+        values.append(theano.function(
+            [s1, s1_mask, s2, s2_mask], list(outputs) + grads)(
+                s1_val, s1_mask_val, s2_val, s2_mask_val))
+    for value, reference in zip(*values):
+        assert numpy.allclose(value, reference, atol=1e-5)
+
+
+def test_esim_soft_align():
+    with temporary_content_path(TEST_VOCAB) as path:
+        vocab = Vocabulary(path)
+    floatX = theano.config.floatX
+
+    s1_val = numpy.array([[5, 6, 7, 8], [9, 5, 0, 0], [6, 0, 0, 0]])
+    s2_val = numpy.array([[7, 7, 0], [8, 9, 5], [5, 6, 0]])
+    s1_mask_val = _masks([4, 2, 1], 4)
+    s2_mask_val = _masks([2, 3, 2], 3)
+
+    esim = ESIM(dim=3, emb_dim=4, vocab=vocab, bn=False, dropout=0.,
+                weights_init=Uniform(width=0.2), biases_init=Constant(0.))
+    esim.initialize()
+
+    s1 = tensor.lmatrix('s1')
+    s2 = tensor.lmatrix('s2')
+    s1_mask = tensor.matrix('s1_mask', dtype=floatX)
+    s2_mask = tensor.matrix('s2_mask', dtype=floatX)
+
+    values = []
+    try:
+        for align in [soft_align, scan_soft_align]:
+            nli_esim_model.soft_align = align
+            probs = esim.apply(s1, s1_mask, s2, s2_mask, train_phase=False,
+                               auxiliary=set())
+            cost = -tensor.log(probs[:, 0]).sum()
+            parameters = ComputationGraph(cost).parameters
+            parameters = sorted(
+                parameters, key=lambda p: get_brick(p).get_hierarchical_name(p))
+            grads = tensor.grad(cost, parameters)
+            values.append(theano.function(
+                [s1, s1_mask, s2, s2_mask], [probs] + grads)(
+                    s1_val, s1_mask_val, s2_val, s2_mask_val))
+    finally:
+        nli_esim_model.soft_align = soft_align
+    for value, reference in zip(*values):
+        assert numpy.allclose(value, reference, atol=1e-5)
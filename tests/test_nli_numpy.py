@@ -0,0 +1,66 @@
+import os
+import tempfile
+
+import numpy
+import theano
+from theano import tensor
+from blocks.initialization import Uniform, Constant
+
+from dictlearn.vocab import Vocabulary
+from dictlearn.retrieval import Retrieval, Dictionary
+from dictlearn.nli_simple_model import NLISimple
+from dictlearn.def_embeddings import precompute_def_embeddings
+from dictlearn.nli_numpy import NumpyNLISimple
+
+from tests.util import (
+    TEST_VOCAB, TEST_DICT_JSON, temporary_content_path)
+
+
+def test_numpy_nli_simple():
+    floatX = theano.config.floatX
+    with temporary_content_path(TEST_VOCAB) as path:
+        vocab = Vocabulary(path)
+    with temporary_content_path(TEST_DICT_JSON, suffix=".json") as path:
+        dict_ = Dictionary(path)
+    rng = numpy.random.RandomState(1)
+    dest = tempfile.mkdtemp()
+
+    s1 = numpy.array([[5, 6, 9, 7], [8, 5, 0, 0]])
+    s1_mask = numpy.array([[1, 1, 1, 1], [1, 1, 0, 0]], dtype=floatX)
+    s2 = numpy.array([[6, 4, 0], [9, 8, 7]])
+    s2_mask = numpy.array([[1, 1, 0], [1, 1, 1]], dtype=floatX)
+
+    for encoder, retrieval in [('sum', None),
+                               ('sum', Retrieval(vocab, dict_)),
+                               ('rnn', Retrieval(vocab, dict_))]:
+        model = NLISimple(
+            mlp_dim=6, translate_dim=4, emb_dim=4, vocab=vocab,
+            num_input_words=8, num_input_def_words=vocab.size(),
+            encoder=encoder, n_layers=2, retrieval=retrieval, def_dim=4,
+            def_vocab=vocab, combiner_shortcut=True, exclude_top_k=7,
+            weights_init=Uniform(width=0.5), biases_init=Constant(0.1))
+        model.initialize()
+        # the statistics used in the inference mode
+        for bn in [model._prem_bn, model._hyp_bn] + [bn for _, _, bn in model._mlp]:
+            bn.population_mean.set_value(
+                rng.normal(size=bn.input_dim).astype(floatX))
+            bn.population_stdev.set_value(
+                rng.uniform(0.5, 2, size=bn.input_dim).astype(floatX))
+
+        def_table = None
+        if retrieval:
+            def_table = numpy.array(precompute_def_embeddings(
+                model, retrieval, vocab, os.path.join(dest, 'table.npy')))
+            model.set_def_table(def_table)
+        s1_var, s2_var = tensor.lmatrix('s1'), tensor.lmatrix('s2')
+        s1_mask_var, s2_mask_var = tensor.matrix('s1_mask'), tensor.matrix('s2_mask')
+        pred = model.apply(s1_var, s1_mask_var, s2_var, s2_mask_var,
+                           train_phase=False)
+        expected = theano.function(
+            [s1_var, s1_mask_var, s2_var, s2_mask_var], pred)(
+                s1, s1_mask, s2, s2_mask)
+
+        path = os.path.join(dest, 'model.npz')
+        model.export_numpy(path, def_table=def_table)
+        predicted = NumpyNLISimple(path).predict(s1, s1_mask, s2, s2_mask)
+        assert numpy.allclose(predicted, expected, atol=1e-5)
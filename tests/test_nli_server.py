@@ -0,0 +1,104 @@
+import json
+import time
+import httplib
+import threading
+
+import numpy
+
+from dictlearn.vocab import Vocabulary
+from dictlearn.retrieval import Dictionary, Retrieval
+from dictlearn.nli_server import MicroBatcher, NLIPredictor, make_server
+
+from tests.util import TEST_VOCAB, TEST_DICT_JSON, temporary_content_path
+
+
+def _fake_predict(batch_sizes):
+    def predict(pairs):
+        batch_sizes.append(len(pairs))
+        time.sleep(0.01)
+        # the probabilities depend on the pair, to check the order
+        lengths = numpy.array([[len(s1), len(s2), 1] for s1, s2 in pairs], dtype='float64')
+        return lengths / lengths.sum(axis=1, keepdims=True)
+    return predict
+
+
+def _post(port, content):
+    connection = httplib.HTTPConnection('localhost', port)
+    connection.request('POST', '/predict', json.dumps(content))
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def test_micro_batching_server():
+    batch_sizes = []
+    batcher = MicroBatcher(_fake_predict(batch_sizes), max_batch_size=4,
+                           max_wait=0.05).start()
+    server = make_server(batcher, ('localhost', 0), timeout=5)
+    port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        requests = [[['a' * (i + 1), 'b b'], ['c', 'd' * i + 'd']] for i in range(6)]
+        answers = [None] * len(requests)
+
+        def client(i):
+            answers[i] = _post(port, {'pairs': requests[i]})
+        clients = [threading.Thread(target=client, args=(i,))
+                   for i in range(len(requests))]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+
+        for pairs, (status, answer) in zip(requests, answers):
+            assert status == 200
+            assert answer['labels'] == ['contradiction', 'neutral', 'entailment']
+            assert numpy.allclose(answer['probabilities'],
+                                  _fake_predict([])(pairs))
+        assert sum(batch_sizes) == 12
+        assert max(batch_sizes) <= 4
+        assert len(batch_sizes) < 12
+
+        status, answer = _post(port, {'pairs': [['a', '']]})
+        assert status == 400
+        status, _ = _post(port, {'sentences': []})
+        assert status == 400
+
+        connection = httplib.HTTPConnection('localhost', port)
+        connection.request('GET', '/metrics')
+        metrics = json.loads(connection.getresponse().read())
+        assert metrics['requests'] == 6
+        assert metrics['pairs'] == 12
+        assert metrics['batches'] == len(batch_sizes)
+        assert metrics['latency_ms']['p50'] > 0
+    finally:
+        server.shutdown()
+        server.server_close()
+        batcher.stop()
+
+
+def test_nli_predictor():
+    with temporary_content_path(TEST_VOCAB, ".txt") as path:
+        vocab = Vocabulary(path)
+    with temporary_content_path(TEST_DICT_JSON, ".json") as path:
+        dict_ = Dictionary(path)
+
+    calls = []
+
+    def predict_function(**inputs):
+        calls.append(inputs)
+        return numpy.ones((len(inputs['sentence1']), 3)) / 3
+    predictor = NLIPredictor(predict_function, vocab, Retrieval(vocab, dict_),
+                             lowercase=True)
+    probabilities = predictor([('A b.', 'c'), ('x', 'e d')])
+    assert probabilities.shape == (2, 3)
+
+    inputs, = calls
+    assert (inputs['sentence1'] == [[5, 6, 0], [0, 0, 0]]).all()
+    assert (inputs['sentence1_mask'] == [[1, 1, 1], [1, 0, 0]]).all()
+    assert (inputs['sentence2'] == [[7, 0], [9, 8]]).all()
+    assert (inputs['sentence2_mask'] == [[1, 0], [1, 1]]).all()
+    # the definitions of "a" and "b" in the first premise
+    assert inputs['sentence1_def_map'].tolist() == [[0, 0, 0], [0, 0, 1], [0, 1, 2]]
+    assert inputs['defs'].shape[0] == len(inputs['def_mask'])
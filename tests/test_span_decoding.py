@@ -0,0 +1,56 @@
+import numpy
+
+import theano
+from theano import tensor
+
+from dictlearn.span_decoding import best_spans, best_span
+
+
+def _brute_force(begin_scores, end_scores, max_answer_len):
+    # the best beginning for every end
+    best = {}
+    for begin in range(len(begin_scores)):
+        for end in range(begin + 1, min(begin + max_answer_len, len(end_scores) - 1) + 1):
+            score = begin_scores[begin] + end_scores[end]
+            if end not in best or score > best[end][0]:
+                best[end] = (score, begin)
+    return sorted(((score, begin, end) for end, (score, begin) in best.items()),
+                  reverse=True)
+
+
+def test_best_spans():
+    rng = numpy.random.RandomState(1)
+    begin_scores = rng.normal(size=(4, 9))
+    end_scores = rng.normal(size=(4, 9))
+    mask = numpy.ones((4, 9))
+    mask[1, 5:] = 0
+    mask[3, 2:] = 0
+
+    for max_answer_len in [1, 3, 20]:
+        begins, ends, scores = best_spans(
+            begin_scores, end_scores, mask, max_answer_len, k=3)
+        for i in range(4):
+            length = int(mask[i].sum())
+            log_begin = begin_scores[i, :length] - numpy.log(
+                numpy.exp(begin_scores[i, :length]).sum())
+            log_end = end_scores[i, :length] - numpy.log(
+                numpy.exp(end_scores[i, :length]).sum())
+            expected = _brute_force(log_begin, log_end, max_answer_len)[:3]
+            for j, (score, begin, end) in enumerate(expected):
+                assert begins[i, j] == begin
+                assert ends[i, j] == end
+                assert numpy.allclose(scores[i, j], score)
+            assert numpy.all(scores[i, len(expected):] == -numpy.inf)
+
+        # the graph gives the same best spans
+        begins_var = tensor.matrix('begins')
+        ends_var = tensor.matrix('ends')
+        decode = theano.function(
+            [begins_var, ends_var],
+            best_span(begins_var, ends_var, max_answer_len))
+        masked = lambda scores: (scores * mask - 1000 * (1 - mask)).astype(
+            theano.config.floatX)
+        graph_begins, graph_ends = decode(masked(begin_scores),
+                                          masked(end_scores))
+        assert numpy.all(graph_begins == begins[:, 0])
+        assert numpy.all(graph_ends == ends[:, 0])
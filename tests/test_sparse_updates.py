@@ -0,0 +1,48 @@
+import numpy
+
+import theano
+from theano import tensor
+from blocks.algorithms import GradientDescent, Adam, Scale
+from blocks.utils import shared_floatx
+
+from dictlearn.sparse_updates import (
+    SparseSGD, SparseAdam, find_lookups, sparse_updates)
+
+
+def _lookup_cost(W, indices):
+    # the same row is looked up twice and the table is used twice
+    embs = W[indices]
+    more_embs = W[indices[:2]]
+    return (embs ** 2).sum() + embs.sum() + (more_embs * 3).sum()
+
+
+def test_sparse_updates():
+    rng = numpy.random.RandomState(1)
+    indices = tensor.lvector('indices')
+    indices_val = numpy.array([3, 1, 3, 0])
+
+    for sparse_rule, dense_rule in [
+            (SparseSGD(0.1), Scale(0.1)),
+            (SparseAdam(learning_rate=0.1), Adam(learning_rate=0.1))]:
+        value = rng.uniform(size=(5, 2))
+        W_dense = shared_floatx(value, name='W')
+        W_sparse = shared_floatx(value, name='W')
+
+        dense = GradientDescent(cost=_lookup_cost(W_dense, indices),
+                                parameters=[W_dense], step_rule=dense_rule)
+        dense.initialize()
+        cost = _lookup_cost(W_sparse, indices)
+        assert len(find_lookups(cost, [W_sparse])[W_sparse]) == 2
+        parameters, updates = sparse_updates(cost, {W_sparse: sparse_rule})
+        assert parameters == [W_sparse]
+        sparse = theano.function([indices], [], updates=updates)
+
+        for i in range(3):
+            dense.process_batch({'indices': indices_val})
+            sparse(indices_val)
+            # the rows that are looked up at every step are updated
+            # like with the dense rules, the other rows are untouched
+            assert numpy.allclose(W_sparse.get_value()[[0, 1, 3]],
+                                  W_dense.get_value()[[0, 1, 3]])
+            assert numpy.allclose(W_sparse.get_value()[[2, 4]],
+                                  value[[2, 4]])
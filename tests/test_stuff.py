@@ -0,0 +1,38 @@
+import numpy
+
+import theano
+from theano import tensor
+from blocks.initialization import Uniform
+from blocks.filter import VariableFilter
+from blocks.graph import ComputationGraph
+from blocks.model import Model
+
+from dictlearn.stuff import PeepholeLSTM, DebugLSTM
+
+
+def test_peephole_lstm():
+    floatX = theano.config.floatX
+    inputs = tensor.tensor3('inputs')
+    mask = tensor.matrix('mask')
+    inputs_val = numpy.random.RandomState(1).uniform(
+        size=(5, 2, 12)).astype(floatX)
+    mask_val = numpy.ones((5, 2), dtype=floatX)
+    mask_val[3:, 1] = 0
+
+    debug = DebugLSTM(3, weights_init=Uniform(width=0.1), name='rnn')
+    debug.initialize()
+    debug_states = debug.apply(inputs, mask=mask)[0]
+    assert len(VariableFilter(name='input_gates')(
+        ComputationGraph(debug_states))) == 1
+
+    lstm = PeepholeLSTM(3, weights_init=Uniform(width=0.1), name='rnn')
+    lstm.initialize()
+    states = lstm.apply(inputs, mask=mask)[0]
+    assert not VariableFilter(name='input_gates')(ComputationGraph(states))
+
+    # the parameters of one can be loaded into the other
+    model = Model(states)
+    model.set_parameter_values(Model(debug_states).get_parameter_values())
+    f = theano.function([inputs, mask], [states, debug_states])
+    states_val, debug_states_val = f(inputs_val, mask_val)
+    assert numpy.allclose(states_val, debug_states_val)
@@ -1,3 +1,4 @@
+import numpy
 from theano import tensor
 
 from dictlearn.vocab import Vocabulary
@@ -19,3 +20,13 @@ def test_vocab_op():
 
     input_ = tensor.as_tensor_variable([[ord('a'), 0], [ord('b'), 0]])
     assert list(op(input_).eval()) == [5, 6]
+
+
+def test_words_to_ids():
+    with temporary_content_path(TEST_VOCAB) as path:
+        vocab = Vocabulary(path)
+    words = ['a', 'e', 'xyz', 'c', '<bos>', 'a']
+    assert vocab.words_to_ids(words).tolist() == map(vocab.word_to_id, words)
+    assert (vocab.words_to_ids(numpy.array(words, dtype='S5')).tolist()
+            == map(vocab.word_to_id, words))
+    assert vocab.words_to_ids([]).tolist() == []